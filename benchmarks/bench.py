@@ -0,0 +1,471 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+
+RWLock, Semaphore, StripedSemaphore的竞争压测，结果输出成json，方便不同版本之间对比
+
+    python benchmarks/bench.py --backend spawn --coroutines 50 --processes 4
+    python benchmarks/bench.py --backend memory -o after.json --compare before.json
+
+场景写成 名字:参数
+    rwlock:<读的比例>            rwlock:0.9 读多写少，rwlock:0.1 写多读少
+    semaphore:<value>
+    fair:<value>                 fair=True的Semaphore，和semaphore:<value>对比尾延迟
+    striped:<value>:<stripes>    默认从striped:16:1到striped:16:16，看吞吐量随stripes的变化
+每个协程循环 获取 -> 持有--hold秒 -> 释放，直到--duration秒用完，一次获取加释放算一个op
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from redis.asyncio import Redis
+
+import redislocks
+from redislocks import MemoryBackend, RWLock, Semaphore, StripedSemaphore
+
+DEFAULT_SCENARIOS = [
+    "rwlock:0.9",
+    "rwlock:0.5",
+    "rwlock:0.1",
+    "semaphore:1",
+    "semaphore:10",
+    "fair:1",
+    "fair:10",
+    # 同样的value，stripes翻倍，看吞吐量随子信号量个数怎么变
+    "striped:16:1",
+    "striped:16:2",
+    "striped:16:4",
+    "striped:16:8",
+    "striped:16:16",
+]
+KEYSPACE_EVENTS = "KEA"
+# 建连接、加载脚本、统计本身用的命令，不算在op里
+SETUP_COMMANDS = {
+    "client",
+    "config",
+    "function",
+    "hello",
+    "info",
+    "ping",
+    "scan",
+    "script",
+    "select",
+    "subscribe",
+    "unsubscribe",
+}
+
+
+class _Value:
+    """单进程的时候代替multiprocessing.Value"""
+
+    def __init__(self):
+        self.value = 0.0
+
+
+class Recorder:
+    """
+    记录一个进程里所有协程的延迟
+    获取延迟: 调用acquire到返回
+    交接延迟: 获取还没返回的时候别人释放了，从最近一次释放到获取返回，跨进程的释放时间放在共享内存里
+    """
+
+    def __init__(self, last_release):
+        self.ops = 0
+        self.acquire = []  # type: List[float]
+        self.handoff = []  # type: List[float]
+        self._last_release = last_release
+
+    async def acquire_timed(self, awaitable) -> None:
+        start = time.monotonic()
+        await awaitable
+        now = time.monotonic()
+        self.acquire.append(now - start)
+        last_release = self._last_release.value
+        if last_release > start:
+            self.handoff.append(now - last_release)
+
+    def released(self) -> None:
+        self._last_release.value = time.monotonic()
+        self.ops += 1
+
+
+def make_lock(scenario: str, client, namespace: str, options):
+    kind, *params = scenario.split(":")
+    if kind == "rwlock":
+        return RWLock(
+            client,
+            namespace,
+            notify=options.notify,
+            coalesce_reads=options.coalesce_reads,
+        )
+    if kind == "semaphore":
+        return Semaphore(int(params[0]), client, namespace, layout=options.layout)
+    if kind == "fair":
+        return Semaphore(
+            int(params[0]), client, namespace, layout=options.layout, fair=True
+        )
+    if kind == "striped":
+        return StripedSemaphore(
+            int(params[0]), int(params[1]), client, namespace, layout=options.layout
+        )
+    raise ValueError(f"unknown scenario {scenario!r}")
+
+
+async def _rwlock_worker(lock: RWLock, read_ratio: float, hold, deadline, recorder):
+    rng = random.Random()
+    while time.monotonic() < deadline:
+        mode = "r" if rng.random() < read_ratio else "w"
+        await recorder.acquire_timed(lock.acquire(mode))
+        await asyncio.sleep(hold)
+        await lock.release(mode)
+        recorder.released()
+
+
+async def _semaphore_worker(sem, hold, deadline, recorder):
+    while time.monotonic() < deadline:
+        await recorder.acquire_timed(sem.acquire())
+        await asyncio.sleep(hold)
+        await sem.release()
+        recorder.released()
+
+
+async def run_scenario(
+    scenario: str, client, namespace: str, options, last_release, barrier=None
+):
+    """在当前进程里跑options.coroutines个协程，所有协程共用一个锁对象，返回Recorder"""
+    lock = make_lock(scenario, client, namespace, options)
+    # 预热，加载脚本、建立订阅、初始化信号量，不计入结果
+    if isinstance(lock, RWLock):
+        await lock.acquire("w")
+        await lock.release("w")
+    else:
+        await lock.acquire()
+        await lock.release()
+    if barrier is not None:  # 所有进程准备好了再一起开始
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    recorder = Recorder(last_release)
+    deadline = time.monotonic() + options.duration
+    if isinstance(lock, RWLock):
+        read_ratio = float(scenario.split(":")[1])
+        workers = [
+            _rwlock_worker(lock, read_ratio, options.hold, deadline, recorder)
+            for _ in range(options.coroutines)
+        ]
+    else:
+        workers = [
+            _semaphore_worker(lock, options.hold, deadline, recorder)
+            for _ in range(options.coroutines)
+        ]
+    await asyncio.gather(*workers)
+    return recorder
+
+
+def _process_main(scenario, url, namespace, options, last_release, barrier, queue):
+    async def main():
+        client = Redis.from_url(url)
+        try:
+            recorder = await run_scenario(
+                scenario, client, namespace, options, last_release, barrier
+            )
+        finally:
+            await client.aclose()
+        return recorder
+
+    recorder = asyncio.run(main())
+    queue.put((recorder.ops, recorder.acquire, recorder.handoff))
+
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    """毫秒，最近秩法"""
+    if not samples:
+        return {"count": 0, "p50": None, "p99": None, "p999": None, "max": None}
+    samples = sorted(samples)
+
+    def rank(q: float) -> float:
+        return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+    return {
+        "count": len(samples),
+        "p50": rank(0.5),
+        "p99": rank(0.99),
+        "p999": rank(0.999),
+        "max": samples[-1] * 1000,
+    }
+
+
+async def command_stats(url: str) -> Dict[str, int]:
+    """服务器上每个命令的调用次数，脚本里redis.call的命令也算"""
+    client = Redis.from_url(url)
+    try:
+        stats = await client.info("commandstats")
+    finally:
+        await client.aclose()
+    calls = {}  # type: Dict[str, int]
+    for name, value in stats.items():
+        command = name[len("cmdstat_") :]
+        if command.split("|")[0] not in SETUP_COMMANDS:
+            calls[command] = value["calls"]
+    return calls
+
+
+async def _prepare_server(url: str, options) -> str:
+    client = Redis.from_url(url)
+    try:
+        if options.notify in (None, "keyspace"):  # RWLock默认用keyspace事件
+            await client.config_set("notify-keyspace-events", KEYSPACE_EVENTS)
+        return (await client.info("server"))["redis_version"]
+    finally:
+        await client.aclose()
+
+
+async def _cleanup(url: str, namespace: str) -> None:
+    client = Redis.from_url(url)
+    try:
+        keys = [key async for key in client.scan_iter(match=f"{namespace}*")]
+        if keys:
+            await client.delete(*keys)
+    finally:
+        await client.aclose()
+
+
+def bench(scenario: str, index: int, url: Optional[str], options) -> dict:
+    namespace = f"BENCH{os.getpid()}_{index}"
+    before = asyncio.run(command_stats(url)) if url else None
+    started = time.monotonic()
+    if url is None:  # 进程内后端，只能单进程
+
+        async def main():
+            return await run_scenario(
+                scenario, MemoryBackend(), namespace, options, _Value()
+            )
+
+        recorder = asyncio.run(main())
+        ops, acquire, handoff = recorder.ops, recorder.acquire, recorder.handoff
+    elif options.processes == 1:
+
+        async def main():
+            client = Redis.from_url(url)
+            try:
+                return await run_scenario(
+                    scenario, client, namespace, options, _Value()
+                )
+            finally:
+                await client.aclose()
+
+        recorder = asyncio.run(main())
+        ops, acquire, handoff = recorder.ops, recorder.acquire, recorder.handoff
+    else:
+        last_release = multiprocessing.Value("d", 0.0, lock=False)
+        barrier = multiprocessing.Barrier(options.processes)
+        queue = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=_process_main,
+                args=(scenario, url, namespace, options, last_release, barrier, queue),
+            )
+            for _ in range(options.processes)
+        ]
+        for process in processes:
+            process.start()
+        ops, acquire, handoff = 0, [], []
+        for _ in processes:  # 先取结果再join，不然队列满了子进程退不出来
+            process_ops, process_acquire, process_handoff = queue.get()
+            ops += process_ops
+            acquire.extend(process_acquire)
+            handoff.extend(process_handoff)
+        for process in processes:
+            process.join()
+    elapsed = time.monotonic() - started
+
+    result = {
+        "scenario": scenario,
+        "ops": ops,
+        "duration": options.duration,
+        "ops_per_sec": ops / options.duration,
+        "acquire_latency_ms": percentiles(acquire),
+        "handoff_latency_ms": percentiles(handoff),
+        "commands_per_op": None,
+        "commands": None,
+        "wall_time": elapsed,
+    }
+    if url is not None:
+        after = asyncio.run(command_stats(url))
+        asyncio.run(_cleanup(url, namespace))
+        if ops:
+            commands = {
+                name: (calls - before.get(name, 0)) / ops
+                for name, calls in after.items()
+                if calls != before.get(name, 0)
+            }
+            result["commands"] = dict(sorted(commands.items()))
+            result["commands_per_op"] = sum(commands.values())
+    return result
+
+
+class RedisServer:
+    """在临时目录里起一个不落盘的redis-server"""
+
+    def __init__(self, executable: str = "redis-server"):
+        self.executable = shutil.which(executable)
+        if self.executable is None:
+            raise RuntimeError(f"{executable} not found")
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.url = f"redis://127.0.0.1:{self.port}"
+        self._dir = tempfile.TemporaryDirectory()
+        self._process = None  # type: Optional[subprocess.Popen]
+
+    def __enter__(self):
+        self._process = subprocess.Popen(
+            [
+                self.executable,
+                "--port",
+                str(self.port),
+                "--bind",
+                "127.0.0.1",
+                "--save",
+                "",
+                "--appendonly",
+                "no",
+                "--dir",
+                self._dir.name,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), 0.1):
+                    return self
+            except OSError:
+                if time.monotonic() > deadline or self._process.poll() is not None:
+                    self.__exit__(None, None, None)
+                    raise RuntimeError("redis-server did not start")
+                time.sleep(0.05)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+        self._dir.cleanup()
+
+
+def compare(previous: dict, current: dict) -> str:
+    """和之前的结果按场景对比，返回给人看的表格"""
+    old = {result["scenario"]: result for result in previous["results"]}
+    lines = [
+        f"{'scenario':<16}{'ops/s':>12}{'change':>9}{'p99 ms':>10}{'change':>9}",
+    ]
+    for result in current["results"]:
+        before = old.get(result["scenario"])
+        ops = result["ops_per_sec"]
+        p99 = result["acquire_latency_ms"]["p99"] or 0.0
+        if before is None:
+            lines.append(f"{result['scenario']:<16}{ops:>12.0f}{'':>9}{p99:>10.3f}")
+            continue
+        old_ops = before["ops_per_sec"]
+        old_p99 = before["acquire_latency_ms"]["p99"] or 0.0
+        ops_change = f"{(ops / old_ops - 1) * 100:+.1f}%" if old_ops else ""
+        p99_change = f"{(p99 / old_p99 - 1) * 100:+.1f}%" if old_p99 else ""
+        lines.append(
+            f"{result['scenario']:<16}{ops:>12.0f}{ops_change:>9}{p99:>10.3f}{p99_change:>9}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("scenarios", nargs="*", default=DEFAULT_SCENARIOS)
+    parser.add_argument(
+        "--backend",
+        choices=("redis", "spawn", "memory"),
+        default="spawn",
+        help="redis: use --url, spawn: start a local redis-server, memory: MemoryBackend",
+    )
+    parser.add_argument("--url", default="redis://localhost:6379/0")
+    parser.add_argument("--redis-server", default="redis-server")
+    parser.add_argument("--coroutines", type=int, default=20, help="per process")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument(
+        "--duration", type=float, default=5.0, help="seconds per scenario"
+    )
+    parser.add_argument(
+        "--hold", type=float, default=0.0, help="seconds to hold the lock"
+    )
+    parser.add_argument("--notify", choices=("keyspace", "publish"), default=None)
+    parser.add_argument("--coalesce-reads", action="store_true")
+    parser.add_argument("--layout", choices=("list", "counter"), default="list")
+    parser.add_argument("-o", "--output", help="write the json here instead of stdout")
+    parser.add_argument("--compare", help="previous json to compare against")
+    options = parser.parse_args(argv)
+    if options.backend == "memory" and options.processes != 1:
+        parser.error("the memory backend only works with --processes 1")
+    for scenario in options.scenarios:
+        if scenario.split(":")[0] not in ("rwlock", "semaphore", "fair", "striped"):
+            parser.error(f"unknown scenario {scenario!r}")
+    return options
+
+
+def run(options, url: Optional[str]) -> dict:
+    redis_version = asyncio.run(_prepare_server(url, options)) if url else None
+    results = []
+    for index, scenario in enumerate(options.scenarios):
+        result = bench(scenario, index, url, options)
+        print(
+            f"{scenario}: {result['ops_per_sec']:.0f} ops/s, "
+            f"p99 {result['acquire_latency_ms']['p99'] or 0:.3f} ms",
+            file=sys.stderr,
+        )
+        results.append(result)
+    return {
+        "redislocks": redislocks.__version__,
+        "python": platform.python_version(),
+        "redis": redis_version,
+        "backend": options.backend,
+        "config": {
+            "coroutines": options.coroutines,
+            "processes": options.processes,
+            "duration": options.duration,
+            "hold": options.hold,
+            "notify": options.notify,
+            "coalesce_reads": options.coalesce_reads,
+            "layout": options.layout,
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.backend == "memory":
+        report = run(options, None)
+    elif options.backend == "redis":
+        report = run(options, options.url)
+    else:
+        with RedisServer(options.redis_server) as server:
+            report = run(options, server.url)
+    data = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            f.write(data)
+    else:
+        print(data)
+    if options.compare:
+        with open(options.compare, "r", encoding="utf-8") as f:
+            print(compare(json.load(f), report), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
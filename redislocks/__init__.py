@@ -2,7 +2,12 @@
 Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
 """
 from redislocks.exceptions import NotAvailable
+from redislocks.memory import MemoryBackend
+from redislocks.metrics import LockMetrics
+from redislocks.multilock import MultiLock
+from redislocks.quorum import QuorumRWLock, QuorumSemaphore
 from redislocks.rwlock import LockState, RWLock
 from redislocks.sem import Semaphore
+from redislocks.striped import StripedSemaphore
 
 __version__ = "0.0.1dev1"
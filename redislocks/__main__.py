@@ -0,0 +1,55 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+
+python -m redislocks stats --url redis://localhost:6379/0 --sort rate --top 10
+"""
+import argparse
+import asyncio
+import json
+import sys
+from typing import List, Optional
+
+from redislocks.stats import SORT_KEYS, collect, format_table, rank
+
+
+async def _stats(args) -> None:
+    if args.cluster:
+        from redis.asyncio import RedisCluster
+
+        client = RedisCluster.from_url(args.url)
+    else:
+        from redis.asyncio import Redis
+
+        client = Redis.from_url(args.url)
+    try:
+        ranked = rank(await collect(client, args.match), args.sort, args.top)
+    finally:
+        await client.aclose()
+    if args.json:
+        json.dump(dict(ranked), sys.stdout, indent=2)
+        print()
+    elif ranked:
+        print(format_table(ranked))
+    else:
+        print(f"no stats found for {args.match!r}, is stats=True set on the locks?")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m redislocks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    stats = commands.add_parser(
+        "stats", help="rank namespaces by contention, see redislocks.stats"
+    )
+    stats.add_argument("--url", default="redis://localhost:6379/0")
+    stats.add_argument("--cluster", action="store_true", help="url is a Redis Cluster")
+    stats.add_argument("--match", default="*", help="namespace glob pattern")
+    stats.add_argument("--sort", choices=SORT_KEYS, default="contended")
+    stats.add_argument("--top", type=int, default=20, help="0 for all")
+    stats.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+    if args.command == "stats":
+        asyncio.run(_stats(args))
+
+
+if __name__ == "__main__":
+    main()
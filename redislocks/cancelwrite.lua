@@ -0,0 +1,35 @@
+-- 取消等待中的写锁
+-- numkey: 4
+-- keys: read_key write_key write_waiter_key lease_key [stats_key]
+-- argv: event_channel token
+local token = ARGV[2]
+local read_key = KEYS[1]
+local write_key = KEYS[2]
+local write_waiter_key = KEYS[3]
+local event_channel = ARGV[1]
+local lease_key = KEYS[4]
+local stats_key = KEYS[5]
+
+redis.call("ZREM", lease_key, token)
+
+if redis.call("ZREM", write_waiter_key, token) == 1 then
+    -- 还在队列里，删掉就行
+    -- 最后一个等写锁的走了的话被它挡住的读锁可以进来了，写锁key没变，没有keyspace事件，要发布"open"
+    -- 它前面没人了的话排在最前面的可能是在等的MultiLock
+    waiter_left(read_key, write_key, write_waiter_key, event_channel, stats_key)
+    return 1
+end
+if redis.call("GET", write_key) == token then
+    -- 取消的时候已经被轮到了，等于获取了写锁又马上释放，帮下一个人轮
+    local write_token = pop_writer(write_waiter_key)
+    if write_token then
+        redis.call("SET", write_key, write_token)
+        redis.call("PUBLISH", event_channel, "set:" .. write_token)
+        record_promotion(stats_key)
+    else
+        redis.call("DEL", write_key)
+        redis.call("PUBLISH", event_channel, "del")
+    end
+    return 2
+end
+return 0
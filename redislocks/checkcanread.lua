@@ -1,13 +1,12 @@
 -- 看看是否可以唤醒blocking的读锁
--- numkey: 1
--- namespace
-local namespace = KEYS[1]
+-- numkey: 4
+-- keys: read_key write_key write_waiter_key lease_key
 
-local read_key = namespace .. ":READ"
-local write_key = namespace .. ":WRITE"
-local write_waiter_key = namespace .. ":WRITEWAITER"
+local read_key = KEYS[1]
+local write_key = KEYS[2]
+local write_waiter_key = KEYS[3]
 
-if redis.call("EXISTS", write_key) == 1 or redis.call("LLEN", write_waiter_key) > 0 then
+if redis.call("EXISTS", write_key) == 1 or redis.call("ZCARD", write_waiter_key) > 0 then
     -- 存在写锁或者有人在等写锁
     return 0 -- 不能唤醒waiters
 else
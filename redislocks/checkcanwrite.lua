@@ -1,11 +1,10 @@
 -- 看看是否可以立刻获取写锁
--- numkey: 1
--- namespace
-local namespace = KEYS[1]
+-- numkey: 4
+-- keys: read_key write_key write_waiter_key lease_key
 
-local read_key = namespace .. ":READ"
-local write_key = namespace .. ":WRITE"
-local write_waiter_key = namespace .. ":WRITEWAITER"
+local read_key = KEYS[1]
+local write_key = KEYS[2]
+local write_waiter_key = KEYS[3]
 
 if redis.call("EXISTS", write_key) == 1 or redis.call("SCARD", read_key) > 0 then
     -- 存在写锁或者存在读锁
@@ -0,0 +1,372 @@
+-- 各个脚本共用的函数
+-- scripts.py把它拼在用到这些函数的脚本前面，FUNCTION库里只出现一次
+-- 这里只能定义local函数，不能在最外层return，也不能用KEYS和ARGV
+
+-- 读写锁现在的状态
+-- 0 空的 1 读ing 2 写ing 3 没有写锁并且有人在等写锁
+-- 没有读锁也没有写锁还有人排队的话，排在最前面的是在等别的namespace的MultiLock，新来的也不能插队，算3
+local function get_state(read_key, write_key, write_waiter_key)
+    local read_lock_exists = redis.call("SCARD", read_key) > 0
+    local write_lock_exists = redis.call("EXISTS", write_key) == 1
+    local write_waiter_exists = redis.call("ZCARD", write_waiter_key) > 0
+    if not read_lock_exists and not write_lock_exists then -- 没有读锁也没有写锁
+        if write_waiter_exists then
+            return 3
+        end
+        return 0
+    elseif read_lock_exists and not write_lock_exists and not write_waiter_exists then -- 存在读锁，不存在写锁和写锁等待，读ing
+        return 1
+    elseif not read_lock_exists and write_lock_exists then -- 不存在读锁，存在写锁，写ing
+        return 2
+    elseif read_lock_exists and not write_lock_exists and write_waiter_exists then -- 存在读锁，不存在写锁，不过有等待等待队列有东西
+        return 3
+    end
+end
+
+-- WRITEWAITER是zset[token, 分数]，分数小的先拿到写锁
+-- 分数是排队时的微秒时间戳减去priority * step_us，同一个优先级内先来后到
+-- step_us是等多久抵得上一级优先级，不开aging的时候用WRITER_STRICT_STEP_US，相当于严格按优先级
+-- 升级的写者分数是-inf，排在所有人前面
+local WRITER_STRICT_STEP_US = 1099511627776 -- 2^40微秒，大约12.7天
+
+local function writer_score(time, priority, step_us)
+    local now_us = tonumber(time[1]) * 1000000 + tonumber(time[2])
+    -- 超过14位有效数字的数字直接传给redis.call会被转成科学计数法，丢精度
+    return string.format("%.0f", now_us - priority * step_us)
+end
+
+-- 排队的MultiLock的token以"multi:"开头，它在每个namespace的WRITEWAITER里都排着，
+-- 单个namespace的脚本不能替它拿锁，要等每个namespace都轮到它的时候由multilock.lua一起拿
+local function is_multi(token)
+    return string.sub(token, 1, 6) == "multi:"
+end
+
+-- 取出分数最小的写者，没有的话返回nil
+-- 排在最前面的是MultiLock的话也返回nil，调用的脚本发布del或者free让它自己重试
+local function pop_writer(write_waiter_key)
+    local write_token = redis.call("ZRANGE", write_waiter_key, 0, 0)[1]
+    if not write_token or is_multi(write_token) then
+        return nil
+    end
+    redis.call("ZREM", write_waiter_key, write_token)
+    return write_token
+end
+
+-- 统计，stats_key是NS:STATS hash，没打开统计的锁不传这个key，是nil，见redislocks/stats.py
+-- mode是读写锁的"r"或者"w"，信号量是"s"，等待和持有时间按2的幂分桶，桶名是上界(毫秒)
+local function stats_bucket(ms)
+    local bucket = 1
+    while bucket < ms do
+        bucket = bucket * 2
+    end
+    return bucket
+end
+
+-- 没能立刻拿到，失败或者开始排队
+local function record_contended(stats_key, mode)
+    if stats_key then
+        redis.call("HINCRBY", stats_key, "contended:" .. mode, 1)
+    end
+end
+
+-- 写锁被轮给了排队的写者
+local function record_promotion(stats_key)
+    if stats_key then
+        redis.call("HINCRBY", stats_key, "promotions", 1)
+    end
+end
+
+-- count个token被释放，wait_ms和hold_ms是客户端量的等待和持有时间，没量的话是空字符串，不记
+local function record_release(stats_key, mode, count, wait_ms, hold_ms)
+    wait_ms = tonumber(wait_ms)
+    hold_ms = tonumber(hold_ms)
+    if not stats_key or count == 0 or not wait_ms or not hold_ms then
+        return
+    end
+    redis.call("HINCRBY", stats_key, "acquired:" .. mode, count)
+    redis.call("HINCRBY", stats_key, "wait_ms:" .. mode, math.floor(wait_ms) * count)
+    redis.call("HINCRBY", stats_key, "hold_ms:" .. mode, math.floor(hold_ms) * count)
+    redis.call("HINCRBY", stats_key, "wait:" .. mode .. ":" .. stats_bucket(wait_ms), count)
+    redis.call("HINCRBY", stats_key, "hold:" .. mode .. ":" .. stats_bucket(hold_ms), count)
+end
+
+-- 没有写锁，有人在排队的时候调用，读锁也空了就把写锁轮给队首的写者
+-- 轮不到的话队首可能是MultiLock，要读的话有读锁也能拿，发布"free"让它重试
+local function promote_or_free(read_key, write_key, write_waiter_key, event_channel, stats_key)
+    local write_token = nil
+    if redis.call("SCARD", read_key) == 0 then
+        write_token = pop_writer(write_waiter_key)
+    end
+    if write_token then
+        redis.call("SET", write_key, write_token)
+        redis.call("PUBLISH", event_channel, "set:" .. write_token)
+        record_promotion(stats_key)
+    else
+        redis.call("PUBLISH", event_channel, "free")
+    end
+end
+
+-- 回收租约过期的token，被挡住的等待者顺便轮一下
+local function reap(read_key, write_key, write_waiter_key, lease_key, event_channel, now_ms, stats_key)
+    local expired = redis.call("ZRANGEBYSCORE", lease_key, "-inf", now_ms, "LIMIT", 0, 100)
+    if #expired == 0 then
+        return
+    end
+    redis.call("ZREM", lease_key, unpack(expired))
+    local write_token = redis.call("GET", write_key)
+    local unblocked = false -- 有没有去掉挡住读锁的写锁或者写锁等待者
+    local deleted = false -- 写锁key有没有被删，删了的话keyspace模式自己会收到del
+    for _, token in ipairs(expired) do
+        redis.call("SREM", read_key, token)
+        if redis.call("ZREM", write_waiter_key, token) == 1 then
+            unblocked = true
+        end
+        if token == write_token then
+            redis.call("DEL", write_key)
+            unblocked = true
+            deleted = true
+        end
+    end
+    if redis.call("EXISTS", write_key) == 0 then
+        if redis.call("ZCARD", write_waiter_key) == 0 then
+            if deleted then
+                redis.call("PUBLISH", event_channel, "del") -- 读锁可以进来了
+            elseif unblocked then
+                redis.call("PUBLISH", event_channel, "open") -- 只是挡路的等待者没了
+            end
+        else
+            promote_or_free(read_key, write_key, write_waiter_key, event_channel, stats_key)
+        end
+    end
+end
+
+-- 写锁等待者走了以后调用，写锁还在的话什么都不用做
+-- 没人排队了就发布"open"，读锁可以进来了；否则和reap一样轮给队首或者叫MultiLock重试
+local function waiter_left(read_key, write_key, write_waiter_key, event_channel, stats_key)
+    if redis.call("EXISTS", write_key) == 1 then
+        return
+    end
+    if redis.call("ZCARD", write_waiter_key) == 0 then
+        redis.call("PUBLISH", event_channel, "open")
+    else
+        promote_or_free(read_key, write_key, write_waiter_key, event_channel, stats_key)
+    end
+end
+
+-- BLMOVE挪进PENDING还没被semgrab.lua记进GRABBED的token，当作now的时候被拿走
+-- 拿它的进程在两步之间挂了或者被取消的话，过stale_timeout以后跟别的超时token一起被回收
+local function claim_pending(pending_key, grabbed_key, now)
+    local pending = redis.call("LRANGE", pending_key, 0, 99)
+    if #pending == 0 then
+        return
+    end
+    for i = 1, #pending do
+        redis.call("ZADD", grabbed_key, "NX", now, pending[i])
+    end
+    redis.call("LTRIM", pending_key, #pending, -1)
+end
+
+-- 信号量的非阻塞获取，见semacquire.lua, semacquire_counter.lua, semacquire_striped.lua
+-- count不为空就原子地一次拿count个，返回token列表，不够就一个都不拿，拿不到返回false
+-- stale_timeout不为空就先回收获取时间早于now-stale_timeout的token，一次最多回收100个
+local function sem_acquire_list(exists_key, available_key, grabbed_key, pending_key, stats_key, value, count, stale_timeout, event_channel)
+    if redis.call("SET", exists_key, "ok", "NX") then
+        -- 第一次使用，初始化全部token，unpack有参数个数限制，分批rpush
+        redis.call("DEL", grabbed_key, available_key, pending_key)
+        local batch = {}
+        for i = 0, value - 1 do
+            batch[#batch + 1] = i
+            if #batch == 1000 then
+                redis.call("RPUSH", available_key, unpack(batch))
+                batch = {}
+            end
+        end
+        if #batch > 0 then
+            redis.call("RPUSH", available_key, unpack(batch))
+        end
+    end
+
+    local time = redis.call("TIME")
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+    if stale_timeout ~= nil then
+        claim_pending(pending_key, grabbed_key, now)
+        -- GRABBED按获取时间排序，只看过期的那一段 O(log n + 过期个数)
+        local stale = redis.call("ZRANGEBYSCORE", grabbed_key, "-inf", "(" .. (now - stale_timeout), "LIMIT", 0, 100)
+        if #stale > 0 then
+            redis.call("ZREM", grabbed_key, unpack(stale))
+            redis.call("LPUSH", available_key, unpack(stale))
+            redis.call("PUBLISH", event_channel, "release")
+        end
+    end
+
+    if count == nil then
+        local token = redis.call("LPOP", available_key)
+        if not token then
+            record_contended(stats_key, "s")
+            return false -- 没有可用的token
+        end
+        redis.call("ZADD", grabbed_key, now, token)
+        return token
+    end
+
+    if redis.call("LLEN", available_key) < count then
+        record_contended(stats_key, "s")
+        return false -- 不够，一个都不拿
+    end
+    local tokens = redis.call("LPOP", available_key, count)
+    local batch = {}
+    for i = 1, #tokens do
+        batch[#batch + 1] = now
+        batch[#batch + 1] = tokens[i]
+        if #batch == 1000 then
+            redis.call("ZADD", grabbed_key, unpack(batch))
+            batch = {}
+        end
+    end
+    if #batch > 0 then
+        redis.call("ZADD", grabbed_key, unpack(batch))
+    end
+    return tokens
+end
+
+-- 计数模式，不需要初始化，GRABBED的长度就是已经被获取的个数，参数和返回值同上
+local function sem_acquire_counter(grabbed_key, seq_key, stats_key, value, count, stale_timeout, event_channel)
+    local time = redis.call("TIME")
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+    if stale_timeout ~= nil then
+        local stale = redis.call("ZRANGEBYSCORE", grabbed_key, "-inf", "(" .. (now - stale_timeout), "LIMIT", 0, 100)
+        if #stale > 0 then
+            redis.call("ZREM", grabbed_key, unpack(stale))
+            redis.call("PUBLISH", event_channel, "release")
+        end
+    end
+
+    local need = count or 1
+    if redis.call("ZCARD", grabbed_key) + need > value then
+        record_contended(stats_key, "s")
+        return false -- 不够
+    end
+
+    -- token是递增的序号，不会和还没释放的重复
+    local last = redis.call("INCRBY", seq_key, need)
+
+    if count == nil then
+        local token = tostring(last)
+        redis.call("ZADD", grabbed_key, now, token)
+        return token
+    end
+
+    local tokens = {}
+    local batch = {}
+    for i = 1, count do
+        tokens[i] = tostring(last - count + i)
+        batch[#batch + 1] = now
+        batch[#batch + 1] = tokens[i]
+        if #batch == 1000 then
+            redis.call("ZADD", grabbed_key, unpack(batch))
+            batch = {}
+        end
+    end
+    if #batch > 0 then
+        redis.call("ZADD", grabbed_key, unpack(batch))
+    end
+    return tokens
+end
+
+-- 公平信号量，见semfair.lua, semfair_release.lua, semfair_cancel.lua
+-- keys: grabbed_key available_key seq_key exists_key queue_key tickets_key grants_key [stats_key]
+-- argv开头是: value layout event_channel
+-- QUEUE list里是排队的票，票是"<客户端生成的id>/<要几个token>"
+-- TICKETS zset[票, 过期时间ms]，等待者定期续期，进程挂了的话票会过期被清掉
+-- GRANTS hash[票, 逗号连起来的token]，已经交给这张票的token，等待者超时或者取消的时候从这里认领
+local function fair_semaphore(keys, argv)
+    return {
+        grabbed_key = keys[1],
+        available_key = keys[2],
+        seq_key = keys[3],
+        exists_key = keys[4],
+        queue_key = keys[5],
+        tickets_key = keys[6],
+        grants_key = keys[7],
+        stats_key = keys[8],
+        value = tonumber(argv[1]),
+        counter = argv[2] == "counter",
+        event_channel = argv[3],
+    }
+end
+
+-- 还能拿几个token
+local function fair_free(sem)
+    if sem.counter then
+        return sem.value - redis.call("ZCARD", sem.grabbed_key)
+    end
+    return redis.call("LLEN", sem.available_key)
+end
+
+-- 拿n个token，调用前要确认fair_free够
+local function fair_take(sem, n, now)
+    local tokens = {}
+    if sem.counter then
+        local last = redis.call("INCRBY", sem.seq_key, n)
+        for i = 1, n do
+            tokens[i] = tostring(last - n + i)
+        end
+    else
+        for i = 1, n do
+            tokens[i] = redis.call("LPOP", sem.available_key)
+        end
+    end
+    for i = 1, n do
+        redis.call("ZADD", sem.grabbed_key, now, tokens[i])
+    end
+    return tokens
+end
+
+-- token放回去，没有被获取的不算，返回真正放回去的个数
+local function fair_put(sem, tokens)
+    local released = 0
+    for _, token in ipairs(tokens) do
+        if redis.call("ZREM", sem.grabbed_key, token) == 1 then
+            if not sem.counter then
+                redis.call("LPUSH", sem.available_key, token)
+            end
+            released = released + 1
+        end
+    end
+    return released
+end
+
+-- 清掉过期的票，还在排队的出队，已经发了token没来认领的只删记录，token当作被拿走了，靠stale_client_timeout回收
+local function fair_expire(sem, now_ms)
+    local expired = redis.call("ZRANGEBYSCORE", sem.tickets_key, "-inf", now_ms, "LIMIT", 0, 100)
+    if #expired == 0 then
+        return
+    end
+    redis.call("ZREM", sem.tickets_key, unpack(expired))
+    for _, ticket in ipairs(expired) do
+        -- 发过token的票已经不在QUEUE里了，不用O(n)的LREM
+        if redis.call("HDEL", sem.grants_key, ticket) == 0 then
+            redis.call("LREM", sem.queue_key, 1, ticket)
+        end
+    end
+end
+
+-- 按先来后到把空出来的token直接交给队首的票，队首要的多就先等着，后面要的少的也不能插队
+local function fair_grant(sem, now)
+    while true do
+        local ticket = redis.call("LINDEX", sem.queue_key, 0)
+        if not ticket then
+            return
+        end
+        local need = tonumber(string.match(ticket, "/(%d+)$"))
+        if fair_free(sem) < need then
+            return
+        end
+        redis.call("LPOP", sem.queue_key)
+        local granted = table.concat(fair_take(sem, need, now), ",")
+        redis.call("HSET", sem.grants_key, ticket, granted)
+        redis.call("PUBLISH", sem.event_channel, "grant:" .. ticket .. ":" .. granted)
+    end
+end
@@ -0,0 +1,142 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+import weakref
+from typing import Dict, Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from redislocks.utils import ensure_bytes
+
+
+class EventDispatcher:
+    """
+    一个Redis client共享一个pubsub连接和一个监听task
+    锁按channel注册自己，收到消息以后通过dict找到对应的锁，调用它的_handle_event(channel, data)
+    channel统一用bytes表示
+
+    连接断了redis-py读的时候会重连并且重新订阅之前的channel，重连失败的话监听task不退出，隔retry_interval秒再试
+    断线期间发布的事件丢了，所以重新订阅确认以后给channel上的handler发一条b"reconnect"，让等待者自己重新检查
+    """
+
+    retry_interval = 0.5  # 重连失败以后隔这么久再试
+
+    def __init__(self, client: Redis):
+        # 只持有pubsub，不持有client，不然WeakKeyDictionary里的client永远不会被回收
+        self._pubsub = client.pubsub()
+        self._handlers = {}  # type: Dict[bytes, weakref.WeakSet]
+        self._confirmed = {}  # type: Dict[bytes, asyncio.Future]
+        self._listen_task = None  # type: Optional[asyncio.Task]
+        # 串行化(un)subscribe，并发connect会让pubsub拿到两个连接
+        self._lock = None  # type: Optional[asyncio.Lock]
+
+    async def subscribe(self, channel: bytes, handler) -> None:
+        """
+        注册handler，等到redis确认订阅以后才返回，这样之后发生的事件都不会漏掉
+        已经订阅过的channel只是一次dict查找
+        """
+        handlers = self._handlers.get(channel)
+        if handlers is None:
+            handlers = self._handlers[channel] = weakref.WeakSet()
+        handlers.add(handler)
+        confirmed = self._confirmed.get(channel)
+        if confirmed is None:
+            confirmed = self._confirmed[
+                channel
+            ] = asyncio.get_running_loop().create_future()
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            try:
+                async with self._lock:
+                    await self._pubsub.subscribe(channel)
+            except Exception as e:
+                # 没订阅上，下次subscribe再试，同时在等的也一起失败
+                if self._confirmed.get(channel) is confirmed:
+                    del self._confirmed[channel]
+                if not confirmed.done():
+                    confirmed.set_exception(e)
+                    confirmed.exception()  # 没有别人在等的话也不要报never retrieved
+                raise
+            # 订阅之后再启动，否则listen()看到没有订阅会直接退出
+            if self._listen_task is None or self._listen_task.done():
+                self._listen_task = asyncio.create_task(self._listen())
+        if not confirmed.done():
+            await asyncio.shield(confirmed)
+
+    def unsubscribe(self, channel: bytes, handler) -> None:
+        """可以在__del__里调用，channel上没有handler了就退订"""
+        handlers = self._handlers.get(channel)
+        if handlers is not None:
+            handlers.discard(handler)
+            if not handlers:
+                self._drop(channel)
+
+    def _drop(self, channel: bytes) -> None:
+        self._handlers.pop(channel, None)
+        confirmed = self._confirmed.pop(channel, None)
+        if confirmed is not None and not confirmed.done():
+            confirmed.cancel()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # 事件循环已经没了，连接也跟着没了
+            return
+        loop.create_task(self._unsubscribe(channel))
+
+    async def _unsubscribe(self, channel: bytes) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if channel not in self._handlers:  # 期间没有人重新订阅
+                try:
+                    await self._pubsub.unsubscribe(channel)
+                except (RedisError, OSError):  # 连接断了，重连以后多收到的消息没有handler，直接忽略
+                    pass
+
+    async def _listen(self):
+        while True:
+            try:
+                async for event in self._pubsub.listen():
+                    event_type = event["type"]
+                    channel = ensure_bytes(event["channel"])
+                    if event_type in (b"message", "message"):
+                        self._dispatch(channel, ensure_bytes(event["data"]))
+                    elif event_type in (b"subscribe", "subscribe"):
+                        confirmed = self._confirmed.get(channel)
+                        if confirmed is None:
+                            continue
+                        if not confirmed.done():
+                            confirmed.set_result(None)
+                        else:  # 确认过的channel又确认了一次，是重连以后重新订阅的
+                            self._dispatch(channel, b"reconnect")
+                return  # 全部退订了，下次subscribe再启动
+            except (RedisError, OSError):
+                # 重连失败，比如redis还没起来，过一会儿再读，redis-py会接着重连
+                await asyncio.sleep(self.retry_interval)
+
+    def _dispatch(self, channel: bytes, data: bytes) -> None:
+        # 单独一个函数，免得_listen的栈帧一直引用着最后一个锁
+        handlers = self._handlers.get(channel)
+        if not handlers:  # 锁都被回收了
+            if handlers is not None:
+                self._drop(channel)
+            return
+        for handler in list(handlers):
+            handler._handle_event(channel, data)
+
+
+_dispatchers = (
+    weakref.WeakKeyDictionary()
+)  # type: weakref.WeakKeyDictionary[Redis, EventDispatcher]
+
+
+def get_dispatcher(client: Redis) -> EventDispatcher:
+    """每个client只有一个dispatcher，自带事件分发的后端(比如MemoryBackend)用它自己的"""
+    own = getattr(client, "event_dispatcher", None)
+    if own is not None:
+        return own
+    dispatcher = _dispatchers.get(client)
+    if dispatcher is None:
+        dispatcher = _dispatchers[client] = EventDispatcher(client)
+    return dispatcher
@@ -0,0 +1,32 @@
+-- 写锁原子地降级成读锁
+-- numkey: 4
+-- keys: read_key write_key write_waiter_key lease_key
+-- argv: event_channel write_token [lease_ms]
+-- 返回新的读锁token，写锁不是这个token的返回0
+local write_token = ARGV[2]
+local lease_ms = tonumber(ARGV[3])
+local read_key = KEYS[1]
+local write_key = KEYS[2]
+local write_waiter_key = KEYS[3]
+local lease_key = KEYS[4]
+local event_channel = ARGV[1]
+
+if redis.call("GET", write_key) ~= write_token then
+    return 0
+end
+
+local time = redis.call("TIME")
+local timestring = time[1] ..".".. time[2] -- string
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+redis.call("DEL", write_key)
+redis.call("ZREM", lease_key, write_token)
+redis.call("SADD", read_key, timestring)
+if lease_ms then
+    redis.call("ZADD", lease_key, now_ms + lease_ms, timestring)
+end
+if redis.call("ZCARD", write_waiter_key) == 0 then
+    redis.call("PUBLISH", event_channel, "del") -- 等着的读者可以一起进来了，有写者在排队就还是写锁优先
+else
+    redis.call("PUBLISH", event_channel, "free") -- 排在最前面的MultiLock在这个namespace只要读锁的话可以拿了
+end
+return timestring
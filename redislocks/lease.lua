@@ -0,0 +1,22 @@
+-- 续租，顺便回收别人过期的租约
+-- numkey: 4
+-- keys: read_key write_key write_waiter_key lease_key [stats_key]
+-- argv: event_channel lease_ms token...
+-- 返回续上的token个数，已经被回收的token续不上
+local lease_ms = tonumber(ARGV[2])
+local read_key = KEYS[1]
+local write_key = KEYS[2]
+local write_waiter_key = KEYS[3]
+local lease_key = KEYS[4]
+local stats_key = KEYS[5]
+local event_channel = ARGV[1]
+
+local time = redis.call("TIME")
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+reap(read_key, write_key, write_waiter_key, lease_key, event_channel, now_ms, stats_key)
+
+local renewed = 0
+for i = 3, #ARGV do
+    renewed = renewed + redis.call("ZADD", lease_key, "XX", "CH", now_ms + lease_ms, ARGV[i])
+end
+return renewed
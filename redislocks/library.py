@@ -0,0 +1,149 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+import weakref
+from typing import Awaitable, Callable, Dict, Optional, Sequence
+
+from redis.asyncio import Redis, RedisCluster
+from redis.exceptions import NoScriptError, ResponseError
+
+from redislocks.scripts import (
+    READONLY_SCRIPTS,
+    function_prefix,
+    library_code,
+    script_shas,
+    scripts,
+)
+
+
+class LibraryScript:
+    """
+    库里的一个脚本，调用方式和register_script返回的AsyncScript一样
+    一个client的每个脚本只有一个实例，锁直接拿来用
+    """
+
+    def __init__(self, library: "ScriptLibrary", name: str):
+        self.library = library
+        self.name = name
+        self.sha = script_shas[name]
+        self.function_name = function_prefix + name
+        self.readonly = name in READONLY_SCRIPTS
+
+    async def __call__(
+        self, keys: Sequence = (), args: Sequence = (), client=None
+    ):  # client可以是pipeline
+        library = self.library
+        if library.use_functions is None:
+            await library.load()
+        if client is None:
+            client = library.client
+        try:
+            return await self._send(client, keys, args)
+        except ResponseError as e:
+            # redis被清空或者换了主，重新加载一次，平时不会走到这里
+            if not library.is_missing(e):
+                raise
+            await library.load(force=True)
+            return await self._send(client, keys, args)
+
+    def _send(self, client, keys: Sequence, args: Sequence):
+        if self.library.use_functions:
+            command = "FCALL_RO" if self.readonly else "FCALL"
+            return client.execute_command(
+                command, self.function_name, len(keys), *keys, *args
+            )
+        return client.execute_command("EVALSHA", self.sha, len(keys), *keys, *args)
+
+
+class ScriptLibrary:
+    """
+    一个Redis client只加载一次所有的脚本，第一次调用的时候加载
+    redis 7以上FUNCTION LOAD成一个库，按名字FCALL；老的redis没有FUNCTION，SCRIPT LOAD以后EVALSHA
+    调用的时候直接发FCALL/EVALSHA，只有redis丢了脚本(FLUSHALL, SCRIPT FLUSH, 故障切换)才重新加载
+    """
+
+    def __init__(self, client: Redis):
+        # 只持有client的弱引用，不然WeakKeyDictionary里的client永远不会被回收
+        self._client = weakref.ref(client)
+        self.use_functions = None  # type: Optional[bool]  # None表示还没加载
+        self._lock = None  # type: Optional[asyncio.Lock]
+        self._scripts = {
+            name: LibraryScript(self, name) for name in scripts
+        }  # type: Dict[str, LibraryScript]
+
+    def __getitem__(self, name: str) -> LibraryScript:
+        return self._scripts[name]
+
+    @property
+    def client(self) -> Redis:
+        return self._client()
+
+    @staticmethod
+    def is_missing(e: ResponseError) -> bool:
+        # pipeline里的错误前面会被加上"Command # n (...) of pipeline caused error: "
+        return isinstance(e, NoScriptError) or "Function not found" in str(e)
+
+    async def run_pipeline(self, fill: Callable[[object], Awaitable[None]]) -> list:
+        """
+        fill往一个pipeline里排脚本调用，然后一起发出去
+        pipeline里的EVALSHA/FCALL丢了脚本只会在execute的时候报错，这里重新加载以后整个pipeline重发一次，
+        所以排进去的脚本要能重复执行
+        """
+        try:
+            return await self._execute(fill)
+        except ResponseError as e:
+            if not self.is_missing(e):
+                raise
+        await self.load(force=True)
+        return await self._execute(fill)
+
+    async def _execute(self, fill: Callable[[object], Awaitable[None]]) -> list:
+        async with self.client.pipeline(transaction=False) as pipe:
+            await fill(pipe)
+            return await pipe.execute()
+
+    async def load(self, force: bool = False) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.use_functions is not None and not force:  # 别的调用已经加载好了
+                return
+            client = self.client
+            try:
+                await client.function_load(library_code)
+                self.use_functions = True
+                return
+            except ResponseError as e:
+                message = str(e).lower()
+                if "already exists" in message:
+                    self.use_functions = True
+                    return
+                if "unknown command" not in message:
+                    raise
+            # redis 7以前没有FUNCTION
+            if isinstance(client, RedisCluster):  # 会发给所有主节点，集群的pipeline不能SCRIPT LOAD
+                for source in scripts.values():
+                    await client.script_load(source)
+            else:
+                async with client.pipeline(transaction=False) as pipe:
+                    for source in scripts.values():
+                        pipe.script_load(source)
+                    await pipe.execute()
+            self.use_functions = False
+
+
+_libraries = (
+    weakref.WeakKeyDictionary()
+)  # type: weakref.WeakKeyDictionary[Redis, ScriptLibrary]
+
+
+def get_library(client: Redis) -> ScriptLibrary:
+    """每个client只有一个ScriptLibrary，自带脚本的后端(比如MemoryBackend)用它自己的"""
+    own = getattr(client, "script_library", None)
+    if own is not None:
+        return own
+    library = _libraries.get(client)
+    if library is None:
+        library = _libraries[client] = ScriptLibrary(client)
+    return library
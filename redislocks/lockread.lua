@@ -1,35 +1,62 @@
 -- 加读锁
--- numkey: 1
--- namespace
-local namespace = KEYS[1]
---local blocking = ARGV[1] -- string
-local read_key = namespace .. ":READ"
-local write_key = namespace .. ":WRITE"
-local write_waiter_key = namespace .. ":WRITEWAITER"
+-- numkey: 4
+-- keys: read_key write_key write_waiter_key lease_key [stats_key]
+-- argv: event_channel [count] [lease_ms] [retry] 给了count就一次加count个读锁，返回token列表，用来批量唤醒本地等待的读者
+--                     给了lease_ms就给新token加上租约，过期了会被回收
+--                     retry不为空表示被叫醒以后的重试，第一次失败已经记过contended了，不再记
+local count = tonumber(ARGV[2])
+local lease_ms = tonumber(ARGV[3])
+local retry = ARGV[4] ~= nil and ARGV[4] ~= ""
+local read_key = KEYS[1]
+local write_key = KEYS[2]
+local write_waiter_key = KEYS[3]
+local lease_key = KEYS[4]
+local stats_key = KEYS[5]
+local event_channel = ARGV[1]
 
-local function get_state()
-    local read_lock_exists = redis.call("SCARD", read_key) > 0
-    local write_lock_exists = redis.call("EXISTS", write_key) == 1
-    local write_waiter_exists = redis.call("LLEN", write_waiter_key) > 0
-    if not read_lock_exists and not write_lock_exists then -- 没有读锁也没有写锁，是空的
-        return 0
-    elseif read_lock_exists and not write_lock_exists and not write_waiter_exists then -- 存在读锁，不存在写锁和写锁等待，读ing
-        return 1
-    elseif not read_lock_exists and write_lock_exists then -- 不存在读锁，存在写锁，写ing
-        return 2
-    elseif read_lock_exists and not write_lock_exists and  write_waiter_exists then -- 存在读锁，不存在写锁，不过有等待等待队列有东西
-        return 3
-    end
-end
+local time = redis.call("TIME")
+local timestring = time[1] ..".".. time[2] -- string
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+reap(read_key, write_key, write_waiter_key, lease_key, event_channel, now_ms, stats_key)
 
-local current_state = get_state()
+local current_state = get_state(read_key, write_key, write_waiter_key)
 
 if current_state == 2 or current_state == 3 then
     -- 写入状态 or 写锁正在等待等待
+    if not retry then
+        record_contended(stats_key, "r")
+    end
     return 0 -- 直接加锁失败，此时，如果是阻塞模式，开始监听keyspace
 else
-    local time = redis.call("TIME")
-    local timestring = time[1] ..".".. time[2] -- string
-    redis.call("SADD", read_key, timestring)
-    return timestring -- 成功就返回时间戳
+    if count == nil then
+        redis.call("SADD", read_key, timestring)
+        if lease_ms then
+            redis.call("ZADD", lease_key, now_ms + lease_ms, timestring)
+        end
+        return timestring -- 成功就返回时间戳
+    end
+    local tokens = {}
+    local batch = {}
+    local leases = {}
+    for i = 1, count do
+        tokens[i] = timestring .. "-" .. i -- 同一时刻的token要区分开
+        batch[#batch + 1] = tokens[i]
+        leases[#leases + 1] = now_ms + (lease_ms or 0)
+        leases[#leases + 1] = tokens[i]
+        if #batch == 1000 then -- unpack有参数个数限制，分批sadd
+            redis.call("SADD", read_key, unpack(batch))
+            if lease_ms then
+                redis.call("ZADD", lease_key, unpack(leases))
+            end
+            batch = {}
+            leases = {}
+        end
+    end
+    if #batch > 0 then
+        redis.call("SADD", read_key, unpack(batch))
+        if lease_ms then
+            redis.call("ZADD", lease_key, unpack(leases))
+        end
+    end
+    return tokens
 end
@@ -0,0 +1,40 @@
+-- 加写锁 能立刻获取就设置写锁，不能就原子地排进写锁等待队列
+-- numkey: 4
+-- keys: read_key write_key write_waiter_key lease_key [stats_key]
+-- argv: event_channel [lease_ms] [priority] [step_us] 给了lease_ms就给token加上租约，排队的时候也算
+-- priority越大越先轮到，默认0，step_us是aging，等这么多微秒抵得上一级优先级，不给的话严格按优先级
+-- 返回 {token, 1, 0} 拿到了写锁
+--      {token, 0, ahead} 排进了WRITEWAITER，前面还有ahead个写者
+local lease_ms = tonumber(ARGV[2])
+local read_key = KEYS[1]
+local write_key = KEYS[2]
+local write_waiter_key = KEYS[3]
+local lease_key = KEYS[4]
+local stats_key = KEYS[5]
+local event_channel = ARGV[1]
+local priority = tonumber(ARGV[3]) or 0
+local step_us = tonumber(ARGV[4]) or WRITER_STRICT_STEP_US
+
+local time = redis.call("TIME")
+local timestring = time[1] ..".".. time[2] -- string
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+reap(read_key, write_key, write_waiter_key, lease_key, event_channel, now_ms, stats_key)
+
+local current_state = get_state(read_key, write_key, write_waiter_key)
+if lease_ms then
+    redis.call("ZADD", lease_key, now_ms + lease_ms, timestring)
+end
+if current_state ~= 0 then
+    redis.call("ZADD", write_waiter_key, writer_score(time, priority, step_us), timestring)
+    local ahead = redis.call("ZRANK", write_waiter_key, timestring)
+    if current_state ~= 3 or redis.call("SCARD", read_key) > 0 or ahead > 0 then
+        redis.call("PUBLISH", event_channel, "wait") -- 告诉合并读锁的进程别再让新读者搭车了
+        record_contended(stats_key, "w")
+        return {timestring, 0, ahead} -- 进入等待队列，等unlockread/unlockwrite轮到它
+    end
+    -- 空着的namespace里只有在等别的namespace的MultiLock，优先级比它们高的话直接拿
+    redis.call("ZREM", write_waiter_key, timestring)
+end
+-- 不存在写锁 也不存在 读锁 可以直接设置写锁
+redis.call("SET", write_key, timestring)
+return {timestring, 1, 0} -- 获取写锁成功
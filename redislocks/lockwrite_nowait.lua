@@ -1,34 +1,30 @@
 -- 加写锁 直接设置不检查
--- numkey: 1
--- namespace
-local namespace = KEYS[1]
-local read_key = namespace .. ":READ"
-local write_key = namespace .. ":WRITE"
-local write_waiter_key = namespace .. ":WRITEWAITER"
+-- numkey: 4
+-- keys: read_key write_key write_waiter_key lease_key [stats_key]
+-- argv: event_channel [lease_ms] 给了就给token加上租约
+local lease_ms = tonumber(ARGV[2])
+local read_key = KEYS[1]
+local write_key = KEYS[2]
+local write_waiter_key = KEYS[3]
+local lease_key = KEYS[4]
+local stats_key = KEYS[5]
+local event_channel = ARGV[1]
 
-local function get_state()
-    local read_lock_exists = redis.call("SCARD", read_key) > 0
-    local write_lock_exists = redis.call("EXISTS", write_key) == 1
-    local write_waiter_exists = redis.call("LLEN", write_waiter_key) > 0
-    if not read_lock_exists and not write_lock_exists then -- 没有读锁也没有写锁，是空的
-        return 0
-    elseif read_lock_exists and not write_lock_exists and not write_waiter_exists then -- 存在读锁，不存在写锁和写锁等待，读ing
-        return 1
-    elseif not read_lock_exists and write_lock_exists then -- 不存在读锁，存在写锁，写ing
-        return 2
-    elseif read_lock_exists and not write_lock_exists and  write_waiter_exists then -- 存在读锁，不存在写锁，不过有等待等待队列有东西
-        return 3
-    end
-end
+local time = redis.call("TIME")
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+reap(read_key, write_key, write_waiter_key, lease_key, event_channel, now_ms, stats_key)
 
-local current_state = get_state()
+local current_state = get_state(read_key, write_key, write_waiter_key)
 
 if current_state == 0 then
     -- 不存在写锁 也不存在 读锁 可以直接设置写锁
-    local time = redis.call("TIME")
     local timestring = time[1] ..".".. time[2] -- string
     redis.call("SET", write_key, timestring)
+    if lease_ms then
+        redis.call("ZADD", lease_key, now_ms + lease_ms, timestring)
+    end
     return timestring -- 获取写锁成功，返回时间戳
 else
+    record_contended(stats_key, "w")
     return 0
 end
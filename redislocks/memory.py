@@ -0,0 +1,1331 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+import bisect
+import fnmatch
+import math
+import time
+import weakref
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from redislocks.utils import ensure_bytes
+
+
+class MemoryDispatcher:
+    """
+    和EventDispatcher一样的接口，PUBLISH不经过网络，直接交给本进程里订阅了的锁
+    消息在下一轮事件循环里送到，和Redis一样，锁总是在脚本返回以后才收到
+    """
+
+    def __init__(self):
+        self._handlers = {}  # type: Dict[bytes, weakref.WeakSet]
+
+    async def subscribe(self, channel: bytes, handler) -> None:
+        handlers = self._handlers.get(channel)
+        if handlers is None:
+            handlers = self._handlers[channel] = weakref.WeakSet()
+        handlers.add(handler)
+
+    def unsubscribe(self, channel: bytes, handler) -> None:
+        handlers = self._handlers.get(channel)
+        if handlers is not None:
+            handlers.discard(handler)
+            if not handlers:
+                del self._handlers[channel]
+
+    def publish(self, channel: bytes, data: bytes) -> int:
+        handlers = self._handlers.get(channel)
+        if not handlers:
+            return 0
+        try:
+            asyncio.get_running_loop().call_soon(self._dispatch, channel, data)
+        except RuntimeError:  # 没有事件循环，直接送
+            self._dispatch(channel, data)
+        return len(handlers)
+
+    def _dispatch(self, channel: bytes, data: bytes) -> None:
+        for handler in list(self._handlers.get(channel, ())):
+            handler._handle_event(channel, data)
+
+
+class _SortedSet:
+    """
+    zset，member -> score的dict加上按(score, member)排好的list，和Redis一样分数一样按member排
+    查分数O(1)，增删是bisect加list的插入删除，按顺序取不用每次重新排序
+    """
+
+    def __init__(self):
+        self._scores = {}  # type: Dict[bytes, float]
+        self._items = []  # type: List[Tuple[float, bytes]]
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def get(self, member: bytes) -> Optional[float]:
+        return self._scores.get(member)
+
+    def add(self, member: bytes, score: float) -> bool:
+        """返回是不是新加的"""
+        old = self._scores.get(member)
+        if old is not None:
+            if old == score:
+                return False
+            del self._items[bisect.bisect_left(self._items, (old, member))]
+        self._scores[member] = score
+        bisect.insort(self._items, (score, member))
+        return old is None
+
+    def remove(self, member: bytes) -> bool:
+        score = self._scores.pop(member, None)
+        if score is None:
+            return False
+        del self._items[bisect.bisect_left(self._items, (score, member))]
+        return True
+
+    def first(self) -> Optional[bytes]:
+        return self._items[0][1] if self._items else None
+
+    def rank(self, member: bytes) -> Optional[int]:
+        score = self._scores.get(member)
+        if score is None:
+            return None
+        return bisect.bisect_left(self._items, (score, member))
+
+    def range_by_score(
+        self, max_score: float, exclusive: bool = False, limit: int = -1
+    ) -> List[bytes]:
+        """分数不超过max_score的member，exclusive时不含等于的"""
+        end = bisect.bisect_left(self._items, (max_score,))  # 第一个分数>=max_score的
+        if not exclusive:
+            while end < len(self._items) and self._items[end][0] == max_score:
+                end += 1
+        if 0 <= limit < end:
+            end = limit
+        return [member for _, member in self._items[:end]]
+
+
+class MemoryKeyspace:
+    """
+    lua脚本用到的那部分Redis命令，key和值都是bytes
+    string是bytes，set是set，list是deque，zset是_SortedSet，空了的容器和Redis一样直接删掉
+    """
+
+    def __init__(self, dispatcher: MemoryDispatcher):
+        self._data = {}  # type: Dict[bytes, Any]
+        self._dispatcher = dispatcher
+        self._last_time = 0  # 微秒
+        self._pushed = None  # type: Optional[asyncio.Future] 有list被push的时候完成，叫醒BLPOP
+
+    def _container(self, key, factory):
+        key = ensure_bytes(key)
+        value = self._data.get(key)
+        if value is None:
+            value = self._data[key] = factory()
+        return value
+
+    def _lookup(self, key, default):
+        return self._data.get(ensure_bytes(key), default)
+
+    def _drop_empty(self, key) -> None:
+        key = ensure_bytes(key)
+        if not self._data.get(key, True):
+            del self._data[key]
+
+    def time(self) -> Tuple[int, int]:
+        """(秒, 微秒)，同一个后端上严格递增，拿时间戳当token的脚本不会撞车"""
+        now = max(time.time_ns() // 1000, self._last_time + 1)
+        self._last_time = now
+        return divmod(now, 1000000)
+
+    def publish(self, channel, data) -> int:
+        return self._dispatcher.publish(ensure_bytes(channel), ensure_bytes(data))
+
+    def get(self, key) -> Optional[bytes]:
+        return self._lookup(key, None)
+
+    def set(self, key, value, nx: bool = False) -> Optional[bool]:
+        key = ensure_bytes(key)
+        if nx and key in self._data:
+            return None
+        self._data[key] = ensure_bytes(value)
+        return True
+
+    def delete(self, *keys) -> int:
+        return sum(self._data.pop(ensure_bytes(key), None) is not None for key in keys)
+
+    def exists(self, *keys) -> int:
+        return sum(ensure_bytes(key) in self._data for key in keys)
+
+    def incrby(self, key, amount: int) -> int:
+        value = int(self._lookup(key, 0)) + amount
+        self.set(key, value)
+        return value
+
+    def hincrby(self, key, field, amount: int) -> int:
+        container = self._container(key, dict)
+        field = ensure_bytes(field)
+        value = int(container.get(field, 0)) + amount
+        container[field] = b"%d" % value
+        return value
+
+    def hset(self, key, field, value) -> int:
+        container = self._container(key, dict)
+        field = ensure_bytes(field)
+        added = int(field not in container)
+        container[field] = ensure_bytes(value)
+        return added
+
+    def hget(self, key, field) -> Optional[bytes]:
+        return self._lookup(key, {}).get(ensure_bytes(field))
+
+    def hdel(self, key, *fields) -> int:
+        container = self._lookup(key, None)
+        if not container:
+            return 0
+        deleted = sum(
+            container.pop(ensure_bytes(field), None) is not None for field in fields
+        )
+        self._drop_empty(key)
+        return deleted
+
+    def hgetall(self, key) -> Dict[bytes, bytes]:
+        return dict(self._lookup(key, {}))
+
+    def sadd(self, key, *members) -> int:
+        container = self._container(key, set)
+        size = len(container)
+        container.update(map(ensure_bytes, members))
+        return len(container) - size
+
+    def srem(self, key, *members) -> int:
+        container = self._lookup(key, None)
+        if not container:
+            return 0
+        size = len(container)
+        container.difference_update(map(ensure_bytes, members))
+        self._drop_empty(key)
+        return size - len(container)
+
+    def sismember(self, key, member) -> int:
+        return int(ensure_bytes(member) in self._lookup(key, ()))
+
+    def scard(self, key) -> int:
+        return len(self._lookup(key, ()))
+
+    def smembers(self, key) -> set:
+        return set(self._lookup(key, ()))
+
+    def rpush(self, key, *values) -> int:
+        container = self._container(key, deque)
+        container.extend(map(ensure_bytes, values))
+        self._wake_blpop()
+        return len(container)
+
+    def lpush(self, key, *values) -> int:
+        container = self._container(key, deque)
+        container.extendleft(map(ensure_bytes, values))
+        self._wake_blpop()
+        return len(container)
+
+    def lpop(self, key, count: Optional[int] = None):
+        container = self._lookup(key, None)
+        if not container:
+            return None
+        if count is None:
+            value = container.popleft()
+        else:
+            value = [container.popleft() for _ in range(min(count, len(container)))]
+        self._drop_empty(key)
+        return value
+
+    def lrem(self, key, value) -> int:
+        """只实现了脚本用到的LREM key 1 value"""
+        container = self._lookup(key, None)
+        try:
+            container.remove(ensure_bytes(value))
+        except (AttributeError, ValueError):
+            return 0
+        self._drop_empty(key)
+        return 1
+
+    def lindex(self, key, index: int) -> Optional[bytes]:
+        container = self._lookup(key, ())
+        try:
+            return container[index]
+        except IndexError:
+            return None
+
+    def llen(self, key) -> int:
+        return len(self._lookup(key, ()))
+
+    def lrange(self, key, start: int, end: int) -> List[bytes]:
+        values = list(self._lookup(key, ()))
+        return values[start:] if end == -1 else values[start : end + 1]
+
+    def zadd(self, key, mapping: Dict[Any, float], xx: bool = False) -> int:
+        """返回新加的个数，xx=True时只更新已有的成员，返回被改了的个数(CH)"""
+        container = self._lookup(key, None) if xx else self._container(key, _SortedSet)
+        if container is None:
+            return 0
+        changed = 0
+        for member, score in mapping.items():
+            member = ensure_bytes(member)
+            if xx:
+                old = container.get(member)
+                if old is not None and old != score:
+                    container.add(member, score)
+                    changed += 1
+            else:
+                changed += container.add(member, score)
+        return changed
+
+    def zrem(self, key, *members) -> int:
+        container = self._lookup(key, None)
+        if not container:
+            return 0
+        removed = sum(container.remove(ensure_bytes(member)) for member in members)
+        self._drop_empty(key)
+        return removed
+
+    def zscore(self, key, member) -> Optional[float]:
+        container = self._lookup(key, None)
+        return None if container is None else container.get(ensure_bytes(member))
+
+    def zcard(self, key) -> int:
+        return len(self._lookup(key, ()))
+
+    def zrank(self, key, member) -> Optional[int]:
+        container = self._lookup(key, None)
+        return None if container is None else container.rank(ensure_bytes(member))
+
+    def zfirst(self, key) -> Optional[bytes]:
+        """ZRANGE key 0 0"""
+        container = self._lookup(key, None)
+        return None if container is None else container.first()
+
+    def zpopmin(self, key) -> Optional[bytes]:
+        """只实现了脚本用到的ZPOPMIN key，只返回member"""
+        member = self.zfirst(key)
+        if member is not None:
+            self.zrem(key, member)
+        return member
+
+    def zrangebyscore(
+        self, key, max_score: float, exclusive: bool = False, limit: int = -1
+    ) -> List[bytes]:
+        """ZRANGEBYSCORE key -inf max_score LIMIT 0 limit，exclusive对应"(max_score" """
+        container = self._lookup(key, None)
+        if not container:
+            return []
+        return container.range_by_score(max_score, exclusive, limit)
+
+    def flushdb(self) -> bool:
+        self._data.clear()
+        return True
+
+    def _wake_blpop(self) -> None:
+        if self._pushed is not None:
+            if not self._pushed.done():
+                self._pushed.set_result(None)
+            self._pushed = None
+
+    async def blpop(self, keys, timeout: float = 0) -> Optional[Tuple[bytes, bytes]]:
+        if isinstance(keys, (str, bytes)):
+            keys = [keys]
+        keys = [ensure_bytes(key) for key in keys]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout else None
+        while True:
+            for key in keys:
+                value = self.lpop(key)
+                if value is not None:
+                    return key, value
+            if self._pushed is None:
+                self._pushed = loop.create_future()
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(asyncio.shield(self._pushed), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+    async def blmove(self, source, destination, timeout: float = 0) -> Optional[bytes]:
+        """只实现了BLMOVE source destination LEFT RIGHT，pop和push之间不会切走"""
+        pair = await self.blpop(source, timeout)
+        if pair is None:
+            return None
+        self.rpush(destination, pair[1])
+        return pair[1]
+
+
+class MemoryPipeline:
+    """命令先攒着，execute的时候一次执行完，中间不会切到别的task，相当于MULTI"""
+
+    def __init__(self, keyspace: MemoryKeyspace):
+        self._keyspace = keyspace
+        self._commands = []  # type: List[Tuple[Callable, tuple]]
+
+    def __getattr__(self, name: str):
+        command = getattr(self._keyspace, name)
+
+        def queue(*args):
+            self._commands.append((command, args))
+            return self
+
+        return queue
+
+    async def execute(self) -> list:
+        commands, self._commands = self._commands, []
+        return [command(*args) for command, args in commands]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._commands = []
+
+
+# 脚本名 -> 对应的python实现，每个都和同名的lua脚本一一对应
+_scripts = {}  # type: Dict[str, Callable[[MemoryKeyspace, Sequence, Sequence], Any]]
+
+
+def _script(func):
+    _scripts[func.__name__] = func
+    return func
+
+
+def _arg(args: Sequence, index: int) -> Optional[bytes]:
+    """ARGV[index]，index从1开始，没有的话是None"""
+    return ensure_bytes(args[index - 1]) if index <= len(args) else None
+
+
+def _number(args: Sequence, index: int):
+    """tonumber(ARGV[index])，不是数字的话是None"""
+    value = _arg(args, index)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+
+def _timestring(db: MemoryKeyspace) -> Tuple[bytes, int]:
+    """lua脚本里的time[1] .. "." .. time[2]和now_ms"""
+    sec, usec = db.time()
+    return b"%d.%d" % (sec, usec), sec * 1000 + usec // 1000
+
+
+def _now(db: MemoryKeyspace) -> float:
+    sec, usec = db.time()
+    return sec + usec / 1000000
+
+
+def _get_state(db: MemoryKeyspace, read_key, write_key, write_waiter_key):
+    """common.lua的get_state"""
+    read_lock_exists = db.scard(read_key) > 0
+    write_lock_exists = db.exists(write_key) == 1
+    write_waiter_exists = db.zcard(write_waiter_key) > 0
+    if not read_lock_exists and not write_lock_exists:
+        return 3 if write_waiter_exists else 0
+    elif read_lock_exists and not write_lock_exists and not write_waiter_exists:
+        return 1
+    elif not read_lock_exists and write_lock_exists:
+        return 2
+    elif read_lock_exists and not write_lock_exists and write_waiter_exists:
+        return 3
+    return None
+
+
+# common.lua的WRITER_STRICT_STEP_US
+_WRITER_STRICT_STEP_US = 1 << 40
+
+
+def _writer_score(timestring: bytes, priority, step_us) -> int:
+    """common.lua的writer_score，priority和step_us是_number的结果"""
+    sec, usec = map(int, timestring.split(b"."))
+    return sec * 1000000 + usec - (priority or 0) * (step_us or _WRITER_STRICT_STEP_US)
+
+
+def _is_multi(token: bytes) -> bool:
+    """common.lua的is_multi"""
+    return token.startswith(b"multi:")
+
+
+def _pop_writer(db: MemoryKeyspace, write_waiter_key) -> Optional[bytes]:
+    """common.lua的pop_writer，排在最前面的是MultiLock的话返回None"""
+    write_token = db.zfirst(write_waiter_key)
+    if write_token is None or _is_multi(write_token):
+        return None
+    db.zrem(write_waiter_key, write_token)
+    return write_token
+
+
+def _stats_bucket(ms) -> int:
+    """common.lua的stats_bucket"""
+    bucket = 1
+    while bucket < ms:
+        bucket *= 2
+    return bucket
+
+
+def _record_contended(db: MemoryKeyspace, stats_key, mode: bytes) -> None:
+    """common.lua的record_contended"""
+    if stats_key is not None:
+        db.hincrby(stats_key, b"contended:" + mode, 1)
+
+
+def _record_promotion(db: MemoryKeyspace, stats_key) -> None:
+    """common.lua的record_promotion"""
+    if stats_key is not None:
+        db.hincrby(stats_key, b"promotions", 1)
+
+
+def _record_release(
+    db: MemoryKeyspace, stats_key, mode: bytes, count: int, wait_ms, hold_ms
+) -> None:
+    """common.lua的record_release，wait_ms和hold_ms是_number的结果"""
+    if stats_key is None or count == 0 or wait_ms is None or hold_ms is None:
+        return
+    db.hincrby(stats_key, b"acquired:" + mode, count)
+    db.hincrby(stats_key, b"wait_ms:" + mode, math.floor(wait_ms) * count)
+    db.hincrby(stats_key, b"hold_ms:" + mode, math.floor(hold_ms) * count)
+    db.hincrby(stats_key, b"wait:%s:%d" % (mode, _stats_bucket(wait_ms)), count)
+    db.hincrby(stats_key, b"hold:%s:%d" % (mode, _stats_bucket(hold_ms)), count)
+
+
+def _stats_key(keys: Sequence, index: int):
+    """可选的KEYS[index]，index从1开始"""
+    return keys[index - 1] if index <= len(keys) else None
+
+
+def _reap(
+    db: MemoryKeyspace,
+    read_key,
+    write_key,
+    write_waiter_key,
+    lease_key,
+    event_channel,
+    now_ms: int,
+    stats_key=None,
+) -> None:
+    """common.lua的reap"""
+    expired = db.zrangebyscore(lease_key, now_ms, limit=100)
+    if not expired:
+        return
+    db.zrem(lease_key, *expired)
+    write_token = db.get(write_key)
+    unblocked = False
+    deleted = False
+    for token in expired:
+        db.srem(read_key, token)
+        if db.zrem(write_waiter_key, token) == 1:
+            unblocked = True
+        if token == write_token:
+            db.delete(write_key)
+            unblocked = True
+            deleted = True
+    if not db.exists(write_key):
+        if db.zcard(write_waiter_key) == 0:
+            if deleted:
+                db.publish(event_channel, b"del")
+            elif unblocked:
+                db.publish(event_channel, b"open")
+        else:
+            _promote_or_free(
+                db, read_key, write_key, write_waiter_key, event_channel, stats_key
+            )
+
+
+def _promote_or_free(
+    db: MemoryKeyspace,
+    read_key,
+    write_key,
+    write_waiter_key,
+    event_channel,
+    stats_key=None,
+) -> None:
+    """common.lua的promote_or_free"""
+    write_token = None
+    if db.scard(read_key) == 0:
+        write_token = _pop_writer(db, write_waiter_key)
+    if write_token is not None:
+        db.set(write_key, write_token)
+        db.publish(event_channel, b"set:" + write_token)
+        _record_promotion(db, stats_key)
+    else:
+        db.publish(event_channel, b"free")
+
+
+def _waiter_left(
+    db: MemoryKeyspace,
+    read_key,
+    write_key,
+    write_waiter_key,
+    event_channel,
+    stats_key=None,
+) -> None:
+    """common.lua的waiter_left"""
+    if db.exists(write_key):
+        return
+    if db.zcard(write_waiter_key) == 0:
+        db.publish(event_channel, b"open")
+    else:
+        _promote_or_free(
+            db, read_key, write_key, write_waiter_key, event_channel, stats_key
+        )
+
+
+def _promote(
+    db: MemoryKeyspace, write_key, write_waiter_key, event_channel, stats_key=None
+) -> None:
+    """把写锁轮给WRITEWAITER最前面的写者，没有或者最前面是MultiLock就删掉写锁"""
+    write_token = _pop_writer(db, write_waiter_key)
+    if write_token is not None:
+        db.set(write_key, write_token)
+        db.publish(event_channel, b"set:" + write_token)
+        _record_promotion(db, stats_key)
+    else:
+        db.delete(write_key)
+        db.publish(event_channel, b"del")
+
+
+@_script
+def lockread(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    read_key, write_key, write_waiter_key, lease_key = keys[:4]
+    stats_key = _stats_key(keys, 5)
+    event_channel, count, lease_ms = _arg(args, 1), _number(args, 2), _number(args, 3)
+    retry = bool(_arg(args, 4))
+    timestring, now_ms = _timestring(db)
+    _reap(
+        db,
+        read_key,
+        write_key,
+        write_waiter_key,
+        lease_key,
+        event_channel,
+        now_ms,
+        stats_key,
+    )
+    if _get_state(db, read_key, write_key, write_waiter_key) in (2, 3):
+        if not retry:
+            _record_contended(db, stats_key, b"r")
+        return 0
+    if count is None:
+        tokens = [timestring]
+    else:
+        tokens = [b"%s-%d" % (timestring, i) for i in range(1, count + 1)]
+    db.sadd(read_key, *tokens)
+    if lease_ms is not None:
+        db.zadd(lease_key, dict.fromkeys(tokens, now_ms + lease_ms))
+    return timestring if count is None else tokens
+
+
+@_script
+def unlockread(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    read_key, write_key, write_waiter_key, lease_key = keys[:4]
+    stats_key = _stats_key(keys, 5)
+    event_channel, token = _arg(args, 1), _arg(args, 2)
+    ret = db.srem(read_key, token)
+    db.zrem(lease_key, token)
+    _record_release(db, stats_key, b"r", ret, _number(args, 3), _number(args, 4))
+    if ret == 1 and db.scard(read_key) == 0:
+        _promote_or_free(
+            db, read_key, write_key, write_waiter_key, event_channel, stats_key
+        )
+    return ret
+
+
+@_script
+def lockwrite_nowait(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    read_key, write_key, write_waiter_key, lease_key = keys[:4]
+    stats_key = _stats_key(keys, 5)
+    event_channel, lease_ms = _arg(args, 1), _number(args, 2)
+    timestring, now_ms = _timestring(db)
+    _reap(
+        db,
+        read_key,
+        write_key,
+        write_waiter_key,
+        lease_key,
+        event_channel,
+        now_ms,
+        stats_key,
+    )
+    if _get_state(db, read_key, write_key, write_waiter_key) != 0:
+        _record_contended(db, stats_key, b"w")
+        return 0
+    db.set(write_key, timestring)
+    if lease_ms is not None:
+        db.zadd(lease_key, {timestring: now_ms + lease_ms})
+    return timestring
+
+
+@_script
+def lockwrite(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    read_key, write_key, write_waiter_key, lease_key = keys[:4]
+    stats_key = _stats_key(keys, 5)
+    event_channel, lease_ms = _arg(args, 1), _number(args, 2)
+    timestring, now_ms = _timestring(db)
+    _reap(
+        db,
+        read_key,
+        write_key,
+        write_waiter_key,
+        lease_key,
+        event_channel,
+        now_ms,
+        stats_key,
+    )
+    current_state = _get_state(db, read_key, write_key, write_waiter_key)
+    if lease_ms is not None:
+        db.zadd(lease_key, {timestring: now_ms + lease_ms})
+    if current_state != 0:
+        score = _writer_score(timestring, _number(args, 3), _number(args, 4))
+        db.zadd(write_waiter_key, {timestring: score})
+        ahead = db.zrank(write_waiter_key, timestring)
+        if current_state != 3 or db.scard(read_key) > 0 or ahead > 0:
+            db.publish(event_channel, b"wait")
+            _record_contended(db, stats_key, b"w")
+            return [timestring, 0, ahead]
+        db.zrem(write_waiter_key, timestring)  # 只有在等别的namespace的MultiLock
+    db.set(write_key, timestring)
+    return [timestring, 1, 0]
+
+
+@_script
+def cancelwrite(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    read_key, write_key, write_waiter_key, lease_key = keys[:4]
+    event_channel, token = _arg(args, 1), _arg(args, 2)
+    db.zrem(lease_key, token)
+    if db.zrem(write_waiter_key, token) == 1:
+        _waiter_left(
+            db,
+            read_key,
+            write_key,
+            write_waiter_key,
+            event_channel,
+            _stats_key(keys, 5),
+        )
+        return 1
+    if db.get(write_key) == token:
+        _promote(db, write_key, write_waiter_key, event_channel, _stats_key(keys, 5))
+        return 2
+    return 0
+
+
+@_script
+def unlockwrite(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    read_key, write_key, write_waiter_key, lease_key = keys[:4]
+    event_channel, token = _arg(args, 1), _arg(args, 2)
+    if _get_state(db, read_key, write_key, write_waiter_key) != 2:
+        return 0
+    current_token = db.get(write_key)
+    if token is not None and current_token != token:  # lua里空字符串也是真
+        return 0
+    db.zrem(lease_key, current_token)
+    stats_key = _stats_key(keys, 5)
+    _record_release(db, stats_key, b"w", 1, _number(args, 3), _number(args, 4))
+    _promote(db, write_key, write_waiter_key, event_channel, stats_key)
+    return 1
+
+
+@_script
+def upgrade(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    read_key, write_key, write_waiter_key, lease_key, upgrader_key = keys[:5]
+    event_channel, read_token = _arg(args, 1), _arg(args, 2)
+    lease_ms, nowait = _number(args, 3), _arg(args, 4) == b"1"
+    if not db.sismember(read_key, read_token):
+        return [b"", -1]
+    pending = db.get(upgrader_key)
+    if pending is not None and db.zfirst(write_waiter_key) == pending:
+        return [b"", -2]
+    alone = db.scard(read_key) == 1
+    if not alone and nowait:
+        return [b"", -3]
+    timestring, now_ms = _timestring(db)
+    db.srem(read_key, read_token)
+    db.zrem(lease_key, read_token)
+    if lease_ms is not None:
+        db.zadd(lease_key, {timestring: now_ms + lease_ms})
+    if alone:
+        db.set(write_key, timestring)
+        return [timestring, 1]
+    db.zadd(write_waiter_key, {timestring: float("-inf")})
+    db.set(upgrader_key, timestring)
+    db.publish(event_channel, b"wait")
+    _record_contended(db, _stats_key(keys, 6), b"w")
+    return [timestring, 0]
+
+
+@_script
+def downgrade(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    read_key, write_key, write_waiter_key, lease_key = keys[:4]
+    event_channel, write_token = _arg(args, 1), _arg(args, 2)
+    lease_ms = _number(args, 3)
+    if db.get(write_key) != write_token:
+        return 0
+    timestring, now_ms = _timestring(db)
+    db.delete(write_key)
+    db.zrem(lease_key, write_token)
+    db.sadd(read_key, timestring)
+    if lease_ms is not None:
+        db.zadd(lease_key, {timestring: now_ms + lease_ms})
+    if db.zcard(write_waiter_key) == 0:
+        db.publish(event_channel, b"del")
+    else:
+        db.publish(event_channel, b"free")
+    return timestring
+
+
+@_script
+def get_state(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    return _get_state(db, *keys[:3])
+
+
+@_script
+def lease(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    read_key, write_key, write_waiter_key, lease_key = keys[:4]
+    event_channel, lease_ms = _arg(args, 1), _number(args, 2)
+    _, now_ms = _timestring(db)
+    _reap(
+        db,
+        read_key,
+        write_key,
+        write_waiter_key,
+        lease_key,
+        event_channel,
+        now_ms,
+        _stats_key(keys, 5),
+    )
+    return db.zadd(
+        lease_key,
+        dict.fromkeys(map(ensure_bytes, args[2:]), now_ms + lease_ms),
+        xx=True,
+    )
+
+
+@_script
+def multilock(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    lease_ms, token = _number(args, 1), _arg(args, 2)
+    enqueue = _arg(args, 3) == b"1"
+    modes = [ensure_bytes(mode) for mode in args[5::2]]
+    channels = [ensure_bytes(channel) for channel in args[6::2]]
+    namespaces = [
+        (keys[4 * i : 4 * i + 4], mode, channel)
+        for i, (mode, channel) in enumerate(zip(modes, channels))
+    ]
+    timestring, now_ms = _timestring(db)
+    for ns_keys, _, channel in namespaces:
+        _reap(db, *ns_keys, channel, now_ms)
+
+    def ready():
+        for (read_key, write_key, write_waiter_key, _), mode, _ in namespaces:
+            if db.zfirst(write_waiter_key) != token or db.exists(write_key):
+                return False
+            if mode == b"w" and db.scard(read_key) > 0:
+                return False
+        return True
+
+    def grant():
+        for (
+            (read_key, write_key, write_waiter_key, lease_key),
+            mode,
+            channel,
+        ) in namespaces:
+            queued = db.zrem(write_waiter_key, token) == 1
+            if mode == b"w":
+                db.set(write_key, token)
+            else:
+                db.sadd(read_key, token)
+                if queued:
+                    if db.zcard(write_waiter_key) == 0:
+                        db.publish(channel, b"open")
+                    else:
+                        db.publish(channel, b"free")
+            if lease_ms is not None:
+                db.zadd(lease_key, {token: now_ms + lease_ms})
+        return [token, 1]
+
+    if token:
+        if any(db.zscore(ns_keys[2], token) is None for ns_keys, _, _ in namespaces):
+            for (
+                (read_key, write_key, write_waiter_key, lease_key),
+                _,
+                channel,
+            ) in namespaces:
+                if db.zrem(write_waiter_key, token) == 1:
+                    db.zrem(lease_key, token)
+                    _waiter_left(db, read_key, write_key, write_waiter_key, channel)
+            return [b"", -1]
+        return grant() if ready() else [token, 0]
+
+    token = b"multi:" + timestring
+    free = True
+    for ns_keys, mode, _ in namespaces:
+        current_state = _get_state(db, *ns_keys[:3])
+        if mode == b"w":
+            if current_state != 0:
+                free = False
+        elif current_state in (2, 3):
+            free = False
+    if free:
+        return grant()
+    if not enqueue:
+        return [b"", 0]
+    score = _writer_score(timestring, _number(args, 4), _number(args, 5))
+    for (_, _, write_waiter_key, lease_key), _, channel in namespaces:
+        db.zadd(write_waiter_key, {token: score})
+        if lease_ms is not None:
+            db.zadd(lease_key, {token: now_ms + lease_ms})
+        db.publish(channel, b"wait")
+    return grant() if ready() else [token, 0, b"%d" % score]
+
+
+@_script
+def multiunlock(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    token = _arg(args, 1)
+    released = 0
+    for i in range(len(keys) // 4):
+        read_key, write_key, write_waiter_key, lease_key = keys[4 * i : 4 * i + 4]
+        mode, event_channel = _arg(args, 2 * i + 2), _arg(args, 2 * i + 3)
+        db.zrem(lease_key, token)
+        if mode == b"w":
+            if db.get(write_key) == token:
+                released += 1
+                _promote(db, write_key, write_waiter_key, event_channel)
+        elif db.srem(read_key, token) == 1:
+            released += 1
+            if db.scard(read_key) == 0:
+                _promote_or_free(
+                    db, read_key, write_key, write_waiter_key, event_channel
+                )
+    return released
+
+
+@_script
+def multicancel(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    token = _arg(args, 1)
+    removed = 0
+    for i in range(len(keys) // 4):
+        read_key, write_key, write_waiter_key, lease_key = keys[4 * i : 4 * i + 4]
+        if db.zrem(write_waiter_key, token) == 1:
+            removed += 1
+            db.zrem(lease_key, token)
+            _waiter_left(db, read_key, write_key, write_waiter_key, _arg(args, i + 2))
+    return removed
+
+
+def _reap_grabbed(db: MemoryKeyspace, grabbed_key, now: float, stale_timeout, limit):
+    """GRABBED里获取时间早于now - stale_timeout的token"""
+    stale = db.zrangebyscore(
+        grabbed_key, now - stale_timeout, exclusive=True, limit=limit
+    )
+    if stale:
+        db.zrem(grabbed_key, *stale)
+    return stale
+
+
+def _claim_pending(db: MemoryKeyspace, pending_key, grabbed_key, now: float) -> None:
+    """common.lua的claim_pending"""
+    pending = db.lrange(pending_key, 0, 99)
+    for token in pending:
+        if db.zscore(grabbed_key, token) is None:
+            db.zadd(grabbed_key, {token: now})
+    if pending:
+        db.lpop(pending_key, len(pending))
+
+
+@_script
+def semacquire(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    exists_key, available_key, grabbed_key, pending_key = keys[:4]
+    value, count, stale_timeout = _number(args, 1), _number(args, 2), _number(args, 3)
+    event_channel = _arg(args, 4)
+    stats_key = None if _arg(args, 5) else _stats_key(keys, 5)
+    if db.set(exists_key, b"ok", nx=True):
+        db.delete(grabbed_key, available_key, pending_key)
+        db.rpush(available_key, *range(value))
+    now = _now(db)
+    if stale_timeout is not None:
+        _claim_pending(db, pending_key, grabbed_key, now)
+        stale = _reap_grabbed(db, grabbed_key, now, stale_timeout, 100)
+        if stale:
+            db.lpush(available_key, *stale)
+            db.publish(event_channel, b"release")
+    if count is None:
+        token = db.lpop(available_key)
+        if token is None:
+            _record_contended(db, stats_key, b"s")
+            return None
+        db.zadd(grabbed_key, {token: now})
+        return token
+    if db.llen(available_key) < count:
+        _record_contended(db, stats_key, b"s")
+        return None
+    tokens = db.lpop(available_key, count)
+    db.zadd(grabbed_key, dict.fromkeys(tokens, now))
+    return tokens
+
+
+@_script
+def semgrab(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    grabbed_key, token = keys[0], _arg(args, 1)
+    if (
+        len(keys) > 1
+        and not db.lrem(keys[1], token)
+        and db.zscore(grabbed_key, token) is None
+    ):
+        return 0
+    db.zadd(grabbed_key, {token: _now(db)})
+    return 1
+
+
+@_script
+def semrelease(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    available_key, grabbed_key = keys[:2]
+    stats_key = _stats_key(keys, 3)
+    first = 1 if stats_key is None else 3
+    released = 0
+    for token in args[first:]:
+        if db.zrem(grabbed_key, token) == 1:
+            db.lpush(available_key, token)
+            released += 1
+    if stats_key is not None:
+        _record_release(
+            db, stats_key, b"s", released, _number(args, 2), _number(args, 3)
+        )
+    if released:
+        db.publish(_arg(args, 1), b"release")
+    return released
+
+
+@_script
+def semacquire_counter(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    grabbed_key, seq_key = keys[:2]
+    value, count, stale_timeout = _number(args, 1), _number(args, 2), _number(args, 3)
+    event_channel = _arg(args, 4)
+    stats_key = None if _arg(args, 5) else _stats_key(keys, 3)
+    now = _now(db)
+    if stale_timeout is not None:
+        if _reap_grabbed(db, grabbed_key, now, stale_timeout, 100):
+            db.publish(event_channel, b"release")
+    need = 1 if count is None else count
+    if db.zcard(grabbed_key) + need > value:
+        _record_contended(db, stats_key, b"s")
+        return None
+    last = db.incrby(seq_key, need)
+    tokens = [b"%d" % i for i in range(last - need + 1, last + 1)]
+    db.zadd(grabbed_key, dict.fromkeys(tokens, now))
+    return tokens[0] if count is None else tokens
+
+
+@_script
+def semrelease_counter(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    stats_key = _stats_key(keys, 2)
+    first = 1 if stats_key is None else 3
+    released = db.zrem(keys[0], *args[first:]) if len(args) > first else 0
+    if stats_key is not None:
+        _record_release(
+            db, stats_key, b"s", released, _number(args, 2), _number(args, 3)
+        )
+    if released:
+        db.publish(_arg(args, 1), b"release")
+    return released
+
+
+@_script
+def semacquire_striped(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    counter = _arg(args, 1) == b"counter"
+    stale_timeout, start = _arg(args, 2), _number(args, 3)
+    width = 2 if counter else 4
+    stripes = len(keys) // width
+    for offset in range(stripes):
+        index = (start + offset) % stripes
+        stripe_keys = keys[index * width : (index + 1) * width]
+        stripe_args = [args[3 + index * 2], b"", stale_timeout, args[4 + index * 2]]
+        if counter:
+            token = semacquire_counter(db, stripe_keys, stripe_args)
+        else:
+            token = semacquire(db, stripe_keys, stripe_args)
+        if token is not None:
+            return [index, token]
+    return None
+
+
+@_script
+def semreap(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    stale_timeout, limit, event_channel = (
+        _number(args, 1),
+        _number(args, 2),
+        _arg(args, 3),
+    )
+    now = _now(db)
+    if len(keys) > 2:
+        _claim_pending(db, keys[2], keys[0], now)
+    stale = _reap_grabbed(db, keys[0], now, stale_timeout, limit)
+    if stale:
+        if len(keys) > 1:
+            db.lpush(keys[1], *stale)
+        db.publish(event_channel, b"release")
+    return stale
+
+
+class _FairSemaphore:
+    """common.lua的fair_semaphore和后面几个fair_函数"""
+
+    def __init__(self, db: MemoryKeyspace, keys: Sequence, args: Sequence):
+        self.db = db
+        (
+            self.grabbed_key,
+            self.available_key,
+            self.seq_key,
+            self.exists_key,
+            self.queue_key,
+            self.tickets_key,
+            self.grants_key,
+        ) = keys[:7]
+        self.stats_key = _stats_key(keys, 8)
+        self.value = _number(args, 1)
+        self.counter = _arg(args, 2) == b"counter"
+        self.event_channel = _arg(args, 3)
+
+    def free(self) -> int:
+        if self.counter:
+            return self.value - self.db.zcard(self.grabbed_key)
+        return self.db.llen(self.available_key)
+
+    def take(self, n: int, now: float) -> List[bytes]:
+        if self.counter:
+            last = self.db.incrby(self.seq_key, n)
+            tokens = [b"%d" % i for i in range(last - n + 1, last + 1)]
+        else:
+            tokens = self.db.lpop(self.available_key, n)
+        self.db.zadd(self.grabbed_key, dict.fromkeys(tokens, now))
+        return tokens
+
+    def put(self, tokens: Sequence) -> int:
+        released = 0
+        for token in tokens:
+            if self.db.zrem(self.grabbed_key, token) == 1:
+                if not self.counter:
+                    self.db.lpush(self.available_key, token)
+                released += 1
+        return released
+
+    def expire(self, now_ms: int) -> None:
+        expired = self.db.zrangebyscore(self.tickets_key, now_ms, limit=100)
+        if not expired:
+            return
+        self.db.zrem(self.tickets_key, *expired)
+        for ticket in expired:
+            if self.db.hdel(self.grants_key, ticket) == 0:
+                self.db.lrem(self.queue_key, ticket)
+
+    def grant(self, now: float) -> None:
+        while True:
+            ticket = self.db.lindex(self.queue_key, 0)
+            if ticket is None:
+                return
+            need = int(ticket.rsplit(b"/", 1)[1])
+            if self.free() < need:
+                return
+            self.db.lpop(self.queue_key)
+            granted = b",".join(self.take(need, now))
+            self.db.hset(self.grants_key, ticket, granted)
+            self.db.publish(self.event_channel, b"grant:%s:%s" % (ticket, granted))
+
+
+@_script
+def semfair(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    sem = _FairSemaphore(db, keys, args)
+    count, stale_timeout = _number(args, 4), _number(args, 5)
+    ticket, ticket_ms = _arg(args, 6), _number(args, 7)
+    retry = bool(_arg(args, 8))
+    if not sem.counter and db.set(sem.exists_key, b"ok", nx=True):
+        db.delete(sem.grabbed_key, sem.available_key)
+        db.rpush(sem.available_key, *range(sem.value))
+    _, now_ms = _timestring(db)
+    now = now_ms / 1000
+    if stale_timeout is not None:
+        stale = _reap_grabbed(db, sem.grabbed_key, now, stale_timeout, 100)
+        if stale and not sem.counter:
+            db.lpush(sem.available_key, *stale)
+    sem.expire(now_ms)
+    sem.grant(now)
+    if db.llen(sem.queue_key) == 0 and sem.free() >= count:
+        return [1, sem.take(count, now)]
+    if not retry:
+        _record_contended(db, sem.stats_key, b"s")
+    if not ticket:
+        return None
+    ahead = db.rpush(sem.queue_key, ticket) - 1
+    db.zadd(sem.tickets_key, {ticket: now_ms + ticket_ms})
+    return [0, ahead]
+
+
+@_script
+def semfair_release(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    sem = _FairSemaphore(db, keys, args)
+    first = 3 if sem.stats_key is None else 5
+    released = sem.put(args[first:])
+    if sem.stats_key is not None:
+        _record_release(
+            db, sem.stats_key, b"s", released, _number(args, 4), _number(args, 5)
+        )
+    if released:
+        _, now_ms = _timestring(db)
+        sem.expire(now_ms)
+        sem.grant(now_ms / 1000)
+    return released
+
+
+@_script
+def semfair_cancel(db: MemoryKeyspace, keys: Sequence, args: Sequence):
+    sem = _FairSemaphore(db, keys, args)
+    ticket, ticket_ms = _arg(args, 4), _number(args, 5)
+    _, now_ms = _timestring(db)
+    now = now_ms / 1000
+    sem.expire(now_ms)
+    if ticket_ms is not None or not ticket:
+        sem.grant(now)
+    if not ticket:
+        return [-1]
+    granted = db.hget(sem.grants_key, ticket)
+    if granted is not None:
+        db.hdel(sem.grants_key, ticket)
+        db.zrem(sem.tickets_key, ticket)
+        return [1, granted.split(b",")]
+    if ticket_ms is not None:
+        if db.zscore(sem.tickets_key, ticket) is not None:
+            db.zadd(sem.tickets_key, {ticket: now_ms + ticket_ms})
+            return [0]
+        return [-1]
+    db.zrem(sem.tickets_key, ticket)
+    if db.lrem(sem.queue_key, ticket) == 1:
+        sem.grant(now)
+    return [-1]
+
+
+class MemoryScript:
+    """调用方式和LibraryScript一样，client是pipeline的时候也是马上执行"""
+
+    def __init__(self, keyspace: MemoryKeyspace, name: str):
+        self.name = name
+        self._keyspace = keyspace
+        self._func = _scripts[name]
+
+    async def __call__(self, keys: Sequence = (), args: Sequence = (), client=None):
+        return self._func(self._keyspace, keys, args)
+
+
+class MemoryLibrary:
+    def __init__(self, keyspace: MemoryKeyspace):
+        self._keyspace = keyspace
+        self._scripts = {
+            name: MemoryScript(keyspace, name) for name in _scripts
+        }  # type: Dict[str, MemoryScript]
+
+    def __getitem__(self, name: str) -> MemoryScript:
+        return self._scripts[name]
+
+    async def run_pipeline(self, fill) -> list:
+        """和ScriptLibrary.run_pipeline一样，脚本不会丢，也不用重发"""
+        pipe = MemoryPipeline(self._keyspace)
+        await fill(pipe)
+        return await pipe.execute()
+
+
+class MemoryBackend:
+    """
+    进程内的后端，代替redis.asyncio.Redis当client传给RWLock, Semaphore, MultiLock, StripedSemaphore，
+    单机部署和测试不需要Redis，加锁解锁就是几次dict操作
+    key的布局和Redis里一样，每个lua脚本都有一个同名的python实现，状态机和返回值都和脚本一致
+    脚本是不会await的普通函数，在一个事件循环里天然是原子的
+    只能在一个事件循环里用，没有keyspace事件，RWLock默认notify="publish"
+
+    锁通过client.script_library找脚本，通过client.event_dispatcher订阅EVENTS，
+    别的后端提供这两个属性和锁直接用到的那几个命令就能接进来，没有keyspace事件的后端把keyspace_events设成False
+    """
+
+    keyspace_events = False  # RWLock看到它默认用notify="publish"
+
+    def __init__(self):
+        self.event_dispatcher = MemoryDispatcher()
+        self.keyspace = MemoryKeyspace(self.event_dispatcher)
+        self.script_library = MemoryLibrary(self.keyspace)
+
+    def pipeline(self, transaction: bool = True) -> MemoryPipeline:
+        return MemoryPipeline(self.keyspace)
+
+    def get_connection_kwargs(self) -> dict:
+        return {"db": 0}
+
+    async def time(self) -> Tuple[int, int]:
+        return self.keyspace.time()
+
+    async def publish(self, channel, data) -> int:
+        return self.keyspace.publish(channel, data)
+
+    async def get(self, key) -> Optional[bytes]:
+        return self.keyspace.get(key)
+
+    async def set(self, key, value, nx: bool = False) -> Optional[bool]:
+        return self.keyspace.set(key, value, nx)
+
+    async def delete(self, *keys) -> int:
+        return self.keyspace.delete(*keys)
+
+    async def exists(self, *keys) -> int:
+        return self.keyspace.exists(*keys)
+
+    async def sismember(self, key, member) -> int:
+        return self.keyspace.sismember(key, member)
+
+    async def scard(self, key) -> int:
+        return self.keyspace.scard(key)
+
+    async def smembers(self, key) -> set:
+        return self.keyspace.smembers(key)
+
+    async def rpush(self, key, *values) -> int:
+        return self.keyspace.rpush(key, *values)
+
+    async def llen(self, key) -> int:
+        return self.keyspace.llen(key)
+
+    async def lrange(self, key, start: int, end: int) -> List[bytes]:
+        return self.keyspace.lrange(key, start, end)
+
+    async def zcard(self, key) -> int:
+        return self.keyspace.zcard(key)
+
+    async def zscore(self, key, member) -> Optional[float]:
+        return self.keyspace.zscore(key, member)
+
+    async def hgetall(self, key) -> Dict[bytes, bytes]:
+        return self.keyspace.hgetall(key)
+
+    async def scan_iter(self, match: Optional[str] = None, count: Optional[int] = None):
+        pattern = ensure_bytes(match or "*")
+        for key in list(self.keyspace._data):
+            if fnmatch.fnmatchcase(key, pattern):
+                yield key
+
+    async def blpop(
+        self, keys: Iterable, timeout: float = 0
+    ) -> Optional[Tuple[bytes, bytes]]:
+        return await self.keyspace.blpop(keys, timeout)
+
+    async def blmove(
+        self, first_list, second_list, timeout: float = 0, src="LEFT", dest="RIGHT"
+    ) -> Optional[bytes]:
+        return await self.keyspace.blmove(first_list, second_list, timeout)
+
+    async def flushdb(self) -> bool:
+        return self.keyspace.flushdb()
@@ -0,0 +1,201 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+# 当前task正在计时的acquire访问了几次redis
+_round_trips = ContextVar(
+    "redislocks_round_trips", default=None
+)  # type: ContextVar[Optional[List[int]]]
+
+
+class LockMetrics:
+    """
+    RWLock和Semaphore的埋点接口，所有方法默认什么都不做，继承以后重写需要的
+    用metrics=传给锁，不传的话锁不会计时也不会计数
+
+    lock是发出事件的锁对象，可以用type(lock).__name__和lock.namespace区分
+    mode是RWLock的"r"或者"w"，Semaphore是None
+    方法在事件循环里同步调用，不能阻塞
+    """
+
+    def acquired(
+        self, lock, mode: Optional[str], wait: float, round_trips: int
+    ) -> None:
+        """
+        拿到了锁，wait是从调用acquire(或者upgrade)到拿到的秒数，
+        round_trips是这期间这个task访问redis的次数，包括脚本和BLPOP
+        """
+
+    def released(self, lock, mode: Optional[str], hold: float) -> None:
+        """token在redis里被释放，hold是持有的秒数，合并的读锁在最后一个本地读者释放的时候才算"""
+
+    def lost_wakeup(self, lock, mode: Optional[str]) -> None:
+        """被事件叫醒以后去拿锁，结果被别人抢先了，只能接着等"""
+
+    def enqueued(self, lock, mode: Optional[str], depth: int) -> None:
+        """
+        开始等待，depth是前面排着的个数
+        写锁是WRITEWAITER里排在前面的写者，读锁和信号量是这个锁对象上已经在等的本地等待者
+        """
+
+
+class CountingScript:
+    """包在脚本外面，每次调用给当前task的round_trips加一，只有设置了metrics的锁才用"""
+
+    __slots__ = ("_script",)
+
+    def __init__(self, script):
+        self._script = script
+
+    async def __call__(self, keys=(), args=(), client=None):
+        count_round_trip()
+        return await self._script(keys, args, client)
+
+
+def instrument_scripts(lock) -> None:
+    """把锁上所有的_xxx_script换成CountingScript"""
+    for name, value in list(vars(lock).items()):
+        if name.endswith("_script"):
+            setattr(lock, name, CountingScript(value))
+
+
+def count_round_trip() -> None:
+    counter = _round_trips.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+async def measure_acquire(metrics: LockMetrics, lock, mode: Optional[str], coro):
+    """等coro拿到锁，成功的话报告等了多久和访问了几次redis"""
+    counter = [0]
+    reset = _round_trips.set(counter)
+    start = time.monotonic()
+    try:
+        result = await coro
+    finally:
+        _round_trips.reset(reset)
+    metrics.acquired(lock, mode, time.monotonic() - start, counter[0])
+    return result
+
+
+class OpenTelemetryMetrics(LockMetrics):
+    """
+    用OpenTelemetry的metrics API报告，需要安装opentelemetry-api
+    属性是redislocks.lock(类名), redislocks.namespace和redislocks.mode
+    """
+
+    def __init__(self, meter_provider=None):
+        from opentelemetry import metrics
+
+        from redislocks import __version__
+
+        meter = metrics.get_meter("redislocks", __version__, meter_provider)
+        self._wait = meter.create_histogram(
+            "redislocks.acquire.wait", unit="s", description="Time spent acquiring"
+        )
+        self._round_trips = meter.create_histogram(
+            "redislocks.acquire.round_trips",
+            unit="{round_trip}",
+            description="Redis round trips per acquire",
+        )
+        self._hold = meter.create_histogram(
+            "redislocks.hold", unit="s", description="Time a token was held"
+        )
+        self._lost_wakeups = meter.create_counter(
+            "redislocks.wakeups.lost",
+            unit="{wakeup}",
+            description="Wakeups that lost the retry race",
+        )
+        self._depth = meter.create_histogram(
+            "redislocks.queue.depth",
+            unit="{waiter}",
+            description="Waiters ahead when starting to wait",
+        )
+
+    @staticmethod
+    def _attributes(lock, mode: Optional[str]) -> dict:
+        attributes = {
+            "redislocks.lock": type(lock).__name__,
+            "redislocks.namespace": lock.namespace,
+        }
+        if mode is not None:
+            attributes["redislocks.mode"] = mode
+        return attributes
+
+    def acquired(self, lock, mode, wait, round_trips):
+        attributes = self._attributes(lock, mode)
+        self._wait.record(wait, attributes)
+        self._round_trips.record(round_trips, attributes)
+
+    def released(self, lock, mode, hold):
+        self._hold.record(hold, self._attributes(lock, mode))
+
+    def lost_wakeup(self, lock, mode):
+        self._lost_wakeups.add(1, self._attributes(lock, mode))
+
+    def enqueued(self, lock, mode, depth):
+        self._depth.record(depth, self._attributes(lock, mode))
+
+
+class PrometheusMetrics(LockMetrics):
+    """
+    用prometheus_client报告，需要安装prometheus-client
+    标签是lock(类名), namespace和mode，Semaphore的mode是空字符串
+    """
+
+    def __init__(self, registry=None, prefix: str = "redislocks"):
+        from prometheus_client import REGISTRY, Counter, Histogram
+
+        if registry is None:
+            registry = REGISTRY
+        labels = ("lock", "namespace", "mode")
+        self._wait = Histogram(
+            f"{prefix}_acquire_wait_seconds",
+            "Time spent acquiring",
+            labels,
+            registry=registry,
+        )
+        self._round_trips = Histogram(
+            f"{prefix}_acquire_round_trips",
+            "Redis round trips per acquire",
+            labels,
+            registry=registry,
+            buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32, float("inf")),
+        )
+        self._hold = Histogram(
+            f"{prefix}_hold_seconds", "Time a token was held", labels, registry=registry
+        )
+        self._lost_wakeups = Counter(
+            f"{prefix}_lost_wakeups",
+            "Wakeups that lost the retry race",
+            labels,
+            registry=registry,
+        )
+        self._depth = Histogram(
+            f"{prefix}_queue_depth",
+            "Waiters ahead when starting to wait",
+            labels,
+            registry=registry,
+            buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, float("inf")),
+        )
+
+    @staticmethod
+    def _labels(lock, mode: Optional[str]):
+        return type(lock).__name__, lock.namespace, mode or ""
+
+    def acquired(self, lock, mode, wait, round_trips):
+        labels = self._labels(lock, mode)
+        self._wait.labels(*labels).observe(wait)
+        self._round_trips.labels(*labels).observe(round_trips)
+
+    def released(self, lock, mode, hold):
+        self._hold.labels(*self._labels(lock, mode)).observe(hold)
+
+    def lost_wakeup(self, lock, mode):
+        self._lost_wakeups.labels(*self._labels(lock, mode)).inc()
+
+    def enqueued(self, lock, mode, depth):
+        self._depth.labels(*self._labels(lock, mode)).observe(depth)
@@ -0,0 +1,17 @@
+-- 取消multilock.lua里排着队的token
+-- numkey: 4n
+-- keys: (read_key write_key write_waiter_key lease_key)... 每个namespace四个key
+-- argv: token event_channel... 和namespace一一对应
+-- 返回从几个namespace的WRITEWAITER里撤了出来，已经拿到了的话是0，要用multiunlock.lua释放
+local token = ARGV[1]
+local removed = 0
+
+for i = 1, #KEYS / 4 do
+    if redis.call("ZREM", KEYS[4 * i - 1], token) == 1 then
+        removed = removed + 1
+        redis.call("ZREM", KEYS[4 * i], token)
+        -- 被它挡着的读者、写者和MultiLock可能可以拿了
+        waiter_left(KEYS[4 * i - 3], KEYS[4 * i - 2], KEYS[4 * i - 1], ARGV[i + 1], nil)
+    end
+end
+return removed
@@ -0,0 +1,112 @@
+-- 一次获取多个namespace的读写锁，要么全部拿到要么一个都不拿
+-- numkey: 4n
+-- keys: (read_key write_key write_waiter_key lease_key)... 每个namespace四个key，调用方已经按namespace排好序
+-- argv: lease_ms token enqueue priority step_us (mode event_channel)... mode是"r"或者"w"，和namespace一一对应
+-- 先和lockread/lockwrite一样回收每个namespace里租约过期的token，给了lease_ms就给token在每个namespace都加上租约
+-- token为空是新来的，能立刻拿到就拿，拿不到的话enqueue为"1"就排队
+-- 排队的时候token在每个namespace的WRITEWAITER里都排着，分数和lockwrite.lua一样按priority和step_us算，
+-- 挡着后来的读者和写者，单个namespace的脚本不会替它拿锁，见common.lua的pop_writer
+-- token不为空是排着队的token在重试，每个namespace都排到最前面、要写的没有读锁和写锁、要读的没有写锁的时候一起拿
+-- 返回 {token, 1} 全部拿到了，所有namespace用同一个token
+--      {token, 0, score} 排上了队，或者排着队还没轮到
+--      {"", 0} 拿不到，没有排队
+--      {"", -1} 排着的token在某个namespace已经不在了，比如租约过期被回收，别的namespace里的也撤掉了
+local lease_ms = tonumber(ARGV[1])
+local token = ARGV[2]
+local enqueue = ARGV[3] == "1"
+local priority = tonumber(ARGV[4]) or 0
+local step_us = tonumber(ARGV[5]) or WRITER_STRICT_STEP_US
+local n = #KEYS / 4
+
+local time = redis.call("TIME")
+local timestring = time[1] ..".".. time[2] -- string
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+for i = 1, n do
+    reap(KEYS[4 * i - 3], KEYS[4 * i - 2], KEYS[4 * i - 1], KEYS[4 * i], ARGV[2 * i + 5], now_ms, nil)
+end
+
+-- 排着队的token是不是在每个namespace都轮到了
+local function ready()
+    for i = 1, n do
+        if redis.call("ZRANGE", KEYS[4 * i - 1], 0, 0)[1] ~= token or redis.call("EXISTS", KEYS[4 * i - 2]) == 1 then
+            return false
+        end
+        if ARGV[2 * i + 4] == "w" and redis.call("SCARD", KEYS[4 * i - 3]) > 0 then
+            return false
+        end
+    end
+    return true
+end
+
+local function grant()
+    for i = 1, n do
+        local queued = redis.call("ZREM", KEYS[4 * i - 1], token) == 1
+        if ARGV[2 * i + 4] == "w" then
+            redis.call("SET", KEYS[4 * i - 2], token)
+        else
+            redis.call("SADD", KEYS[4 * i - 3], token)
+            if queued then
+                -- 只要读锁的话后面排着的也可能可以进来了
+                if redis.call("ZCARD", KEYS[4 * i - 1]) == 0 then
+                    redis.call("PUBLISH", ARGV[2 * i + 5], "open")
+                else
+                    redis.call("PUBLISH", ARGV[2 * i + 5], "free")
+                end
+            end
+        end
+        if lease_ms then
+            redis.call("ZADD", KEYS[4 * i], now_ms + lease_ms, token)
+        end
+    end
+    return {token, 1}
+end
+
+if token ~= "" then
+    for i = 1, n do
+        if not redis.call("ZSCORE", KEYS[4 * i - 1], token) then
+            for j = 1, n do
+                if redis.call("ZREM", KEYS[4 * j - 1], token) == 1 then
+                    redis.call("ZREM", KEYS[4 * j], token)
+                    waiter_left(KEYS[4 * j - 3], KEYS[4 * j - 2], KEYS[4 * j - 1], ARGV[2 * j + 5], nil)
+                end
+            end
+            return {"", -1}
+        end
+    end
+    if ready() then
+        return grant()
+    end
+    return {token, 0}
+end
+
+token = "multi:" .. timestring
+local free = true
+for i = 1, n do
+    local current_state = get_state(KEYS[4 * i - 3], KEYS[4 * i - 2], KEYS[4 * i - 1])
+    if ARGV[2 * i + 4] == "w" then
+        if current_state ~= 0 then
+            free = false
+        end
+    elseif current_state == 2 or current_state == 3 then -- 写锁优先
+        free = false
+    end
+end
+if free then
+    return grant()
+end
+if not enqueue then
+    return {"", 0}
+end
+local score = writer_score(time, priority, step_us)
+for i = 1, n do
+    redis.call("ZADD", KEYS[4 * i - 1], score, token)
+    if lease_ms then
+        redis.call("ZADD", KEYS[4 * i], now_ms + lease_ms, token)
+    end
+    redis.call("PUBLISH", ARGV[2 * i + 5], "wait") -- 告诉合并读锁的进程别再让新读者搭车了
+end
+-- 优先级比排着的MultiLock都高的话，空着的namespace可能马上就轮到自己
+if ready() then
+    return grant()
+end
+return {token, 0, score}
@@ -0,0 +1,268 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+from typing import Dict, Iterable, List, Literal, Optional, Set, Tuple
+
+from redis.asyncio import Redis, RedisCluster
+
+from redislocks.dispatcher import get_dispatcher
+from redislocks.exceptions import NotAvailable
+from redislocks.library import get_library
+from redislocks.utils import (
+    ensure_bytes,
+    ensure_str,
+    namespaced_key,
+    priority_args,
+    priority_step,
+)
+from redislocks.watchdog import get_watchdog
+
+
+class MultiLock:
+    """
+    一次脚本调用获取多个RWLock namespace的锁，要么全部拿到要么一个都不拿
+    和RWLock用同一套key，可以和单独的RWLock混用
+    集群模式下所有key要在同一个slot，namespace要自己带上同一个hash tag，比如"{shop}:orders"
+
+    namespace按字典序排好，同一个namespace要了读又要了写的只算写
+    阻塞模式下要写锁的MultiLock拿不到就和RWLock的写者一样排进每个namespace的WRITEWAITER，
+    token以"multi:"开头，分数按acquire(priority=n)和priority_aging算，和单个namespace的写者一起排，
+    挡住后来的读者和写者，每个namespace都轮到它的时候multilock.lua一次全部拿到，
+    排队的时候不占着任何一个namespace的锁，不会死锁，同一个namespace的锁要用一样的priority_aging
+    只要读锁的MultiLock和RWLock的读者一样不排队，在本地按先来后到等
+    等待的时候监听各个namespace的EVENTS，有写锁被删("del")、挡路的写锁等待者没了("open")
+    或者读锁空了、排在最前面的可能轮到了("free")就由一个task替本地分数最小的等待者重试
+
+    加锁脚本和lockread.lua, lockwrite.lua一样先回收各个namespace里租约过期的token，
+    lease_timeout不为None时拿到的token在每个namespace都带租约，由同一个client的watchdog续租，
+    进程挂了的话和RWLock的token一样过期被回收
+    """
+
+    def __init__(
+        self,
+        locks: Iterable[Tuple[str, Literal["r", "w"]]],
+        client: Optional[Redis] = None,
+        blocking: bool = True,
+        hash_tag: Optional[bool] = None,
+        lease_timeout: Optional[float] = None,
+        priority_aging: Optional[float] = None,
+    ):
+        self.client = client or Redis()
+        self.blocking = blocking
+        if lease_timeout is not None and lease_timeout <= 0:
+            raise ValueError("lease_timeout must be > 0")
+        self.lease_timeout = lease_timeout
+        self._lease_ms = "" if lease_timeout is None else int(lease_timeout * 1000)
+        self.priority_aging = priority_aging
+        self._priority_step = priority_step(priority_aging)
+        if hash_tag is None:
+            hash_tag = isinstance(self.client, RedisCluster)
+        modes = {}  # type: Dict[str, str]
+        for namespace, mode in locks:
+            if mode not in ("r", "w"):
+                raise ValueError("mode must be 'r' or 'w'")
+            if modes.get(namespace) != "w":
+                modes[namespace] = mode
+        if not modes:
+            raise ValueError("MultiLock needs at least one namespace")
+        self.namespaces = sorted(modes)  # 固定的顺序
+        self.modes = [modes[namespace] for namespace in self.namespaces]
+        self._enqueue = blocking and "w" in self.modes  # 要写锁的才去redis排队
+        self._keys = [
+            namespaced_key(namespace, suffix, hash_tag)
+            for namespace in self.namespaces
+            for suffix in ("READ", "WRITE", "WRITEWAITER", "LEASES")
+        ]
+
+        library = get_library(self.client)
+        self._lock_script = library["multilock"]  # multilock.lua
+        self._unlock_script = library["multiunlock"]  # multiunlock.lua
+        self._cancel_script = library["multicancel"]  # multicancel.lua
+        self._lease_script = library["lease"]  # lease.lua
+        self._local_tokens = []  # type: List[str]
+        self._watchdog = None if lease_timeout is None else get_watchdog(self.client)
+
+        self._dispatcher = get_dispatcher(self.client)
+        self._channels = [
+            ensure_bytes(namespaced_key(namespace, "EVENTS", hash_tag))
+            for namespace in self.namespaces
+        ]
+        self._mode_args = []  # type: List
+        for mode, channel in zip(self.modes, self._channels):
+            self._mode_args.extend((mode, channel))
+        # [score, token, future, priority]，排队的token和分数重新排队以后会变
+        # 只读的MultiLock不排队，token为空，分数是本地的到达顺序
+        self._waiters = []  # type: List[list]
+        self._arrivals = 0
+        self._free_epoch = 0  # 每收到一次del或者free加一
+        self._granting = False
+        self._grant_tasks = set()  # type: Set[asyncio.Task]
+
+    def __del__(self):
+        dispatcher = getattr(self, "_dispatcher", None)
+        if dispatcher is not None:
+            for channel in self._channels:
+                dispatcher.unsubscribe(channel, self)
+
+    async def acquire(self, timeout: float = 0, priority: int = 0) -> str:
+        """
+        timeout只对阻塞模式有用，0表示一直等，超时抛NotAvailable
+        priority只对要写锁的MultiLock有用，排队的时候大的先轮到
+        """
+        if priority and "w" not in self.modes:
+            raise ValueError("priority only applies to MultiLocks that write")
+        priority_args(priority, self._priority_step)  # 先检查范围
+        if self.blocking:  # 先订阅再尝试，不然可能漏掉中间的事件
+            for channel in self._channels:
+                await self._dispatcher.subscribe(channel, self)
+        epoch = self._free_epoch
+        token, status, score = await self._lock("", self._enqueue, priority)
+        if status != 1:
+            if not self.blocking:
+                raise NotAvailable
+            token = await self._wait(epoch, token, score, priority, timeout)
+        self._local_tokens.append(token)
+        self._watch()
+        return token
+
+    async def release(self) -> None:
+        """一次释放全部namespace上的锁"""
+        try:
+            token = self._local_tokens.pop()
+        except IndexError:
+            raise ValueError("can not release more than acquire")
+        if not await self._release_token(token):
+            raise ValueError("No lock is released. Is redis changed?")
+
+    async def release_all(self):
+        for _ in range(len(self._local_tokens)):
+            await self.release()
+
+    async def _lock(
+        self, token: str = "", enqueue: bool = False, priority: int = 0
+    ) -> Tuple[str, int, Optional[float]]:
+        """跑一次multilock.lua，返回(token, status, score)，status的意思见multilock.lua"""
+        token, status, *score = await self._lock_script(
+            self._keys,
+            [
+                self._lease_ms,
+                token,
+                "1" if enqueue else "",
+                *priority_args(priority, self._priority_step),
+                *self._mode_args,
+            ],
+        )
+        return ensure_str(token), status, float(score[0]) if score else None
+
+    async def _release_token(self, token: str) -> int:
+        return await self._unlock_script(self._keys, [token, *self._mode_args])
+
+    async def _cancel_token(self, token: str) -> int:
+        """把排着队的token从每个namespace的WRITEWAITER里撤出来"""
+        return await self._cancel_script(self._keys, [token, *self._channels])
+
+    async def _wait(
+        self,
+        epoch: int,
+        token: str,
+        score: Optional[float],
+        priority: int,
+        timeout: float,
+    ) -> str:
+        waiter = asyncio.get_running_loop().create_future()
+        if not token:  # 没有排队，按本地的到达顺序
+            self._arrivals += 1
+            score = self._arrivals
+        entry = [score, token, waiter, priority]
+        self._waiters.append(entry)
+        self._watch()  # 等的时候也要帮忙回收过期的锁，排着的token也要续租
+        if epoch != self._free_epoch:  # 尝试的途中已经有锁被放掉了
+            self._start_grant()
+        try:
+            await asyncio.wait((waiter,), timeout=timeout or None)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():  # 已经拿到了，还回去
+                await self._release_token(waiter.result())
+            else:
+                waiter.cancel()
+                await self._leave(entry)
+            raise
+        if not waiter.done():  # 超时了
+            waiter.cancel()
+            await self._leave(entry)
+            raise NotAvailable
+        self._waiters.remove(entry)
+        return waiter.result()
+
+    async def _leave(self, entry: list) -> None:
+        """等待者走了，排着的token撤掉，_grant_waiters途中拿到的由它还回去"""
+        self._waiters.remove(entry)
+        if entry[1]:
+            await self._cancel_token(entry[1])
+
+    def _handle_event(self, channel: bytes, data: bytes) -> None:
+        """由dispatcher调用"""
+        if data in (b"del", b"open", b"free", b"reconnect"):
+            self._free_epoch += 1
+            self._start_grant()
+
+    def _start_grant(self) -> None:
+        if self._waiters and not self._granting:
+            self._granting = True
+            task = asyncio.create_task(self._grant_waiters())
+            self._grant_tasks.add(task)
+            task.add_done_callback(self._grant_tasks.discard)
+
+    async def _grant_waiters(self):
+        """一个task替本地分数最小的等待者重试，只读的MultiLock就是先来后到"""
+        try:
+            while True:
+                entries = [entry for entry in self._waiters if not entry[2].done()]
+                if not entries:
+                    break
+                entry = min(entries, key=lambda entry: entry[0])
+                epoch = self._free_epoch
+                token, status, score = await self._lock(entry[1])
+                if status == -1 and not entry[2].done():
+                    # 排着的token被回收了，比如租约没续上，重新排队
+                    token, status, score = await self._lock("", True, entry[3])
+                    if status == 0:
+                        entry[0], entry[1] = score, token
+                        if entry[2].done():  # 重新排队的途中等的人走了
+                            await self._cancel_token(token)
+                if status != 1:
+                    if epoch == self._free_epoch:
+                        break
+                    continue  # 途中又有锁被放掉，那次没有再启动，这里补上
+                if entry[2].done():  # 等的人走了，还回去
+                    await self._release_token(token)
+                else:
+                    entry[2].set_result(token)
+        finally:
+            self._granting = False
+
+    def _watch(self) -> None:
+        if self._watchdog is not None:
+            self._watchdog.watch(self)
+
+    def _lease_active(self) -> bool:
+        """有token要续租或者有人在等，watchdog就要接着跑"""
+        return bool(self._local_tokens or self._waiters)
+
+    async def _renew_lease(self, client):
+        """client是watchdog的pipeline或者集群client，每个namespace一次lease.lua"""
+        queued = [entry[1] for entry in self._waiters if entry[1]]
+        for i, channel in enumerate(self._channels):
+            await self._lease_script(
+                self._keys[4 * i : 4 * i + 4],
+                [channel, self._lease_ms, *self._local_tokens, *queued],
+                client=client,
+            )
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.release()
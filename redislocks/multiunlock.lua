@@ -0,0 +1,36 @@
+-- 一次释放multilock.lua拿到的所有锁，和unlockread/unlockwrite一样帮等待者轮
+-- numkey: 4n
+-- keys: (read_key write_key write_waiter_key lease_key)... 每个namespace四个key
+-- argv: token (mode event_channel)... 和namespace一一对应
+-- 返回真正释放掉的个数
+local token = ARGV[1]
+local released = 0
+
+for i = 1, #KEYS / 4 do
+    local read_key = KEYS[4 * i - 3]
+    local write_key = KEYS[4 * i - 2]
+    local write_waiter_key = KEYS[4 * i - 1]
+    local lease_key = KEYS[4 * i]
+    local mode = ARGV[2 * i]
+    local event_channel = ARGV[2 * i + 1]
+    redis.call("ZREM", lease_key, token)
+    if mode == "w" then
+        if redis.call("GET", write_key) == token then
+            released = released + 1
+            local write_token = pop_writer(write_waiter_key)
+            if write_token then
+                redis.call("SET", write_key, write_token)
+                redis.call("PUBLISH", event_channel, "set:" .. write_token)
+            else
+                redis.call("DEL", write_key)
+                redis.call("PUBLISH", event_channel, "del") -- 读锁可以进来了，排在最前面的MultiLock也会重试
+            end
+        end
+    elseif redis.call("SREM", read_key, token) == 1 then
+        released = released + 1
+        if redis.call("SCARD", read_key) == 0 then
+            promote_or_free(read_key, write_key, write_waiter_key, event_channel, nil)
+        end
+    end
+end
+return released
@@ -0,0 +1,283 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+import functools
+import random
+from typing import List, Literal, Optional, Sequence, Set, Tuple
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from redislocks.exceptions import NotAvailable
+from redislocks.rwlock import RWLock
+from redislocks.sem import Semaphore
+
+
+class _Quorum:
+    """
+    在N个互相独立的redis上同时加锁，过半数拿到并且还在有效期内才算拿到，否则全部放掉
+    有效期 = 租约 - 加锁花的时间 - 时钟漂移，调用方要在有效期内用完
+
+    每个实例的脚本用asyncio.gather并发发出去，加锁的延迟是最慢的那个RTT，不是所有RTT之和
+    单个实例超过instance_timeout没有回复就当它失败，挂掉的实例不会拖住整个加锁
+    超时的脚本可能已经在服务器上跑完了，加锁的操作不取消，回复晚到的话再把拿到的锁放掉
+    """
+
+    def __init__(
+        self,
+        count: int,
+        ttl: float,
+        blocking: bool,
+        instance_timeout: float,
+        retry_delay: float,
+        clock_drift_factor: float,
+    ):
+        if count < 1:
+            raise ValueError("at least one client is required")
+        self.quorum = count // 2 + 1
+        self.ttl = ttl
+        self.blocking = blocking
+        self.instance_timeout = instance_timeout
+        self.retry_delay = retry_delay
+        self.clock_drift_factor = clock_drift_factor
+        self._late = set()  # type: Set[asyncio.Task] 超时以后还在等回复的操作
+
+    async def _fan_out(self, coros, late=None) -> list:
+        """
+        并发跑每个实例上的操作，超时或者出错的结果是None
+        超时的操作留在后台接着等，给了late的话回复晚到的结果交给late(i, result)放掉
+        """
+
+        async def run(i, coro):
+            task = asyncio.ensure_future(coro)
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(task), self.instance_timeout
+                )
+            except asyncio.TimeoutError:
+                self._late.add(task)
+                task.add_done_callback(functools.partial(self._on_late, i, late))
+                return None
+            except (NotAvailable, RedisError):
+                return None
+
+        return await asyncio.gather(*[run(i, coro) for i, coro in enumerate(coros)])
+
+    def _on_late(self, i: int, late, task: asyncio.Task) -> None:
+        self._late.discard(task)
+        if late is None or task.cancelled() or task.exception() is not None:
+            return
+        if task.result() is not None:
+            cleanup = asyncio.ensure_future(late(i, task.result()))
+            self._late.add(cleanup)
+            cleanup.add_done_callback(self._late.discard)
+
+    def _validity(self, start: float) -> float:
+        """从start开始算，还剩下的有效期"""
+        drift = self.ttl * self.clock_drift_factor + 0.002
+        return self.ttl - (asyncio.get_running_loop().time() - start) - drift
+
+    async def _acquire_quorum(self, attempt, rollback, timeout: Optional[float]):
+        """
+        attempt()返回每个实例上拿到的东西，没拿到是None，过半数拿到返回(拿到的东西, 有效期)
+        没拿到就rollback()放掉已经拿到的，阻塞模式下随机等一会儿再试，直到timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            start = loop.time()
+            results = await attempt()
+            acquired = [result for result in results if result is not None]
+            validity = self._validity(start)
+            if len(acquired) >= self.quorum and validity > 0:
+                return results, validity
+            await rollback(results)
+            if not self.blocking or (deadline is not None and loop.time() >= deadline):
+                raise NotAvailable
+            # 随机等一会儿，免得几个client同时重试又各拿一部分
+            await asyncio.sleep(random.uniform(0, self.retry_delay))
+
+
+class QuorumRWLock(_Quorum):
+    """
+    每个client上一个非阻塞带租约的RWLock，lease_timeout就是有效期的上限
+    拿到的锁不交给watchdog续租(auto_renew=False)，调用方要在acquire返回的有效期内用完，或者extend续上
+    有效期过了锁可能已经被回收，release的时候放不掉的实例直接跳过
+    没过半数的那些会被并发地释放掉
+    """
+
+    def __init__(
+        self,
+        clients: Sequence[Redis],
+        namespace: str = "RWLOCK",
+        lease_timeout: float = 30,
+        blocking: bool = True,
+        instance_timeout: float = 0.5,
+        retry_delay: float = 0.2,
+        clock_drift_factor: float = 0.01,
+    ):
+        super().__init__(
+            len(clients),
+            lease_timeout,
+            blocking,
+            instance_timeout,
+            retry_delay,
+            clock_drift_factor,
+        )
+        self.namespace = namespace
+        self.locks = [
+            RWLock(
+                client,
+                namespace=namespace,
+                blocking=False,
+                notify="publish",
+                lease_timeout=lease_timeout,
+                # 后台续租的话返回的有效期就没有意义了，租约只能由extend显式续
+                auto_renew=False,
+            )
+            for client in clients
+        ]  # type: List[RWLock]
+        self._held = []  # type: List[Tuple[str, List[RWLock]]]
+
+    async def acquire(
+        self, mode: Literal["r", "w"] = "w", timeout: Optional[float] = None
+    ) -> float:
+        """过半数实例拿到锁以后返回有效期(秒)"""
+        if mode not in ("r", "w"):
+            raise ValueError("mode must be 'r' or 'w'")
+
+        async def attempt():
+            return await self._fan_out(
+                [lock.acquire(mode) for lock in self.locks],
+                lambda i, token: self._release_lock(self.locks[i], mode),
+            )
+
+        async def rollback(results):
+            await self._release_locks(
+                mode,
+                [lock for lock, token in zip(self.locks, results) if token is not None],
+            )
+
+        results, validity = await self._acquire_quorum(attempt, rollback, timeout)
+        self._held.append(
+            (
+                mode,
+                [lock for lock, token in zip(self.locks, results) if token is not None],
+            )
+        )
+        return validity
+
+    async def extend(self) -> float:
+        """
+        给最近一次拿到的锁续租，过半数实例续上以后返回新的有效期(秒)
+        续不上的话抛NotAvailable，锁还是拿着的，要release掉
+        """
+        try:
+            mode, locks = self._held[-1]
+        except IndexError:
+            raise ValueError("can not extend without acquire")
+        start = asyncio.get_running_loop().time()
+        results = await self._fan_out([lock.renew() for lock in locks])
+        validity = self._validity(start)
+        if sum(1 for renewed in results if renewed) >= self.quorum and validity > 0:
+            return validity
+        raise NotAvailable
+
+    async def release(self) -> None:
+        """并发释放最近一次拿到的锁"""
+        try:
+            mode, locks = self._held.pop()
+        except IndexError:
+            raise ValueError("can not release more than acquire")
+        await self._release_locks(mode, locks)
+
+    async def _release_locks(self, mode: str, locks: List[RWLock]) -> None:
+        # 释放失败的实例等租约到期被回收
+        await self._fan_out([self._release_lock(lock, mode) for lock in locks])
+
+    @staticmethod
+    async def _release_lock(lock: RWLock, mode: str) -> None:
+        """租约到期以后锁可能已经被回收了，什么都放不掉的话不算错"""
+        try:
+            await lock.release(mode)
+        except ValueError:
+            pass
+
+
+class QuorumSemaphore(_Quorum):
+    """
+    每个client上一个非阻塞的Semaphore，token不会续租，stale_client_timeout就是有效期的上限
+    """
+
+    def __init__(
+        self,
+        value: int,
+        clients: Sequence[Redis],
+        stale_client_timeout: float,
+        namespace: str = "SEMAPHORE",
+        blocking: bool = True,
+        instance_timeout: float = 0.5,
+        retry_delay: float = 0.2,
+        clock_drift_factor: float = 0.01,
+    ):
+        super().__init__(
+            len(clients),
+            stale_client_timeout,
+            blocking,
+            instance_timeout,
+            retry_delay,
+            clock_drift_factor,
+        )
+        self.value = value
+        self.namespace = namespace
+        self.sems = [
+            Semaphore(
+                value,
+                client,
+                namespace=namespace,
+                stale_client_timeout=stale_client_timeout,
+                blocking=False,
+            )
+            for client in clients
+        ]  # type: List[Semaphore]
+        self._held = []  # type: List[List[Tuple[Semaphore, bytes]]]
+
+    async def acquire(self, timeout: Optional[float] = None) -> float:
+        """过半数实例拿到token以后返回有效期(秒)"""
+
+        async def attempt():
+            return await self._fan_out(
+                [sem._try_acquire() for sem in self.sems],
+                lambda i, token: self.sems[i].signal(token),
+            )
+
+        async def rollback(results):
+            await self._signal(
+                [
+                    (sem, token)
+                    for sem, token in zip(self.sems, results)
+                    if token is not None
+                ]
+            )
+
+        results, validity = await self._acquire_quorum(attempt, rollback, timeout)
+        self._held.append(
+            [
+                (sem, token)
+                for sem, token in zip(self.sems, results)
+                if token is not None
+            ]
+        )
+        return validity
+
+    async def release(self) -> None:
+        """并发把最近一次拿到的token还回去"""
+        try:
+            held = self._held.pop()
+        except IndexError:
+            raise ValueError("can not release more than acquire")
+        await self._signal(held)
+
+    async def _signal(self, held: List[Tuple[Semaphore, bytes]]) -> None:
+        await self._fan_out([sem.signal(token) for sem, token in held])
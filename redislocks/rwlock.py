@@ -2,97 +2,202 @@
 Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
 """
 import asyncio
+import time
 from enum import IntEnum
-from typing import Dict, List, Literal, Optional, Union
+from typing import Dict, List, Literal, Optional, Set, Tuple, Union
 
-from redis.asyncio import Redis
+from redis.asyncio import Redis, RedisCluster
 
+from redislocks.dispatcher import get_dispatcher
 from redislocks.exceptions import NotAvailable
-from redislocks.scripts import (
-    get_state_script,
-    lockread_script,
-    lockwrite_nowait_script,
-    unlockread_script,
-    unlockwrite_script,
+from redislocks.library import get_library
+from redislocks.metrics import LockMetrics, instrument_scripts, measure_acquire
+from redislocks.utils import (
+    ensure_bytes,
+    ensure_str,
+    namespaced_key,
+    priority_args,
+    priority_step,
 )
-from redislocks.utils import ensure_bytes, ensure_str
+from redislocks.watchdog import get_watchdog
 
 
 class LockState(IntEnum):
     empty = 0  # 空
     reading = 1  # 只有读锁
     writing = 2  # 只有写锁
-    waiting_write = 3  # 有读锁，还有写锁在等待队列，因此此时不能继续获取读锁
+    waiting_write = 3  # 没有写锁，还有写锁在等待队列(可能是在等别的namespace的MultiLock)，因此此时不能继续获取读锁
 
 
 class RWLock:
     """
     Redis内存视图
-    "RWLOCK:EXISTS" : "ok" 判断是否存在
     "RWLOCK:READ": Set[str] 已经被获取的读锁，里面是他们的申请时间戳, redis把float当str
     "RWLOCK:WRITE": "1151.1919810" 已经被获取的写锁和他的申请时间戳
-    "RWLOCK:WRITEWAITER": List[str] 等待获取写锁的，里面是他们的申请时间戳
+    "RWLOCK:WRITEWAITER": zset[str, float] 等待获取写锁的，里面是他们的申请时间戳，分数小的先轮到
+    "RWLOCK:UPGRADER": str 最近一个排队等升级的写锁token，它还在WRITEWAITER最前面的话别人就不能再升级
+    "RWLOCK:LEASES": zset[str, int] 带租约的token和到期时间(毫秒)，读锁写锁和排队的写锁都可以有
+    "RWLOCK:EVENTS": channel 写锁轮给等待者的时候发布"set:<token>"，写锁被删了读锁可以进来的时候发布"del"，
+                     写锁没变、只是挡路的写锁等待者没了的时候发布"open"，
+                     有写锁开始排队的时候发布"wait"，读锁空了又没有写锁可轮的时候发布"free"
 
     写锁优先，如果存在写锁或者存在等待获取写锁的，读锁只能先行等待进入等待队列
-    """
 
-    exists_val = "ok"
+    acquire("w", priority=n)的写者按优先级排队，n大的先轮到，同一优先级先来后到，n在±1000之间
+    priority_aging不为None时每多等priority_aging秒相当于升一级，低优先级的写者不会饿死，
+    同一个namespace的锁要用一样的priority_aging，为None时严格按优先级
+
+    notify="keyspace"时阻塞模式依赖服务器打开notify-keyspace-events，同时监听EVENTS，
+    写锁被删从keyspace事件知道，不理EVENTS上的"del"，不然每次都会被叫醒两次
+    notify="publish"时只监听脚本自己发布到EVENTS的消息，服务器不需要打开keyspace事件
+    默认是keyspace，client是RedisCluster的时候默认是publish
+
+    hash_tag=True时key是"{RWLOCK}:READ"这样，同一个namespace的key都在同一个slot，
+    client是RedisCluster的时候默认打开。namespace里自己带了{}的话原样使用
+
+    coalesce_reads=True时这个锁上的所有读者共用一个读锁token，本地用引用计数记录有几个读者，
+    最后一个读者release的时候才真正释放。有写锁排队以后新来的读者不再搭车，老token自然会被放掉
+
+    lease_timeout不为None时token带租约，同一个client的watchdog会在后台给还在用的token续租，
+    进程挂了没人续租的token会在加锁脚本里被回收，等待者跟着被唤醒，不用reset
+    auto_renew=False时不交给watchdog，租约只能调用renew()显式续，到期就会被回收
+
+    metrics不为None时报告等待时间、持有时间、每次获取访问redis的次数、抢输了的唤醒和排队深度，
+    见redislocks.metrics.LockMetrics，默认不计时也不计数
+
+    stats=True时脚本顺便在"RWLOCK:STATS"里累加这个namespace的竞争统计，
+    所有进程汇总在一起，用python -m redislocks stats查看，见redislocks.stats
+    """
 
     def __init__(
         self,
         client: Optional[Redis] = None,
         namespace: str = "RWLOCK",
         blocking: bool = True,
+        notify: Optional[Literal["keyspace", "publish"]] = None,
+        coalesce_reads: bool = False,
+        lease_timeout: Optional[float] = None,
+        hash_tag: Optional[bool] = None,
+        metrics: Optional[LockMetrics] = None,
+        stats: bool = False,
+        priority_aging: Optional[float] = None,
+        auto_renew: bool = True,
     ):
         self.client = client or Redis()
         self.namespace = namespace
         self.blocking = blocking
+        self.metrics = metrics
+        self.stats = stats
+        self._timing = metrics is not None or stats  # 要不要记录等待和持有时间
+        if hash_tag is None:
+            hash_tag = isinstance(self.client, RedisCluster)
+        self.hash_tag = hash_tag
+        if notify is None:
+            # 集群的keyspace事件只在key所在的节点上发，收不全；MemoryBackend这样的后端没有keyspace事件
+            notify = (
+                "publish"
+                if isinstance(self.client, RedisCluster)
+                or not getattr(self.client, "keyspace_events", True)
+                else "keyspace"
+            )
+        if notify not in ("keyspace", "publish"):
+            raise ValueError("notify must be 'keyspace' or 'publish'")
+        self.notify = notify
+        self.coalesce_reads = coalesce_reads
+        if lease_timeout is not None and lease_timeout <= 0:
+            raise ValueError("lease_timeout must be > 0")
+        self.lease_timeout = lease_timeout
+        self._lease_ms = "" if lease_timeout is None else int(lease_timeout * 1000)
+        self.priority_aging = priority_aging
+        self._priority_step = priority_step(priority_aging)
 
-        self.check_exists_key = self.get_namespaced_key("EXISTS")  # RWLOCK:EXISTS
         self.read_key = self.get_namespaced_key("READ")
         self.write_key = self.get_namespaced_key("WRITE")
         self.write_waiter_key = self.get_namespaced_key("WRITEWAITER")
+        self.upgrader_key = self.get_namespaced_key("UPGRADER")
+        self.lease_key = self.get_namespaced_key("LEASES")
+        self.stats_key = self.get_namespaced_key("STATS")
+        # 脚本用到的key全部从KEYS传进去，集群模式下才能路由到正确的slot
+        self._keys = [
+            self.read_key,
+            self.write_key,
+            self.write_waiter_key,
+            self.lease_key,
+        ]
+        if stats:  # 打开统计的时候脚本最后多一个key
+            self._keys.append(self.stats_key)
+        self._upgrade_keys = [*self._keys[:4], self.upgrader_key, *self._keys[4:]]
 
         self._read_waiters = []  # type: List[asyncio.Future]
-        self._write_waiters = {}  # type: Dict[float, asyncio.Future]
-
-        self._lockread_script = self.client.register_script(
-            lockread_script
-        )  # todo lockread.lua
-        self._unlockread_script = self.client.register_script(
-            unlockread_script
-        )  # todo unlockread.lua
-        # self._checkcanread_script = self.client.register_script(
-        #     """"""
-        # )  #  checkcanread.lua
-        # self._checkcanwrite_script = self.client.register_script(
-        #     """"""
-        # )  #  checkcanwrite.lua
-        self._lockwrite_nowait_script = self.client.register_script(
-            lockwrite_nowait_script
-        )  # todo lockwrite_nowait.lua
-        self._unlockwrite_script = self.client.register_script(
-            unlockwrite_script
-        )  # todo unlockwrite.lua
-        self._get_state_script = self.client.register_script(get_state_script)
+        self._read_epoch = 0  # 写锁每被删除一次加一
+        self._granting = False  # 是否有批量发放读锁的task在跑
+        self._write_waiters = {}  # type: Dict[str, asyncio.Future]
+        # lockwrite.lua返回之前就被轮到的token，等acquire注册好future再认领
+        self._enqueuing = 0
+        self._handoffs = set()  # type: Set[str]
+        # coalesce_reads用，token -> 本地有几个读者在用它
+        self._shared_counts = {}  # type: Dict[str, int]
+        self._shared_token = None  # type: Optional[str] 新读者还可以搭车的token
+        self._shared_lock = None  # type: Optional[asyncio.Lock]
+        self._wait_epoch = 0  # 每收到一次"wait"加一
+
+        # 脚本由client共享，第一次调用的时候加载一次，这里只是拿引用
+        library = get_library(self.client)
+        self._lockread_script = library["lockread"]  # lockread.lua
+        self._unlockread_script = library["unlockread"]  # unlockread.lua
+        self._lockwrite_nowait_script = library[
+            "lockwrite_nowait"
+        ]  # lockwrite_nowait.lua
+        self._lockwrite_script = library["lockwrite"]  # lockwrite.lua
+        self._cancelwrite_script = library["cancelwrite"]  # cancelwrite.lua
+        self._unlockwrite_script = library["unlockwrite"]  # unlockwrite.lua
+        self._upgrade_script = library["upgrade"]  # upgrade.lua
+        self._downgrade_script = library["downgrade"]  # downgrade.lua
+        self._get_state_script = library["get_state"]  # get_state.lua
+        self._lease_script = library["lease"]  # lease.lua
+        if metrics is not None:
+            instrument_scripts(self)
+        # token -> (等了多久, 拿到的时间)，metrics和stats用
+        self._held_since = {}  # type: Dict[str, Tuple[float, float]]
+        self.auto_renew = auto_renew
+        self._watchdog = (
+            get_watchdog(self.client)
+            if lease_timeout is not None and auto_renew
+            else None
+        )
         self._local_readtokens = []  # type: List[str]
         self._local_writetoken = None  # type: Optional[str]
-        self._listen_task = asyncio.create_task(self._listen_events())
 
-    def __del__(self):
-        self._listen_task.cancel()
-        # try:
-        #     await self._listen_task
-        # except asyncio.CancelledError:
-        #     pass
-        self._listen_task = None
+        # 同一个client的所有锁共用一个pubsub连接
+        self._dispatcher = get_dispatcher(self.client)
+        self._keyspace_channel = ensure_bytes(
+            f"__keyspace@{self._get_db()}__:{self.write_key}"
+        )
+        self._event_channel = ensure_bytes(self.get_namespaced_key("EVENTS"))
+        if notify == "keyspace":
+            self._channels = (self._keyspace_channel, self._event_channel)
+        else:
+            self._channels = (self._event_channel,)
+        self._wakeup_tasks = set()  # type: Set[asyncio.Task]
 
-    async def _exists_or_init(self) -> None:
-        # await self.client.config_set("notify-keyspace-events", "Ag$lshzxeKEtmdn") todo 需要修改配置吗
-        await self.client.setnx(self.check_exists_key, self.exists_val)
+    def __del__(self):
+        dispatcher = getattr(self, "_dispatcher", None)
+        if dispatcher is not None:
+            for channel in self._channels:
+                dispatcher.unsubscribe(channel, self)
 
     async def reset(self):
-        await self.client.delete(self.read_key, self.write_key, self.write_waiter_key)
+        async with self.client.pipeline() as pipe:
+            pipe.delete(
+                self.read_key,
+                self.write_key,
+                self.write_waiter_key,
+                self.upgrader_key,
+                self.lease_key,
+            )
+            await pipe.execute()
+        # 写锁可能本来就不存在，keyspace模式的锁也要被唤醒，集群的pipeline里不能publish
+        await self.client.publish(self._event_channel, "open")
 
     async def release_all(self):
         for _ in range(len(self._local_readtokens)):
@@ -101,71 +206,245 @@ class RWLock:
             await self.release("w")
 
     def _get_db(self) -> int:
-        return self.client.get_connection_kwargs()["db"]
+        return self.client.get_connection_kwargs().get("db", 0)
 
-    async def acquire(self, mode: Literal["r", "w"] = "r") -> str:
-        await self._exists_or_init()
+    async def acquire(self, mode: Literal["r", "w"] = "r", priority: int = 0) -> str:
+        """priority只对写锁有用，排队的时候大的先轮到"""
+        if mode == "r" and priority:
+            raise ValueError("priority only applies to mode 'w'")
+        if not self._timing:
+            return await self._acquire(mode, priority)
+        return await self._timed(mode, self._acquire(mode, priority))
+
+    async def _timed(self, mode: Literal["r", "w"], coro) -> str:
+        """等coro拿到锁，记下等了多久和什么时候拿到的"""
+        start = time.monotonic()
+        if self.metrics is None:
+            token = await coro
+        else:
+            token = await measure_acquire(self.metrics, self, mode, coro)
+        now = time.monotonic()
+        self._held_since.setdefault(token, (now - start, now))  # 合并的读锁从第一个读者算起
+        return token
+
+    async def _acquire(self, mode: Literal["r", "w"], priority: int = 0) -> str:
+        if self.blocking or (
+            mode == "r" and self.coalesce_reads
+        ):  # 先订阅再尝试加锁，不然可能漏掉中间的事件
+            for channel in self._channels:
+                await self._dispatcher.subscribe(channel, self)
         if mode == "r":
-            if (token := await self._lockread_script([self.namespace])) == 0:  # 加锁失败
-                if self.blocking:  # 阻塞模式，开始等self._read_waiters
-                    waiter = asyncio.get_running_loop().create_future()
-                    self._read_waiters.append(waiter)
-                    try:
-                        await waiter  # todo 添加asyncio.wait_for 就可以超时了
-                    finally:
-                        self._read_waiters.remove(waiter)
-                    return await self.acquire(mode)
-                else:
-                    raise NotAvailable
-            else:
-                token = ensure_str(token)
-                self._local_readtokens.append(token)
-                return token
+            if self.coalesce_reads:
+                return await self._acquire_shared_read()
+            return await self._acquire_read()
         elif mode == "w":
-            if token := await self._lockwrite_nowait_script(
-                [self.namespace]
-            ):  # 可以立刻非阻塞获取写锁 str, bytes
-                self._local_writetoken = ensure_str(token)
-                return token  # type: ignore
             if not self.blocking:
+                if token := await self._lockwrite_nowait_script(
+                    self._keys, [self._event_channel, self._lease_ms]
+                ):  # 可以立刻非阻塞获取写锁 str, bytes
+                    self._local_writetoken = ensure_str(token)
+                    self._watch()
+                    return self._local_writetoken
                 raise NotAvailable
-            else:
-                token: str = await self.current_time  # type: ignore
-                # 这下只能等了
-                await self.client.rpush(self.write_waiter_key, token)  # type: ignore
-                waiter = asyncio.get_running_loop().create_future()
-                self._write_waiters[token] = waiter
-                try:
-                    await waiter  # 一旦取消，则writewaiter里面还是有token，但是本地的token却再也没机会得到她了
-                except asyncio.CancelledError:
-                    await self.client.lrem(
-                        self.write_waiter_key, 1, token
-                    )  # type: ignore
-                    # 因此需要删除等待写锁队列里面的token
-                    raise
-                finally:
-                    del self._write_waiters[token]
-                self._local_writetoken = token
-                return token
+            # 要么直接拿到写锁，要么原子地排进WRITEWAITER
+            token, granted = await self._write_or_enqueue(
+                self._lockwrite_script,
+                self._keys,
+                [self._lease_ms, *priority_args(priority, self._priority_step)],
+            )
+            if not granted:  # 这下只能等了
+                await self._wait_write(token)
+            self._local_writetoken = token
+            self._watch()
+            return token
         else:
             raise ValueError("mode must be 'r' or 'w'")
 
+    async def _write_or_enqueue(self, script, keys: list, args: list):
+        """
+        跑lockwrite.lua或者upgrade.lua，返回(token, granted)
+        granted为0表示排进了WRITEWAITER，在脚本返回之前被轮到也不会漏掉
+        """
+        self._enqueuing += 1
+        try:
+            # lockwrite.lua排队的时候还会返回前面有几个写者
+            token, granted, *ahead = await script(keys, [self._event_channel, *args])
+            token = ensure_str(token)
+            if granted == 0:
+                if self.metrics is not None:
+                    self.metrics.enqueued(self, "w", ahead[0] if ahead else 0)
+                waiter = asyncio.get_running_loop().create_future()
+                if token in self._handoffs:  # 脚本返回之前就已经轮到了
+                    waiter.set_result(None)
+                self._write_waiters[token] = waiter
+        finally:
+            self._enqueuing -= 1
+            if not self._enqueuing:
+                self._handoffs.clear()
+        self._watch()  # 排队的时候也要续租
+        return token, granted
+
+    async def _wait_write(self, token: str) -> None:
+        try:
+            await self._write_waiters[token]
+        except asyncio.CancelledError:
+            # 删除等待写锁队列里面的token，已经被轮到的话就顺手释放掉
+            await self._cancelwrite_script(self._keys, [self._event_channel, token])
+            raise
+        finally:
+            del self._write_waiters[token]
+
+    async def upgrade(self) -> str:
+        """
+        把最近获取的读锁原子地升级成写锁，中间不会有别的写锁插进来
+        只剩自己在读的话立刻拿到写锁，排队的写者也要让它先。否则读锁放掉，
+        排到WRITEWAITER最前面等别的读者走完
+        已经有别的读者在等升级的话，两个人会互相等对方的读锁，后来的抛NotAvailable，读锁还在
+        非阻塞模式下不能立刻升级也抛NotAvailable
+        取消等待的话读锁和写锁都没有了
+        """
+        if not self._timing:
+            return await self._upgrade()
+        read_token = self._local_readtokens[-1] if self._local_readtokens else None
+        try:
+            return await self._timed("w", self._upgrade())
+        finally:
+            if read_token not in self._local_readtokens:  # 读锁已经放掉了
+                self._finish_hold("r", read_token)
+
+    async def _upgrade(self) -> str:
+        if not self._local_readtokens:
+            raise ValueError("can not upgrade without a read lock")
+        read_token = self._local_readtokens[-1]
+        if self.coalesce_reads and self._shared_counts[read_token] > 1:
+            raise ValueError("can not upgrade a read lock shared with other readers")
+        if self.blocking:
+            for channel in self._channels:
+                await self._dispatcher.subscribe(channel, self)
+        token, granted = await self._write_or_enqueue(
+            self._upgrade_script,
+            self._upgrade_keys,
+            [read_token, self._lease_ms, "" if self.blocking else 1],
+        )
+        if granted == -1:
+            raise ValueError("No lock is upgraded. Is redis changed?")
+        if granted < 0:
+            raise NotAvailable
+        # 读锁已经在redis里放掉了
+        self._local_readtokens.remove(read_token)
+        if self.coalesce_reads:
+            del self._shared_counts[read_token]
+            if read_token == self._shared_token:
+                self._shared_token = None
+        if not granted:
+            await self._wait_write(token)
+        self._local_writetoken = token
+        self._watch()
+        return token
+
+    async def downgrade(self) -> str:
+        """把持有的写锁原子地降级成读锁，没有写者在排队的话等着的读者也可以一起进来了"""
+        if self._local_writetoken is None:
+            raise ValueError("can not downgrade write lock without acquire it")
+        token = await self._downgrade_script(
+            self._keys, [self._event_channel, self._local_writetoken, self._lease_ms]
+        )
+        if not token:
+            raise ValueError("can not downgrade write lock without acquire it")
+        token = ensure_str(token)
+        if self._timing:
+            self._finish_hold("w", self._local_writetoken)
+            self._held_since[token] = (0.0, time.monotonic())
+        self._local_writetoken = None
+        if self.coalesce_reads:
+            self._shared_counts[token] = 1
+        self._local_readtokens.append(token)
+        self._watch()
+        return token
+
+    async def _acquire_read(self) -> str:
+        woken = False  # 是不是因为写锁被删了在重试，重试的时候不再记contended
+        while True:
+            epoch = self._read_epoch
+            if (
+                token := await self._lockread_script(
+                    self._keys,
+                    [self._event_channel, "", self._lease_ms, 1 if woken else ""],
+                )
+            ) != 0:  # 加锁成功
+                break
+            if not self.blocking:
+                raise NotAvailable
+            if woken and self.metrics is not None:
+                self.metrics.lost_wakeup(self, "r")
+            if epoch != self._read_epoch:  # 加锁失败的途中写锁已经被删了，直接重试
+                woken = True
+                continue
+            # 阻塞模式，开始等self._read_waiters，_grant_readers会直接把token发过来
+            waiter = asyncio.get_running_loop().create_future()
+            if self.metrics is not None:
+                self.metrics.enqueued(self, "r", len(self._read_waiters))
+            self._read_waiters.append(waiter)
+            self._watch()  # 等的时候也要帮忙回收过期的写锁
+            try:
+                token = await waiter  # todo 添加asyncio.wait_for 就可以超时了
+            finally:
+                self._read_waiters.remove(waiter)
+            break
+        token = ensure_str(token)
+        self._local_readtokens.append(token)
+        self._watch()
+        return token
+
+    async def _acquire_shared_read(self) -> str:
+        """本地已经有可以搭车的读锁就只加引用计数，不用访问redis"""
+        if self._shared_lock is None:
+            self._shared_lock = asyncio.Lock()
+        async with self._shared_lock:  # 同时来的读者只让一个去redis拿
+            token = self._shared_token
+            if token is None:
+                epoch = self._wait_epoch
+                token = await self._acquire_read()
+                self._local_readtokens.pop()
+                self._shared_counts[token] = 0
+                if epoch == self._wait_epoch:  # 拿锁途中有写锁排队的话就不给别人搭车了
+                    self._shared_token = token
+            self._shared_counts[token] += 1
+            self._local_readtokens.append(token)
+            return token
+
     async def release(self, mode: Literal["r", "w"] = "r"):
         if mode == "r":
             try:
                 token = self._local_readtokens.pop()
             except IndexError:  # 空list？
                 raise ValueError("can not release more than acquire")
+            if self.coalesce_reads:
+                count = self._shared_counts[token] - 1
+                if count:  # 还有别的本地读者在用
+                    self._shared_counts[token] = count
+                    return
+                del self._shared_counts[token]
+                if token == self._shared_token:
+                    self._shared_token = None
+            args = [self._event_channel, token]
+            if self._timing:
+                args += self._finish_hold("r", token)
             if not await self._unlockread_script(
-                [self.namespace, token]
+                self._keys, args
             ):  # 什么都没srem出来，本地token有问题还是云端释放了？
                 raise ValueError("No lock is released. Is redis changed?")
         elif mode == "w":
-            if self._local_writetoken is None:
-                raise ValueError("can not release write lock without acquire it")
-            if not await self._unlockwrite_script([self.namespace]):
+            token = self._local_writetoken
+            if token is None:
                 raise ValueError("can not release write lock without acquire it")
+            # 和读锁一样先从本地拿掉，租约过期被回收了的话本地也不再留着
             self._local_writetoken = None
+            args = [self._event_channel, token]
+            if self._timing:
+                args += self._finish_hold("w", token)
+            if not await self._unlockwrite_script(self._keys, args):
+                raise ValueError("can not release write lock without acquire it")
         else:
             raise ValueError("mode must be 'r' or 'w'")
 
@@ -186,11 +465,11 @@ class RWLock:
                 return False
 
     async def get_state(self) -> int:
-        return await self._get_state_script([self.namespace])
+        return await self._get_state_script(self._keys)
 
     async def locked(self, mode: Literal["r", "w"] = "r") -> bool:
         """如果锁不能立刻获取返回True"""
-        current_state = await self._get_state_script([self.namespace])
+        current_state = await self._get_state_script(self._keys)
         if mode == "r":
             if current_state in (2, 3):
                 return True
@@ -219,52 +498,127 @@ class RWLock:
         return ".".join(map(str, await self.client.time()))
 
     def get_namespaced_key(self, suffix):
-        return "{0}:{1}".format(self.namespace, suffix)
+        return namespaced_key(self.namespace, suffix, self.hash_tag)
 
-    async def _listen_events(self):
+    def _handle_event(self, channel: bytes, data: bytes) -> None:
         """
-        监听redis中的key变动 从而知道什么时候可以获取锁
+        由dispatcher调用，写锁key上的keyspace事件或者EVENTS上脚本发布的消息
         :return:
         """
+        if channel == self._event_channel and data.startswith(b"set:"):
+            # 被释放的老 读锁/写锁 唤醒了新写锁，对应token的写锁不用等了，如果这个client有的话
+            self._wakeup_writer(data[4:].decode())
+        elif data == b"wait":  # 有写锁在排队，写锁优先，新读者不能再搭车了
+            self._wait_epoch += 1
+            self._shared_token = None
+        elif data == b"reconnect":
+            # dispatcher断线重连了，期间的事件可能丢了，不再搭车，读者重试，看写锁是不是已经轮给了自己
+            self._wait_epoch += 1
+            self._shared_token = None
+            self._read_epoch += 1
+            if self._read_waiters and not self._granting:
+                self._granting = True
+                self._spawn(self._grant_readers())
+            if self._write_waiters:
+                self._spawn(self._recheck_writers())
+        elif data == b"open" or (
+            data == b"del"
+            and (self.notify == "publish" or channel == self._keyspace_channel)
+        ):  # 写锁被删除了或者挡路的写锁等待者没了，现在可以读了
+            self._read_epoch += 1
+            if self._read_waiters and not self._granting:
+                self._granting = True
+                self._spawn(self._grant_readers())
 
-        # todo 现在只有加读锁的逻辑，因此只能监听写锁有关的几个key，未来为了加写锁还得监听读锁的几个key
-        # async def check_canread() -> bool:
-        #     """
-        #     判断是否可以加读锁 todo 这个函数抽空换成lua
-        #     :return:
-        #     """
-        #     if await self._checkcanread_script([self.namespace]):
-        #         return True
-        #     return False
-        # if (
-        #     await self.client.llen(self.write_waiter_key)
-        # ) == 0 and not await self.client.exists(self.write_key):
-        #     return True
-        # return False
-
-        async with self.client.pubsub() as pubsub:
-            await pubsub.subscribe(
-                f"__keyspace@{self._get_db()}__:{self.write_key}",
-            )
-            async for event in pubsub.listen():
-                # print(event)
-                if (
-                    ensure_str(event["type"]) == "message"
-                    and ensure_str(event["channel"])
-                    == f"__keyspace@{self._get_db()}__:{self.write_key}"
-                    and ensure_str(event["data"]) == "del"
-                ):  # 写锁被删除了，现在可以读了
-                    for waiter in self._read_waiters:
-                        waiter.set_result(None)
-                if (
-                    ensure_str(event["type"]) == "message"
-                    and ensure_str(event["channel"])
-                    == f"__keyspace@{self._get_db()}__:{self.write_key}"
-                    and ensure_str(event["data"]) == "set"
-                ):  # 被释放的老 读锁/写锁 唤醒了新写锁，对应token的写锁不用等了，如果这个client有的话
-                    token = ensure_str(
-                        await self.client.get(self.write_key)
-                    )  # 轮到哪个幸运儿上了
-                    if token in self._write_waiters:
-                        waiter = self._write_waiters[token]
-                        waiter.set_result(None)
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._wakeup_tasks.add(task)
+        task.add_done_callback(self._wakeup_tasks.discard)
+
+    async def _grant_readers(self):
+        """
+        一次lockread.lua给本地全部等待的读者发token，而不是每个读者各自重试一遍
+        """
+        try:
+            while True:
+                waiters = [waiter for waiter in self._read_waiters if not waiter.done()]
+                if not waiters:
+                    break
+                epoch = self._read_epoch
+                # 等待者第一次失败的时候已经记过contended了，这里不再记
+                tokens = await self._lockread_script(
+                    self._keys, [self._event_channel, len(waiters), self._lease_ms, 1]
+                )
+                if not tokens:  # 写锁又抢先了，等下一次del
+                    if self.metrics is not None:
+                        for _ in waiters:
+                            self.metrics.lost_wakeup(self, "r")
+                    if epoch == self._read_epoch:
+                        break
+                    continue  # 途中又有del，那次没有再启动发放，这里补上
+                for waiter, token in zip(waiters, tokens):
+                    if waiter.done():  # 等的人已经取消了，token还回去
+                        await self._unlockread_script(
+                            self._keys, [self._event_channel, ensure_str(token)]
+                        )
+                    else:
+                        waiter.set_result(token)
+        finally:
+            self._granting = False
+
+    async def _recheck_writers(self) -> None:
+        """漏掉的set:<token>，写锁已经是本地某个等待者的了就叫醒它"""
+        token = await self.client.get(self.write_key)
+        if token is not None:
+            self._wakeup_writer(ensure_str(token))
+
+    def _wakeup_writer(self, token: str) -> None:
+        waiter = self._write_waiters.get(token)
+        if waiter is None:
+            if self._enqueuing:  # 可能是还没来得及注册的
+                self._handoffs.add(token)
+        elif not waiter.done():
+            waiter.set_result(None)
+
+    def _finish_hold(self, mode: Literal["r", "w"], token: Optional[str]) -> list:
+        """token要被释放了，报告持有时间，返回解锁脚本统计用的[wait_ms, hold_ms]"""
+        timing = self._held_since.pop(token, None)
+        if timing is None:
+            return ["", ""] if self.stats else []
+        wait, since = timing
+        hold = time.monotonic() - since
+        if self.metrics is not None:
+            self.metrics.released(self, mode, hold)
+        return [int(wait * 1000), int(hold * 1000)] if self.stats else []
+
+    def _watch(self) -> None:
+        if self._watchdog is not None:
+            self._watchdog.watch(self)
+
+    def _lease_active(self) -> bool:
+        """有token要续租或者有人在等，watchdog就要接着跑"""
+        return bool(
+            self._local_readtokens
+            or self._local_writetoken
+            or self._write_waiters
+            or self._read_waiters
+        )
+
+    async def renew(self) -> int:
+        """给本地的token续租，返回续上的个数，auto_renew=False的时候自己调用"""
+        if self.lease_timeout is None:
+            raise ValueError("lease_timeout is not set")
+        return await self._renew_lease(self.client)
+
+    async def _renew_lease(self, client):
+        """
+        client是watchdog的pipeline或者集群client，没有token的时候只回收别人过期的租约
+        不是pipeline的话返回续上的token个数
+        """
+        tokens = set(self._local_readtokens)
+        tokens.update(self._write_waiters)
+        if self._local_writetoken is not None:
+            tokens.add(self._local_writetoken)
+        return await self._lease_script(
+            self._keys, [self._event_channel, self._lease_ms, *tokens], client=client
+        )
@@ -1,27 +1,97 @@
 """
 Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
 """
+import hashlib
 from pathlib import Path
+from typing import Dict
 
 _current_dir = Path(__file__).resolve().parent
 
-with open(_current_dir / "lockread.lua", encoding="utf-8") as lockread_f:
-    lockread_script = lockread_f.read()
 
-with open(_current_dir / "unlockread.lua", encoding="utf-8") as unlockread_f:
-    unlockread_script = unlockread_f.read()
+def _read(name: str) -> str:
+    with open(_current_dir / f"{name}.lua", encoding="utf-8") as f:
+        return f.read()
 
-# with open(_current_dir / "checkcanread.lua", encoding="utf-8") as checkcanread_f:
-#     checkcanread_script = checkcanread_f.read()
 
-with open(
-    _current_dir / "lockwrite_nowait.lua", encoding="utf-8"
-) as lockwrite_nowait_f:
-    lockwrite_nowait_script = lockwrite_nowait_f.read()
+# 各个脚本共用的get_state, reap和统计
+common_script = _read("common")
 
-with open(_current_dir / "unlockwrite.lua", encoding="utf-8") as unlockwrite_f:
-    unlockwrite_script = unlockwrite_f.read()
+_RWLOCK_SCRIPTS = (
+    "lockread",
+    "unlockread",
+    "lockwrite_nowait",
+    "lockwrite",
+    "cancelwrite",
+    "unlockwrite",
+    "upgrade",
+    "downgrade",
+    "get_state",
+    "lease",
+    "multilock",
+    "multiunlock",
+    "multicancel",
+)
+_SEMAPHORE_SCRIPTS = (
+    "semacquire",
+    "semgrab",
+    "semrelease",
+    "semacquire_counter",
+    "semrelease_counter",
+    "semreap",
+    "semacquire_striped",
+    "semfair",
+    "semfair_release",
+    "semfair_cancel",
+)
+# 用到common.lua的脚本
+_COMMON_SCRIPTS = frozenset(
+    (
+        *_RWLOCK_SCRIPTS,
+        "semacquire",
+        "semrelease",
+        "semacquire_counter",
+        "semrelease_counter",
+        "semreap",
+        "semacquire_striped",
+        "semfair",
+        "semfair_release",
+        "semfair_cancel",
+    )
+)
+# 只读的脚本，FUNCTION库里带上no-writes，可以在从库上FCALL_RO
+READONLY_SCRIPTS = frozenset(("get_state",))
 
+# 脚本名 -> 脚本本身，函数库里一个脚本就是一个函数
+script_bodies = {}  # type: Dict[str, str]
+for _name in _RWLOCK_SCRIPTS + _SEMAPHORE_SCRIPTS:
+    script_bodies[_name] = _read(_name)
 
-with open(_current_dir / "get_state.lua", encoding="utf-8") as get_state_f:
-    get_state_script = get_state_f.read()
+# 脚本名 -> EVAL用的完整脚本，common.lua拼在前面
+scripts = {
+    name: f"{common_script}\n{body}" if name in _COMMON_SCRIPTS else body
+    for name, body in script_bodies.items()
+}  # type: Dict[str, str]
+script_shas = {
+    name: hashlib.sha1(source.encode("utf-8")).hexdigest()
+    for name, source in scripts.items()
+}  # type: Dict[str, str]
+
+
+def _build_library():
+    # 名字里带上内容的hash，不同版本的库可以同时存在，不用REPLACE别人正在用的
+    digest = hashlib.sha1(
+        "\n".join((common_script, *script_bodies.values())).encode("utf-8")
+    ).hexdigest()[:12]
+    prefix = f"redislocks_{digest}_"
+    parts = [f"#!lua name=redislocks_{digest}", common_script]
+    for name, body in script_bodies.items():
+        flags = '"no-writes"' if name in READONLY_SCRIPTS else ""
+        parts.append(
+            f'redis.register_function{{function_name = "{prefix}{name}", '
+            f"flags = {{{flags}}}, callback = function(KEYS, ARGV)\n{body}\nend}}"
+        )
+    return "\n".join(parts), prefix
+
+
+# FUNCTION LOAD用的库，函数名是function_prefix + 脚本名
+library_code, function_prefix = _build_library()
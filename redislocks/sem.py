@@ -3,20 +3,71 @@
 Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
 """
 import asyncio
+import time
+import uuid
+from collections import deque
 
 # __version_info__ = ("0", "2", "2")
-from typing import Awaitable, Callable, List, Optional, Union
+from typing import (
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
-from redis.asyncio import Redis
+from redis.asyncio import Redis, RedisCluster
+from redis.exceptions import RedisError
 
+from redislocks.dispatcher import get_dispatcher
 from redislocks.exceptions import NotAvailable
+from redislocks.library import get_library
+from redislocks.metrics import (
+    LockMetrics,
+    count_round_trip,
+    instrument_scripts,
+    measure_acquire,
+)
+from redislocks.utils import ensure_bytes, namespaced_key
 
 
 class Semaphore:
     """
     Redis中可能存在的key: Namespace:AVAILABLE list 存放全部可用的token，有self.value个
-    Namespace:GRABBED hash[str, float] token and acquire_time pair, 表示这些token正在被使用
+    Namespace:GRABBED zset[str, float] token and acquire_time pair, 表示这些token正在被使用，按获取时间排序
     Namespace:EXISTS str, 表示这个锁已经存在
+    Namespace:EVENTS channel, 有token被放回去的时候发布"release"
+    Namespace:PENDING list, notify="blpop"时BLMOVE从AVAILABLE挪过来、还没记进GRABBED的token，
+                  拿它的进程在中间挂了的话，回收超时token的时候当作那一刻被拿走
+
+    layout="counter"时不存在AVAILABLE和EXISTS，GRABBED的长度就是已经被获取的个数
+    Namespace:SEQ int, 用来生成token的递增序号
+    初始化，获取和释放都是O(1)，和value无关，适合value特别大的信号量
+
+    notify="blpop"时每个阻塞的acquire各自BLMOVE，各占一个连接
+    notify="publish"时等待者在本地排队，共用client的pubsub连接监听EVENTS，
+    有token放回来的时候由一个task替排在最前面的等待者去拿
+    layout="counter"没有list可以BLPOP，只能用publish，notify默认跟着layout走
+
+    fair=True时拿不到的等待者在redis里排队，release的脚本按先来后到把token直接交给队首，
+    不会有人一直抢不到，有人在排队的时候新来的(包括非阻塞的)也不能插队
+    Namespace:QUEUE list 排队的票
+    Namespace:TICKETS zset[票, 过期时间ms]，等待者每ticket_timeout/3秒续期一次，进程挂了的票会被清掉
+    Namespace:GRANTS hash[票, token]，已经交给票但是等待者还没收到消息的token
+    公平模式只能用notify="publish"，同一个namespace的所有Semaphore都要打开fair
+
+    hash_tag=True时key是"{SEMAPHORE}:AVAILABLE"这样，同一个namespace的key都在同一个slot，
+    client是RedisCluster的时候默认打开
+
+    metrics不为None时报告等待时间、持有时间、每次获取访问redis的次数、抢输了的唤醒和排队深度，
+    见redislocks.metrics.LockMetrics，默认不计时也不计数
+
+    stats=True时脚本顺便在Namespace:STATS里累加竞争统计，见redislocks.stats
     """
 
     exists_val = "ok"
@@ -28,31 +79,124 @@ class Semaphore:
         namespace: str = "SEMAPHORE",  # 区分不同的锁
         stale_client_timeout: Optional[float] = None,
         blocking: bool = True,
+        notify: Optional[Literal["blpop", "publish"]] = None,
+        layout: Literal["list", "counter"] = "list",
+        hash_tag: Optional[bool] = None,
+        metrics: Optional[LockMetrics] = None,
+        stats: bool = False,
+        fair: bool = False,
+        ticket_timeout: float = 10,
     ):
         self.client = client or Redis()
+        if hash_tag is None:
+            hash_tag = isinstance(self.client, RedisCluster)
+        self.hash_tag = hash_tag
         if value < 1:
             raise ValueError("Semaphore initial value must be >= 0")
+        if layout not in ("list", "counter"):
+            raise ValueError("layout must be 'list' or 'counter'")
+        if notify is None:
+            notify = "blpop" if layout == "list" and not fair else "publish"
+        if notify not in ("blpop", "publish"):
+            raise ValueError("notify must be 'blpop' or 'publish'")
+        if layout == "counter" and notify == "blpop":
+            raise ValueError("counter layout can only be used with notify='publish'")
+        if fair and notify == "blpop":
+            raise ValueError("fair mode can only be used with notify='publish'")
+        if ticket_timeout <= 0:
+            raise ValueError("ticket_timeout must be > 0")
         self.value = value
         self.namespace = namespace
         self.stale_client_timeout = stale_client_timeout
         self.is_use_local_time = False
         self.blocking = blocking
+        self.notify = notify
+        self.layout = layout
+        self.fair = fair
+        self.ticket_timeout = ticket_timeout
+        self._ticket_ms = int(ticket_timeout * 1000)
         self._local_tokens = list()  # type: List[Union[str, bytes]]
 
-    async def _exists_or_init(self):
-        old_key = await self.client.getset(self.check_exists_key, self.exists_val)
-        if old_key:
-            return False
-        return await self._init()
+        self._event_channel = ensure_bytes(self.get_namespaced_key("EVENTS"))
+        library = get_library(self.client)
+        if layout == "list":
+            self._acquire_script = library["semacquire"]  # semacquire.lua
+            self._acquire_keys = [
+                self.check_exists_key,
+                self.available_key,
+                self.grabbed_key,
+                self.pending_key,
+            ]
+            self._release_script = library["semrelease"]  # semrelease.lua
+            self._release_keys = [self.available_key, self.grabbed_key]
+            self._reap_keys = [self.grabbed_key, self.available_key, self.pending_key]
+        else:
+            self._acquire_script = library[
+                "semacquire_counter"
+            ]  # semacquire_counter.lua
+            self._acquire_keys = [self.grabbed_key, self.seq_key]
+            self._release_script = library[
+                "semrelease_counter"
+            ]  # semrelease_counter.lua
+            self._release_keys = [self.grabbed_key]
+            self._reap_keys = [self.grabbed_key]
+        self._release_args = [self._event_channel]
+        if fair:  # 获取和释放都换成公平模式的脚本，两种layout共用
+            self._acquire_script = library["semfair"]  # semfair.lua
+            self._acquire_keys = [
+                self.grabbed_key,
+                self.available_key,
+                self.seq_key,
+                self.check_exists_key,
+                self.queue_key,
+                self.tickets_key,
+                self.grants_key,
+            ]
+            self._release_script = library["semfair_release"]  # semfair_release.lua
+            self._release_keys = self._acquire_keys
+            self._cancel_script = library["semfair_cancel"]  # semfair_cancel.lua
+            self._release_args = [self.value, layout, self._event_channel]
+        self.stats = stats
+        if stats:  # 打开统计的时候获取和释放脚本最后多一个key
+            self._acquire_keys.append(self.stats_key)
+            if self._release_keys is not self._acquire_keys:
+                self._release_keys.append(self.stats_key)
+        self._grab_script = library["semgrab"]  # semgrab.lua
+        self._reap_script = library["semreap"]  # semreap.lua
+        self.metrics = metrics
+        if metrics is not None:
+            instrument_scripts(self)
+        self._timing = metrics is not None or stats  # 要不要记录等待和持有时间
+        # token -> (等了多久, 拿到的时间)，metrics和stats用
+        self._held_since = {}  # type: Dict[bytes, Tuple[float, float]]
+        self._blocked = 0  # 正在BLPOP的本地等待者
+
+        self._dispatcher = get_dispatcher(self.client)
+        self._waiters = deque()  # type: Deque[Tuple[asyncio.Future, int]]
+        self._release_epoch = 0  # 每收到一次release加一
+        self._granting = False
+        self._grant_tasks = set()  # type: Set[asyncio.Task]
+        self._tickets = {}  # type: Dict[bytes, asyncio.Future] 公平模式下本地在等的票
+
+    def __del__(self):
+        dispatcher = getattr(self, "_dispatcher", None)
+        if dispatcher is not None:
+            dispatcher.unsubscribe(self._event_channel, self)
 
     async def _init(self):
-        await self.client.expire(self.check_exists_key, 10)
-        async with self.client.pipeline() as pipe:
-            pipe.multi()
-            pipe.delete(self.grabbed_key, self.available_key)
-            pipe.rpush(self.available_key, *range(self.value))
+        async with self.client.pipeline(transaction=True) as pipe:  # MULTI，集群也支持同一个slot
+            if self.layout == "list":
+                pipe.delete(self.grabbed_key, self.available_key, self.pending_key)
+                pipe.rpush(self.available_key, *range(self.value))
+                pipe.set(self.check_exists_key, self.exists_val)
+            else:
+                pipe.delete(self.grabbed_key)
+            if self.fair:  # 排着的票也清掉，等待者续期的时候发现票没了会重新排队
+                pipe.delete(self.queue_key, self.tickets_key, self.grants_key)
             await pipe.execute()
-        await self.client.persist(self.check_exists_key)
+        await self.client.publish(
+            self._event_channel, "release"
+        )  # 集群的pipeline里不能publish
 
     async def release_all(self):
         for _ in range(len(self._local_tokens)):
@@ -60,6 +204,8 @@ class Semaphore:
 
     @property
     async def available_count(self):
+        if self.layout == "counter":
+            return self.value - await self.client.zcard(self.grabbed_key)
         return await self.client.llen(self.available_key)
 
     async def acquire(
@@ -67,22 +213,12 @@ class Semaphore:
         timeout: int = 0,
         target: Optional[Callable[[str], Union[None, Awaitable[None]]]] = None,
     ):
-        await self._exists_or_init()
-        if self.stale_client_timeout is not None:
-            await self.release_stale_locks()
-
-        if self.blocking:
-            pair = await self.client.blpop(self.available_key, timeout)  # type: ignore
-            if pair is None:
-                raise NotAvailable
-            token = pair[1]
+        if not self._timing:
+            token = await self._acquire(timeout)
         else:
-            token = await self.client.lpop(self.available_key)  # type: ignore
-            if token is None:
-                raise NotAvailable
+            token = (await self._timed(self._acquire(timeout), single=True))[0]
 
         self._local_tokens.append(token)
-        await self.client.hset(self.grabbed_key, token, await self.current_time)  # type: ignore
         if target is not None:
             try:
                 if asyncio.iscoroutinefunction(target):
@@ -93,23 +229,340 @@ class Semaphore:
                 await self.signal(token)
         return token
 
-    async def release_stale_locks(self, expires=10):
-        token = self.client.getset(self.check_release_locks_key, self.exists_val)
-        if token:
-            return False
-        await self.client.expire(self.check_release_locks_key, expires)
+    async def _acquire(self, timeout: float):
+        if self.fair:
+            return (await self._acquire_fair(1, timeout))[0]
+        if self.blocking and self.notify == "publish":  # 先订阅再尝试，不然可能漏掉中间的release
+            await self._dispatcher.subscribe(self._event_channel, self)
+
+        epoch = self._release_epoch
+        # 初始化，pop和记录获取时间在一次往返里完成
+        token = await self._try_acquire()
+        if token is None:
+            if not self.blocking:
+                raise NotAvailable
+            if self.notify == "publish":
+                token = (await self._wait_tokens(epoch, timeout, 1))[0]
+            else:
+                if self.metrics is not None:
+                    self.metrics.enqueued(self, None, self._blocked)
+                    count_round_trip()
+                self._blocked += 1
+                try:
+                    token = await self._blocking_pop(timeout)
+                finally:
+                    self._blocked -= 1
+                if token is None:
+                    raise NotAvailable
+        return token
+
+    async def _blocking_pop(self, timeout: float) -> Optional[bytes]:
+        """
+        BLMOVE把token从AVAILABLE挪进PENDING，semgrab.lua再挪进GRABBED，超时返回None
+        两步之间进程挂了或者连接断了的话token留在PENDING里，回收的时候不会丢
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout else None
+        while True:
+            remaining = 0 if deadline is None else deadline - loop.time()
+            if deadline is not None and remaining <= 0:
+                return None
+            token = await self.client.blmove(
+                self.available_key, self.pending_key, remaining, "LEFT", "RIGHT"
+            )  # type: ignore
+            if token is None:
+                return None
+            grab = asyncio.ensure_future(
+                self._grab_script([self.grabbed_key, self.pending_key], [token])
+            )
+            try:
+                if await asyncio.shield(grab):
+                    return token
+            except asyncio.CancelledError:
+                # token已经在自己手里了，等grab跑完还回去
+                task = asyncio.create_task(self._give_back(grab, token))
+                self._grant_tasks.add(task)
+                task.add_done_callback(self._grant_tasks.discard)
+                raise
+            # 停得太久，token已经被当作超时回收了，重新等
+
+    async def _give_back(self, grab: asyncio.Future, token: bytes) -> None:
+        """被取消的acquire已经拿到的token，记进GRABBED以后再放回去"""
         try:
-            for token, looked_at in (
-                await self.client.hgetall(self.grabbed_key)
-            ).items():
-                timed_out_at = float(looked_at) + self.stale_client_timeout
-                if timed_out_at < float(await self.current_time):
-                    await self.signal(token)
+            if await grab:
+                await self._signal_many([token])
+        except RedisError:  # 还在PENDING或者GRABBED里，等着被回收
+            pass
+
+    async def acquire_many(self, n: int, timeout: float = 0) -> List[bytes]:
+        """
+        原子地获取n个token，要么全部拿到要么一个都不拿，也就是权重为n的获取
+        阻塞的时候总是在本地排队等EVENTS，BLPOP没法一次原子地拿n个
+        拿到的token要一起用release_many释放
+        """
+        if not 1 <= n <= self.value:
+            raise ValueError("n must be between 1 and the semaphore value")
+        if not self._timing:
+            tokens = await self._acquire_many(n, timeout)
+        else:
+            tokens = await self._timed(self._acquire_many(n, timeout))
+        self._local_tokens.extend(tokens)
+        return tokens
+
+    async def _timed(self, coro, single: bool = False) -> list:
+        """等coro拿到token，记下每个token等了多久和什么时候拿到的"""
+        start = time.monotonic()
+        if self.metrics is None:
+            result = await coro
+        else:
+            result = await measure_acquire(self.metrics, self, None, coro)
+        tokens = [result] if single else result
+        now = time.monotonic()
+        for token in tokens:
+            self._held_since[ensure_bytes(token)] = (now - start, now)
+        return tokens
+
+    async def _acquire_many(self, n: int, timeout: float) -> List[bytes]:
+        if self.fair:
+            return await self._acquire_fair(n, timeout)
+        if self.blocking:
+            await self._dispatcher.subscribe(self._event_channel, self)
+
+        epoch = self._release_epoch
+        tokens = await self._try_acquire(n)
+        if tokens is None:
+            if not self.blocking:
+                raise NotAvailable
+            tokens = await self._wait_tokens(epoch, timeout, n)
+        return tokens
+
+    async def release_many(self, tokens: List[Union[str, bytes]]) -> int:
+        """一次释放多个token，返回真正被放回去的个数"""
+        for token in tokens:
+            try:
+                self._local_tokens.remove(token)
+            except ValueError:
+                pass
+        return await self._signal_many(tokens)
+
+    async def _try_acquire(self, n: Optional[int] = None, retry: bool = False):
+        """
+        n为None时返回一个token，否则返回n个token的列表，拿不到返回None
+        设置了stale_client_timeout的话脚本会顺便回收超时的token
+        retry为True表示替排队的等待者重试，第一次失败已经记过contended了，不再记
+        """
+        return await self._acquire_script(
+            self._acquire_keys,
+            [
+                self.value,
+                "" if n is None else n,
+                "" if self.stale_client_timeout is None else self.stale_client_timeout,
+                self._event_channel,
+                1 if retry else "",
+            ],
+        )
+
+    async def _wait_tokens(self, epoch: int, timeout: float, n: int) -> List[bytes]:
+        """在本地排队，等_grant_waiters把n个token送过来，等待期间不占用连接"""
+        waiter = asyncio.get_running_loop().create_future()
+        item = (waiter, n)
+        if self.metrics is not None:
+            self.metrics.enqueued(self, None, len(self._waiters))
+        self._waiters.append(item)
+        if epoch != self._release_epoch:  # 尝试的途中已经有token放回来了
+            self._start_grant()
+        try:
+            await asyncio.wait((waiter,), timeout=timeout or None)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():  # 已经拿到了，还回去
+                await self._signal_many(waiter.result())
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+            try:
+                self._waiters.remove(item)
+            except ValueError:  # 已经被_grant_waiters取走了
+                pass
+        if waiter.cancelled():  # 超时
+            raise NotAvailable
+        return waiter.result()
+
+    async def _acquire_fair(self, n: int, timeout: float) -> List[bytes]:
+        """公平模式，拿不到就在QUEUE里排队，等release的脚本把token交给自己的票"""
+        if not self.blocking:
+            result = await self._fair_acquire_script(n, "")
+            if not result:
+                raise NotAvailable
+            return result[1]
+        await self._dispatcher.subscribe(self._event_channel, self)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout else None
+        retry = False
+        while True:
+            # 票是自己生成的，先登记再排队，grant消息可能比脚本的返回先到
+            ticket = f"{uuid.uuid4().hex}/{n}"
+            waiter = loop.create_future()
+            self._tickets[ticket.encode()] = waiter
+            try:
+                status, payload = await self._fair_acquire_script(n, ticket, retry)
+                if status == 1:
+                    return payload
+                if self.metrics is not None:
+                    self.metrics.enqueued(self, None, payload)
+                tokens = await self._wait_ticket(ticket, waiter, deadline)
+            except asyncio.CancelledError:
+                tokens = await self._withdraw_ticket(ticket, waiter)
+                if tokens:  # 已经拿到了，还回去
+                    await self._signal_many(tokens)
+                raise
+            finally:
+                self._tickets.pop(ticket.encode(), None)
+                if waiter.done() and not waiter.cancelled():
+                    self._forget_ticket(ticket)
+            if tokens is not None:
+                return tokens
+            # 票过期被清掉了，比如事件循环卡住了没来得及续期，重新排队
+            retry = True
+
+    def _forget_ticket(self, ticket: str) -> None:
+        """
+        token是从grant消息里收到的，GRANTS和TICKETS里还留着这张票，在后台删掉，不耽误acquire返回
+        删失败了也没关系，票过期的时候会被清掉
+        """
+        task = asyncio.create_task(self._drop_ticket(ticket))
+        self._grant_tasks.add(task)
+        task.add_done_callback(self._grant_tasks.discard)
+
+    async def _drop_ticket(self, ticket: str) -> None:
+        try:
+            await self._cancel_script(
+                self._acquire_keys, [*self._release_args, ticket, ""]
+            )
+        except RedisError:
+            pass
+
+    async def _fair_acquire_script(self, n: int, ticket: str, retry: bool = False):
+        return await self._acquire_script(
+            self._acquire_keys,
+            [
+                *self._release_args,
+                n,
+                "" if self.stale_client_timeout is None else self.stale_client_timeout,
+                ticket,
+                self._ticket_ms,
+                1 if retry else "",
+            ],
+        )
+
+    async def _wait_ticket(
+        self, ticket: str, waiter: asyncio.Future, deadline: Optional[float]
+    ) -> Optional[List[bytes]]:
+        """
+        等token发到票上，每ticket_timeout/3秒续期一次，续期的时候发现漏了消息也能拿到token
+        超时抛NotAvailable，票已经不在了返回None
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            wait = self.ticket_timeout / 3
+            if deadline is not None:
+                wait = min(wait, deadline - loop.time())
+            await asyncio.wait((waiter,), timeout=max(wait, 0))
+            if waiter.done():
+                return waiter.result()
+            if deadline is not None and loop.time() >= deadline:
+                tokens = await self._withdraw_ticket(ticket, waiter)
+                if tokens:  # 撤销之前刚好轮到
+                    return tokens
+                raise NotAvailable
+            status, *payload = await self._cancel_script(
+                self._acquire_keys, [*self._release_args, ticket, self._ticket_ms]
+            )
+            if waiter.done():
+                return waiter.result()
+            if status == 1:
+                return payload[0]
+            if status == -1:
+                return None
+
+    async def _withdraw_ticket(
+        self, ticket: str, waiter: asyncio.Future
+    ) -> Optional[List[bytes]]:
+        """撤销排队，已经发到票上的token返回给调用者"""
+        if waiter.done() and not waiter.cancelled():
+            return waiter.result()
+        status, *payload = await self._cancel_script(
+            self._acquire_keys, [*self._release_args, ticket, ""]
+        )
+        if waiter.done() and not waiter.cancelled():
+            return waiter.result()
+        return payload[0] if status == 1 else None
+
+    def _handle_event(self, channel: bytes, data: bytes) -> None:
+        """由dispatcher调用，有token被放回来了"""
+        if self.fair:  # "grant:<票>:<token,token>"，token已经直接交给了这张票
+            if data.startswith(b"grant:"):
+                _, ticket, tokens = data.split(b":", 2)
+                waiter = self._tickets.get(ticket)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(tokens.split(b","))
+            return
+        self._release_epoch += 1
+        self._start_grant()
+
+    def _start_grant(self) -> None:
+        if self._waiters and not self._granting:
+            self._granting = True
+            task = asyncio.create_task(self._grant_waiters())
+            self._grant_tasks.add(task)
+            task.add_done_callback(self._grant_tasks.discard)
+
+    def _pop_done_waiters(self) -> None:
+        while self._waiters and self._waiters[0][0].done():
+            self._waiters.popleft()
+
+    async def _grant_waiters(self):
+        """
+        一个task替本地排队的等待者拿token，严格按先来后到交给队首
+        队首要的多就先等着，后面要的少的也不能插队，不然大请求会饿死
+        """
+        try:
+            while True:
+                self._pop_done_waiters()
+                if not self._waiters:
+                    break
+                epoch = self._release_epoch
+                tokens = await self._try_acquire(self._waiters[0][1], retry=True)
+                if tokens is None:
+                    if self.metrics is not None:  # 被release叫醒了却没拿到
+                        self.metrics.lost_wakeup(self, None)
+                    if epoch == self._release_epoch:
+                        break
+                    continue  # 途中又有release，那次没有再启动，这里补上
+                self._pop_done_waiters()
+                if self._waiters and self._waiters[0][1] == len(tokens):
+                    self._waiters.popleft()[0].set_result(tokens)
+                else:  # 等的人走了，还回去重新来
+                    await self._signal_many(tokens)
         finally:
-            await self.client.delete(self.check_release_locks_key)
+            self._granting = False
+
+    async def release_stale_locks(self, limit: int = 100) -> List[bytes]:
+        """
+        回收获取时间超过stale_client_timeout的token，一次最多limit个，返回被回收的token
+        acquire的时候脚本已经会顺便回收，这个是给想主动清理的人用的
+        """
+        if self.stale_client_timeout is None:
+            raise ValueError("stale_client_timeout is not set")
+        tokens = await self._reap_script(
+            self._reap_keys, [self.stale_client_timeout, limit, self._event_channel]
+        )
+        if self.fair:  # 清掉过期的票，回收出来的token按顺序交给排队的
+            await self._cancel_script(self._acquire_keys, [*self._release_args, "", ""])
+        return tokens
 
     async def _is_locked(self, token):
-        return await self.client.hexists(self.grabbed_key, token)
+        return await self.client.zscore(self.grabbed_key, token) is not None
 
     @property
     def num_tokens(self):
@@ -123,9 +576,18 @@ class Semaphore:
         return False
 
     async def locked(self) -> bool:
-        """如果信号量不能被立刻获取返回True"""
-        grabbed: int = await self.client.hlen(self.grabbed_key)  # type: ignore
-        return True if grabbed == self.value else False
+        """
+        如果信号量不能被立刻获取返回True，公平模式下有人在排队也不能插队
+        list布局下BLMOVE进PENDING还没记进GRABBED的token也算被拿走了
+        """
+        grabbed: int = await self.client.zcard(self.grabbed_key)  # type: ignore
+        if self.layout == "list":
+            grabbed += await self.client.llen(self.pending_key)  # type: ignore
+        if grabbed >= self.value:
+            return True
+        if self.fair:
+            return await self.client.llen(self.queue_key) > 0  # type: ignore
+        return False
 
     async def release(self):
         if not await self.has_token():
@@ -138,15 +600,32 @@ class Semaphore:
     async def signal(self, token):
         if token is None:
             return None
-        async with self.client.pipeline() as pipe:
-            pipe.multi()
-            pipe.hdel(self.grabbed_key, token)
-            pipe.lpush(self.available_key, token)
-            await pipe.execute()
+        if await self._signal_many([token]):
             return token
+        return None
+
+    async def _signal_many(self, tokens) -> int:
+        timings = [self._held_since.pop(ensure_bytes(token), None) for token in tokens]
+        args = list(self._release_args)
+        if self.stats:
+            # 一次释放的token共用一组时间，一般是acquire_many一起拿的，
+            # 没量过的(比如等待者走了还回去的)是空字符串，脚本不记
+            timing = next((t for t in timings if t is not None), None)
+            if timing is None:
+                args += ["", ""]
+            else:
+                wait, since = timing
+                args += [int(wait * 1000), int((time.monotonic() - since) * 1000)]
+        released = await self._release_script(self._release_keys, [*args, *tokens])
+        if self.metrics is not None:
+            now = time.monotonic()
+            for timing in timings:
+                if timing is not None:
+                    self.metrics.released(self, None, now - timing[1])
+        return released
 
     def get_namespaced_key(self, suffix):
-        return "{0}:{1}".format(self.namespace, suffix)
+        return namespaced_key(self.namespace, suffix, self.hash_tag)
 
     @property
     def check_exists_key(self):
@@ -163,8 +642,28 @@ class Semaphore:
         )  # 在redis中表示已经被各个client获得的key
 
     @property
-    def check_release_locks_key(self):
-        return self._get_and_set_key("_release_locks_ley", "RELEASE_LOCKS")
+    def pending_key(self):
+        return self._get_and_set_key("_pending_key", "PENDING")
+
+    @property
+    def seq_key(self):
+        return self._get_and_set_key("_seq_key", "SEQ")
+
+    @property
+    def stats_key(self):
+        return self._get_and_set_key("_stats_key", "STATS")
+
+    @property
+    def queue_key(self):
+        return self._get_and_set_key("_queue_key", "QUEUE")
+
+    @property
+    def tickets_key(self):
+        return self._get_and_set_key("_tickets_key", "TICKETS")
+
+    @property
+    def grants_key(self):
+        return self._get_and_set_key("_grants_key", "GRANTS")
 
     def _get_and_set_key(self, key_name, namespace_suffix):
         if not hasattr(self, key_name):
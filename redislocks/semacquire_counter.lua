@@ -0,0 +1,12 @@
+-- 计数模式下非阻塞获取信号量 不需要初始化，GRABBED的长度就是已经被获取的个数
+-- numkey: 2
+-- grabbed_key seq_key [stats_key]
+-- argv: value count stale_timeout event_channel [retry]
+-- count不为空就原子地一次拿count个，返回token列表，不够就一个都不拿
+-- stale_timeout不为空就先回收获取时间早于now-stale_timeout的token，一次最多回收100个
+-- retry不为空表示被叫醒以后的重试，第一次失败已经记过contended了，不再记
+local stats_key = KEYS[3]
+if ARGV[5] ~= nil and ARGV[5] ~= "" then
+    stats_key = nil
+end
+return sem_acquire_counter(KEYS[1], KEYS[2], stats_key, tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), ARGV[4])
@@ -0,0 +1,31 @@
+-- StripedSemaphore从第start个子信号量开始依次试，拿到一个就停，一次往返试完所有子信号量
+-- 子信号量在不同的slot上，集群里不能用
+-- numkey: 4 * stripes 或者计数模式 2 * stripes
+-- keys: 每个子信号量依次是 exists_key available_key grabbed_key pending_key，计数模式是 grabbed_key seq_key
+-- argv: layout stale_timeout start 然后每个子信号量一组 value event_channel
+-- 返回 {子信号量下标(从0开始), token}，都拿不到返回false
+local counter = ARGV[1] == "counter"
+local stale_timeout = tonumber(ARGV[2])
+local start = tonumber(ARGV[3])
+local width = 4
+if counter then
+    width = 2
+end
+local stripes = #KEYS / width
+
+for offset = 0, stripes - 1 do
+    local index = (start + offset) % stripes
+    local k = index * width
+    local value = tonumber(ARGV[4 + index * 2])
+    local event_channel = ARGV[5 + index * 2]
+    local token
+    if counter then
+        token = sem_acquire_counter(KEYS[k + 1], KEYS[k + 2], nil, value, nil, stale_timeout, event_channel)
+    else
+        token = sem_acquire_list(KEYS[k + 1], KEYS[k + 2], KEYS[k + 3], KEYS[k + 4], nil, value, nil, stale_timeout, event_channel)
+    end
+    if token then
+        return { index, token }
+    end
+end
+return false
@@ -0,0 +1,58 @@
+-- 公平模式获取信号量，有人在排队的话不能插队，拿不到就在QUEUE里排队
+-- numkey: 7
+-- keys: grabbed_key available_key seq_key exists_key queue_key tickets_key grants_key [stats_key]
+-- argv: value layout event_channel count stale_timeout ticket ticket_ms [retry]
+-- ticket为空是非阻塞的，拿不到返回false，不排队
+-- retry不为空表示票过期以后重新排队，第一次排队已经记过contended了，不再记
+-- 拿到了返回{1, tokens}，排上队返回{0, 前面排着的票数}，之后release的脚本会把token直接交给这张票
+local sem = fair_semaphore(KEYS, ARGV)
+local count = tonumber(ARGV[4])
+local stale_timeout = tonumber(ARGV[5])
+local ticket = ARGV[6]
+local ticket_ms = tonumber(ARGV[7])
+local retry = ARGV[8] ~= nil and ARGV[8] ~= ""
+
+if not sem.counter and redis.call("SET", sem.exists_key, "ok", "NX") then
+    -- 第一次使用，初始化全部token，unpack有参数个数限制，分批rpush
+    redis.call("DEL", sem.grabbed_key, sem.available_key)
+    local batch = {}
+    for i = 0, sem.value - 1 do
+        batch[#batch + 1] = i
+        if #batch == 1000 then
+            redis.call("RPUSH", sem.available_key, unpack(batch))
+            batch = {}
+        end
+    end
+    if #batch > 0 then
+        redis.call("RPUSH", sem.available_key, unpack(batch))
+    end
+end
+
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+if stale_timeout ~= nil then
+    local stale = redis.call("ZRANGEBYSCORE", sem.grabbed_key, "-inf", "(" .. (now - stale_timeout), "LIMIT", 0, 100)
+    if #stale > 0 then
+        redis.call("ZREM", sem.grabbed_key, unpack(stale))
+        if not sem.counter then
+            redis.call("LPUSH", sem.available_key, unpack(stale))
+        end
+    end
+end
+fair_expire(sem, now_ms)
+fair_grant(sem, now) -- 回收出来的token先给排着队的
+
+if redis.call("LLEN", sem.queue_key) == 0 and fair_free(sem) >= count then
+    return {1, fair_take(sem, count, now)}
+end
+if not retry then
+    record_contended(sem.stats_key, "s")
+end
+if ticket == "" then
+    return false
+end
+local ahead = redis.call("RPUSH", sem.queue_key, ticket) - 1
+redis.call("ZADD", sem.tickets_key, now_ms + ticket_ms, ticket)
+return {0, ahead}
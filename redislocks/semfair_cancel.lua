@@ -0,0 +1,45 @@
+-- 公平模式的等待者续期或者撤销自己的票
+-- numkey: 7
+-- keys: grabbed_key available_key seq_key exists_key queue_key tickets_key grants_key [stats_key]
+-- argv: value layout event_channel ticket ticket_ms
+-- ticket_ms不为空是续期，顺便补发一次，被semreap回收的token没有人发
+-- ticket_ms为空是撤销，还在排队就出队；从grant消息里收到token以后也用它删掉GRANTS和TICKETS里的记录
+-- ticket也为空的话只清理过期的票并补发，release_stale_locks用
+-- 已经发了token的返回{1, tokens}并删掉记录，续期成功返回{0}，票已经不在了返回{-1}
+local sem = fair_semaphore(KEYS, ARGV)
+local ticket = ARGV[4]
+local ticket_ms = tonumber(ARGV[5])
+
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+fair_expire(sem, now_ms)
+if ticket_ms or ticket == "" then
+    fair_grant(sem, now)
+end
+if ticket == "" then
+    return {-1}
+end
+
+local granted = redis.call("HGET", sem.grants_key, ticket)
+if granted then
+    redis.call("HDEL", sem.grants_key, ticket)
+    redis.call("ZREM", sem.tickets_key, ticket)
+    local tokens = {}
+    for token in string.gmatch(granted, "[^,]+") do
+        tokens[#tokens + 1] = token
+    end
+    return {1, tokens}
+end
+if ticket_ms then
+    if redis.call("ZSCORE", sem.tickets_key, ticket) then
+        redis.call("ZADD", sem.tickets_key, now_ms + ticket_ms, ticket)
+        return {0}
+    end
+    return {-1}
+end
+redis.call("ZREM", sem.tickets_key, ticket)
+if redis.call("LREM", sem.queue_key, 1, ticket) == 1 then
+    fair_grant(sem, now) -- 走的是队首的话后面的可能已经够了
+end
+return {-1}
@@ -0,0 +1,25 @@
+-- 公平模式释放信号量 token放回去以后直接按顺序交给排队的票
+-- numkey: 7
+-- keys: grabbed_key available_key seq_key exists_key queue_key tickets_key grants_key [stats_key]
+-- argv: value layout event_channel [wait_ms hold_ms] token [token ...] 打开统计的时候才有wait_ms和hold_ms
+local sem = fair_semaphore(KEYS, ARGV)
+local first = 4
+if sem.stats_key then
+    first = 6
+end
+
+local tokens = {}
+for i = first, #ARGV do
+    tokens[#tokens + 1] = ARGV[i]
+end
+local released = fair_put(sem, tokens)
+if sem.stats_key then
+    record_release(sem.stats_key, "s", released, ARGV[4], ARGV[5])
+end
+if released > 0 then
+    local time = redis.call("TIME")
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    fair_expire(sem, tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000))
+    fair_grant(sem, now)
+end
+return released
@@ -0,0 +1,15 @@
+-- BLPOP或者BLMOVE拿到token以后记录获取时间，用服务器的时间
+-- numkey: 1 or 2
+-- grabbed_key [pending_key] BLMOVE的话token在PENDING里，从那里挪进GRABBED
+-- argv: token
+-- 返回0表示token已经被claim_pending记进GRABBED又过期回收了，要重新拿
+local grabbed_key = KEYS[1]
+local pending_key = KEYS[2]
+local token = ARGV[1]
+
+if pending_key and redis.call("LREM", pending_key, 1, token) == 0 and not redis.call("ZSCORE", grabbed_key, token) then
+    return 0
+end
+local time = redis.call("TIME")
+redis.call("ZADD", grabbed_key, tonumber(time[1]) + tonumber(time[2]) / 1000000, token)
+return 1
@@ -0,0 +1,26 @@
+-- 回收获取时间早于now-stale_timeout的token，一次最多回收limit个
+-- numkey: 1 or 3
+-- grabbed_key [available_key pending_key] 计数模式没有available_key和pending_key
+-- argv: stale_timeout limit event_channel
+local grabbed_key = KEYS[1]
+local available_key = KEYS[2]
+local pending_key = KEYS[3]
+local stale_timeout = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local event_channel = ARGV[3]
+
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+if pending_key then
+    claim_pending(pending_key, grabbed_key, now)
+end
+
+local stale = redis.call("ZRANGEBYSCORE", grabbed_key, "-inf", "(" .. (now - stale_timeout), "LIMIT", 0, limit)
+if #stale > 0 then
+    redis.call("ZREM", grabbed_key, unpack(stale))
+    if available_key then
+        redis.call("LPUSH", available_key, unpack(stale))
+    end
+    redis.call("PUBLISH", event_channel, "release")
+end
+return stale -- 被回收的token
@@ -0,0 +1,28 @@
+-- 释放信号量 token放回AVAILABLE，并通知在等的人
+-- numkey: 2
+-- available_key grabbed_key [stats_key]
+-- argv: event_channel [wait_ms hold_ms] token [token ...] 打开统计的时候才有wait_ms和hold_ms
+local available_key = KEYS[1]
+local grabbed_key = KEYS[2]
+local stats_key = KEYS[3]
+local event_channel = ARGV[1]
+local first = 2
+if stats_key then
+    first = 4
+end
+
+local released = 0
+for i = first, #ARGV do
+    -- 没有被获取的token不能放回去，否则AVAILABLE里会多出来
+    if redis.call("ZREM", grabbed_key, ARGV[i]) == 1 then
+        redis.call("LPUSH", available_key, ARGV[i])
+        released = released + 1
+    end
+end
+if stats_key then
+    record_release(stats_key, "s", released, ARGV[2], ARGV[3])
+end
+if released > 0 then
+    redis.call("PUBLISH", event_channel, "release")
+end
+return released
@@ -0,0 +1,23 @@
+-- 计数模式下释放信号量 从GRABBED删掉就等于放回去了，并通知在等的人
+-- numkey: 1
+-- grabbed_key [stats_key]
+-- argv: event_channel [wait_ms hold_ms] token [token ...] 打开统计的时候才有wait_ms和hold_ms
+local grabbed_key = KEYS[1]
+local stats_key = KEYS[2]
+local event_channel = ARGV[1]
+local first = 2
+if stats_key then
+    first = 4
+end
+
+local released = 0
+for i = first, #ARGV do
+    released = released + redis.call("ZREM", grabbed_key, ARGV[i])
+end
+if stats_key then
+    record_release(stats_key, "s", released, ARGV[2], ARGV[3])
+end
+if released > 0 then
+    redis.call("PUBLISH", event_channel, "release")
+end
+return released
@@ -0,0 +1,177 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+
+stats=True的RWLock和Semaphore在Namespace:STATS里累加的竞争统计，所有进程的数据汇总在一起
+统计是获取和释放的脚本顺便HINCRBY的，不会多一次访问redis
+
+Namespace:STATS hash, mode是读锁"r", 写锁"w", 信号量"s"
+    acquired:<mode>      释放时计数，正常释放的获取次数，还没释放的和超时被回收的都不算
+                         等待和持有时间要到释放的时候才知道，所以和它们一起记
+    contended:<mode>     没能立刻拿到的acquire次数，开始排队或者非阻塞失败，每次acquire最多记一次，
+                         被叫醒以后重试又失败不再记
+    wait_ms:<mode>       等待时间总和，毫秒
+    hold_ms:<mode>       持有时间总和，毫秒
+    wait:<mode>:<bucket> 等待时间落在(bucket/2, bucket]毫秒的次数，bucket是2的幂，最小是1
+    hold:<mode>:<bucket> 持有时间的分桶，同上
+    promotions           写锁直接轮给排队写者的次数
+"""
+from typing import Dict, List, Tuple, Union
+
+MODES = ("r", "w", "s")
+SORT_KEYS = ("contended", "rate", "wait", "acquired", "promotions")
+
+
+def _percentile(buckets: Dict[int, int], q: float) -> int:
+    """分桶里第q分位所在桶的上界，没有数据是0"""
+    total = sum(buckets.values())
+    if not total:
+        return 0
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen >= q * total:
+            return bucket
+    return max(buckets)
+
+
+def parse(fields: Dict[Union[str, bytes], Union[str, bytes]]) -> dict:
+    """
+    把HGETALL的结果整理成
+    {"promotions": int, "modes": {mode: {"acquired", "contended", "contention",
+    "wait_ms", "hold_ms", "wait_p50", "wait_p99", "hold_p50", "hold_p99"}}}
+    contention是平均每次获取碰到的冲突次数，wait_ms和hold_ms是平均值，分位数是所在桶的上界
+    """
+    counters = {}  # type: Dict[str, int]
+    histograms = {}  # type: Dict[Tuple[str, str], Dict[int, int]]
+    for field, value in fields.items():
+        if isinstance(field, bytes):
+            field = field.decode()
+        parts = field.split(":")
+        if len(parts) == 3:  # wait:r:16
+            histograms.setdefault((parts[0], parts[1]), {})[int(parts[2])] = int(value)
+        else:
+            counters[field] = int(value)
+
+    modes = {}
+    for mode in MODES:
+        acquired = counters.get(f"acquired:{mode}", 0)
+        contended = counters.get(f"contended:{mode}", 0)
+        if not acquired and not contended:
+            continue
+        wait = histograms.get(("wait", mode), {})
+        hold = histograms.get(("hold", mode), {})
+        modes[mode] = {
+            "acquired": acquired,
+            "contended": contended,
+            "contention": contended / acquired if acquired else float(contended),
+            "wait_ms": counters.get(f"wait_ms:{mode}", 0) / acquired if acquired else 0,
+            "hold_ms": counters.get(f"hold_ms:{mode}", 0) / acquired if acquired else 0,
+            "wait_p50": _percentile(wait, 0.5),
+            "wait_p99": _percentile(wait, 0.99),
+            "hold_p50": _percentile(hold, 0.5),
+            "hold_p99": _percentile(hold, 0.99),
+        }
+    return {"promotions": counters.get("promotions", 0), "modes": modes}
+
+
+def namespace_of(key: Union[str, bytes]) -> str:
+    """NS:STATS或者{NS}:STATS里的NS"""
+    if isinstance(key, bytes):
+        key = key.decode()
+    namespace = key[: -len(":STATS")]
+    if namespace.startswith("{") and namespace.endswith("}"):
+        namespace = namespace[1:-1]
+    return namespace
+
+
+async def collect(client, match: str = "*") -> Dict[str, dict]:
+    """
+    SCAN出所有namespace匹配match的STATS，返回namespace -> parse的结果
+    打开了hash_tag的"{NS}:STATS"也能匹配上，RedisCluster会扫所有主节点
+    """
+    patterns = [f"{match}:STATS"]
+    if match != "*":  # "*:STATS"已经包括"{NS}:STATS"了
+        patterns.append(f"{{{match}}}:STATS")
+    keys = set()
+    for pattern in patterns:
+        async for key in client.scan_iter(match=pattern, count=1000):
+            keys.add(key)
+    result = {}
+    for key in sorted(keys):
+        fields = await client.hgetall(key)
+        if fields:
+            result[namespace_of(key)] = parse(fields)
+    return result
+
+
+def _total(entry: dict, sort: str) -> float:
+    modes = entry["modes"].values()
+    if sort == "promotions":
+        return entry["promotions"]
+    acquired = sum(m["acquired"] for m in modes)
+    if sort == "acquired":
+        return acquired
+    contended = sum(m["contended"] for m in modes)
+    if sort == "contended":
+        return contended
+    if sort == "rate":
+        return contended / acquired if acquired else float(contended)
+    # wait: 按获取次数加权的平均等待
+    return (
+        sum(m["wait_ms"] * m["acquired"] for m in modes) / acquired if acquired else 0
+    )
+
+
+def rank(
+    stats: Dict[str, dict], sort: str = "contended", top: int = 0
+) -> List[Tuple[str, dict]]:
+    """按sort从大到小排namespace，top大于0的话只要前top个"""
+    if sort not in SORT_KEYS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_KEYS)}")
+    ranked = sorted(stats.items(), key=lambda item: _total(item[1], sort), reverse=True)
+    return ranked[:top] if top > 0 else ranked
+
+
+def format_table(ranked: List[Tuple[str, dict]]) -> str:
+    """每个namespace的每种mode一行"""
+    header = (
+        "namespace",
+        "mode",
+        "acquired",
+        "contended",
+        "contention",
+        "wait_ms",
+        "wait_p50",
+        "wait_p99",
+        "hold_ms",
+        "hold_p50",
+        "hold_p99",
+        "promotions",
+    )
+    rows = [header]
+    for namespace, entry in ranked:
+        for mode, m in entry["modes"].items():
+            rows.append(
+                (
+                    namespace,
+                    mode,
+                    str(m["acquired"]),
+                    str(m["contended"]),
+                    f"{m['contention']:.2f}",
+                    f"{m['wait_ms']:.1f}",
+                    str(m["wait_p50"]),
+                    str(m["wait_p99"]),
+                    f"{m['hold_ms']:.1f}",
+                    str(m["hold_p50"]),
+                    str(m["hold_p99"]),
+                    str(entry["promotions"]) if mode == "w" else "",
+                )
+            )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return "\n".join(
+        "  ".join(
+            cell.ljust(width) if i < 2 else cell.rjust(width)
+            for i, (cell, width) in enumerate(zip(row, widths))
+        ).rstrip()
+        for row in rows
+    )
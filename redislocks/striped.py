@@ -0,0 +1,325 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+import random
+from collections import deque
+from typing import (
+    Awaitable,
+    Callable,
+    Deque,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from redis.asyncio import Redis, RedisCluster
+
+from redislocks.dispatcher import get_dispatcher
+from redislocks.exceptions import NotAvailable
+from redislocks.library import get_library
+from redislocks.sem import Semaphore
+from redislocks.utils import ensure_str
+
+
+class StripedSemaphore:
+    """
+    把value个token分到stripes个子信号量上，子信号量的namespace是"Namespace:0", "Namespace:1"...
+    每个子信号量就是一个普通的非阻塞Semaphore，集群模式下各自一个hash tag，分散到不同的节点上
+
+    acquire随机挑一个子信号量开始，拿不到再依次试别的，全部拿不到才算拿不到
+    单机的话semacquire_striped.lua一次往返试完所有子信号量；集群里子信号量在不同的slot上，
+    先试挑中的那个，拿不到再并发地试剩下的，多拿到的马上还回去
+    总容量还是value，全部子信号量都被拿完了locked()才返回True
+    返回的token是"<子信号量下标>:<子信号量的token>"
+
+    notify="blpop"只在只有一个子信号量的时候用，和Semaphore一样BLMOVE进PENDING，进程挂了token也不会丢，
+    好几个子信号量没法一次BLMOVE，BLPOP之后挂了token就丢了，所以stripes>1的时候总是用publish
+    notify="publish"时监听所有子信号量的EVENTS，在本地排队，由一个task从有token放回来的子信号量开始替队首去拿
+    """
+
+    def __init__(
+        self,
+        value: int,
+        stripes: int,
+        client: Optional[Redis] = None,
+        namespace: str = "SEMAPHORE",
+        stale_client_timeout: Optional[float] = None,
+        blocking: bool = True,
+        notify: Optional[Literal["blpop", "publish"]] = None,
+        layout: Literal["list", "counter"] = "list",
+        hash_tag: Optional[bool] = None,
+    ):
+        self.client = client or Redis()
+        if not 1 <= stripes <= value:
+            raise ValueError("stripes must be between 1 and the semaphore value")
+        if notify is None:
+            notify = (
+                "blpop"
+                if layout == "list" and not isinstance(self.client, RedisCluster)
+                else "publish"
+            )
+        if notify not in ("blpop", "publish"):
+            raise ValueError("notify must be 'blpop' or 'publish'")
+        if notify == "blpop" and layout == "counter":
+            raise ValueError("counter layout can only be used with notify='publish'")
+        if notify == "blpop" and stripes > 1:  # 没法原子地从好几个list BLMOVE
+            notify = "publish"
+        self.value = value
+        self.namespace = namespace
+        self.blocking = blocking
+        self.notify = notify
+        self.layout = layout
+        # 前value % stripes个子信号量多分一个
+        self.stripes = [
+            Semaphore(
+                value // stripes + (1 if index < value % stripes else 0),
+                self.client,
+                namespace="{0}:{1}".format(namespace, index),
+                stale_client_timeout=stale_client_timeout,
+                blocking=False,
+                layout=layout,
+                hash_tag=hash_tag,
+            )
+            for index in range(stripes)
+        ]  # type: List[Semaphore]
+        self._local_tokens = list()  # type: List[str]
+        self._cluster = isinstance(self.client, RedisCluster)
+        self._acquire_script = get_library(self.client)[
+            "semacquire_striped"
+        ]  # semacquire_striped.lua
+        self._acquire_keys = [
+            key for stripe in self.stripes for key in stripe._acquire_keys
+        ]
+        self._acquire_args = [
+            layout,
+            "" if stale_client_timeout is None else stale_client_timeout,
+        ]
+        self._stripe_args = [
+            arg
+            for stripe in self.stripes
+            for arg in (stripe.value, stripe._event_channel)
+        ]
+
+        self._dispatcher = get_dispatcher(self.client)
+        self._channels = {
+            stripe._event_channel: index for index, stripe in enumerate(self.stripes)
+        }
+        self._waiters = deque()  # type: Deque[asyncio.Future]
+        self._release_epoch = 0  # 每收到一次release加一
+        self._released_stripe = 0  # 最近一次有token放回来的子信号量
+        self._granting = False
+        self._grant_tasks = set()  # type: Set[asyncio.Task]
+
+    def __del__(self):
+        dispatcher = getattr(self, "_dispatcher", None)
+        if dispatcher is not None:
+            for channel in self._channels:
+                dispatcher.unsubscribe(channel, self)
+
+    async def acquire(
+        self,
+        timeout: int = 0,
+        target: Optional[Callable[[str], Union[None, Awaitable[None]]]] = None,
+    ) -> str:
+        if self.blocking and self.notify == "publish":  # 先订阅再尝试，不然可能漏掉中间的release
+            for channel in self._channels:
+                await self._dispatcher.subscribe(channel, self)
+
+        epoch = self._release_epoch
+        token = await self._try_acquire(random.randrange(len(self.stripes)))
+        if token is None:
+            if not self.blocking:
+                raise NotAvailable
+            if self.notify == "publish":
+                token = await self._wait(epoch, timeout)
+            else:  # 只有一个子信号量
+                stripe_token = await self.stripes[0]._blocking_pop(timeout)
+                if stripe_token is None:
+                    raise NotAvailable
+                token = "0:{0}".format(ensure_str(stripe_token))
+
+        self._local_tokens.append(token)
+        if target is not None:
+            try:
+                if asyncio.iscoroutinefunction(target):
+                    await target(token)
+                else:
+                    target(token)
+            finally:
+                await self.signal(token)
+        return token
+
+    async def _try_acquire(self, start: int) -> Optional[str]:
+        """从第start个子信号量开始依次试，都拿不到返回None"""
+        if self._cluster:
+            return await self._try_acquire_spread(start)
+        result = await self._acquire_script(
+            self._acquire_keys, [*self._acquire_args, start, *self._stripe_args]
+        )
+        if not result:
+            return None
+        return "{0}:{1}".format(result[0], ensure_str(result[1]))
+
+    async def _try_acquire_spread(self, start: int) -> Optional[str]:
+        """集群里先试第start个，拿不到再并发地试剩下的，多拿到的还回去"""
+        token = await self.stripes[start]._try_acquire()
+        if token is not None:
+            return "{0}:{1}".format(start, ensure_str(token))
+        others = [
+            (start + offset) % len(self.stripes)
+            for offset in range(1, len(self.stripes))
+        ]
+        results = await asyncio.gather(
+            *[self.stripes[index]._try_acquire() for index in others],
+            return_exceptions=True,
+        )
+        acquired = [
+            (index, token)
+            for index, token in zip(others, results)
+            if token is not None and not isinstance(token, BaseException)
+        ]
+        if len(acquired) > 1:
+            await asyncio.gather(
+                *[
+                    self.stripes[index]._signal_many([token])
+                    for index, token in acquired[1:]
+                ]
+            )
+        if acquired:
+            return "{0}:{1}".format(acquired[0][0], ensure_str(acquired[0][1]))
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return None
+
+    def _split(self, token: Union[str, bytes]) -> Tuple[Semaphore, str]:
+        index, _, stripe_token = ensure_str(token).partition(":")
+        return self.stripes[int(index)], stripe_token
+
+    async def _wait(self, epoch: int, timeout: float) -> str:
+        """在本地排队，等_grant_waiters把token送过来，等待期间不占用连接"""
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if epoch != self._release_epoch:  # 尝试的途中已经有token放回来了
+            self._start_grant()
+        try:
+            await asyncio.wait((waiter,), timeout=timeout or None)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():  # 已经拿到了，还回去
+                await self.signal(waiter.result())
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:  # 已经被_grant_waiters取走了
+                pass
+        if waiter.cancelled():  # 超时
+            raise NotAvailable
+        return waiter.result()
+
+    def _handle_event(self, channel: bytes, data: bytes) -> None:
+        """由dispatcher调用，有子信号量的token被放回来了"""
+        self._release_epoch += 1
+        self._released_stripe = self._channels.get(channel, 0)
+        self._start_grant()
+
+    def _start_grant(self) -> None:
+        if self._waiters and not self._granting:
+            self._granting = True
+            task = asyncio.create_task(self._grant_waiters())
+            self._grant_tasks.add(task)
+            task.add_done_callback(self._grant_tasks.discard)
+
+    def _pop_done_waiters(self) -> None:
+        while self._waiters and self._waiters[0].done():
+            self._waiters.popleft()
+
+    async def _grant_waiters(self):
+        """一个task替本地排队的等待者拿token，从刚有token放回来的子信号量开始试"""
+        try:
+            while True:
+                self._pop_done_waiters()
+                if not self._waiters:
+                    break
+                epoch = self._release_epoch
+                token = await self._try_acquire(self._released_stripe)
+                if token is None:
+                    if epoch == self._release_epoch:
+                        break
+                    continue  # 途中又有release，那次没有再启动，这里补上
+                self._pop_done_waiters()
+                if self._waiters:
+                    self._waiters.popleft().set_result(token)
+                else:  # 等的人走了，还回去
+                    await self.signal(token)
+        finally:
+            self._granting = False
+
+    @property
+    async def available_count(self) -> int:
+        count = 0
+        for stripe in self.stripes:
+            count += await stripe.available_count
+        return count
+
+    @property
+    def num_tokens(self):
+        return len(self._local_tokens)
+
+    async def has_token(self) -> bool:
+        """当前信号量拥有至少一个token时返回True"""
+        for token in self._local_tokens:
+            stripe, stripe_token = self._split(token)
+            if await stripe._is_locked(stripe_token):
+                return True
+        return False
+
+    async def locked(self) -> bool:
+        """所有子信号量都不能被立刻获取时返回True"""
+        for stripe in self.stripes:
+            if not await stripe.locked():
+                return False
+        return True
+
+    async def release(self):
+        if not await self.has_token():
+            return False
+        return await self.signal(self._local_tokens.pop())
+
+    async def release_all(self):
+        for _ in range(len(self._local_tokens)):
+            await self.release()
+
+    async def signal(self, token):
+        if token is None:
+            return None
+        stripe, stripe_token = self._split(token)
+        if await stripe._signal_many([stripe_token]):
+            return token
+        return None
+
+    async def release_stale_locks(self, limit: int = 100) -> List[str]:
+        """每个子信号量各自回收最多limit个超时的token"""
+        tokens = []
+        for index, stripe in enumerate(self.stripes):
+            for token in await stripe.release_stale_locks(limit):
+                tokens.append("{0}:{1}".format(index, ensure_str(token)))
+        return tokens
+
+    async def reset(self):
+        for stripe in self.stripes:
+            await stripe.reset()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.release()
+        return True if exc_type is None else False
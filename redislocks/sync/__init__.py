@@ -0,0 +1,6 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+from redislocks.exceptions import NotAvailable
+from redislocks.sync.rwlock import RWLock
+from redislocks.sync.sem import Semaphore
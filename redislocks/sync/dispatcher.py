@@ -0,0 +1,155 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import threading
+import time
+import uuid
+import weakref
+from typing import Dict, Optional, Set
+
+from redis import Redis
+from redis.exceptions import RedisError, TimeoutError
+
+from redislocks.utils import ensure_bytes
+
+
+class EventDispatcher:
+    """
+    redislocks.dispatcher.EventDispatcher的同步版本
+    一个redis.Redis共享一个pubsub连接和一个后台线程，线程收到消息以后调用锁的_handle_event(channel, data)
+    _handle_event在后台线程里跑，不能阻塞，只能叫醒等待的线程
+    没有锁在监听了线程就退出，下次subscribe再启动
+
+    redis-py的PubSub不是线程安全的，订阅和退订都交给后台线程去做，
+    调用方往自己的wakeup channel发一条消息，让阻塞在get_message里的后台线程马上醒过来
+    """
+
+    poll_interval = 1.0  # 后台线程最多隔这么久处理一次订阅和退订
+    subscribe_timeout = 10.0  # 等redis确认订阅最多等这么久
+
+    def __init__(self, client: Redis):
+        # 只持有pubsub和client的弱引用，不然WeakKeyDictionary里的client永远不会被回收
+        self._pubsub = client.pubsub()
+        self._client = weakref.ref(client)
+        self._wakeup_channel = ensure_bytes(f"redislocks:dispatcher:{uuid.uuid4().hex}")
+        self._handlers = {}  # type: Dict[bytes, weakref.WeakSet]
+        self._confirmed = {}  # type: Dict[bytes, threading.Event]
+        self._requested = set()  # type: Set[bytes] 等后台线程去订阅的channel
+        self._dropped = set()  # type: Set[bytes] 等后台线程去退订的channel
+        self._thread = None  # type: Optional[threading.Thread]
+        # 可重入，锁的__del__可能在持有它的线程里被gc触发
+        self._lock = threading.RLock()
+
+    def subscribe(self, channel: bytes, handler) -> None:
+        """
+        注册handler，等到redis确认订阅以后才返回，这样之后发生的事件都不会漏掉
+        subscribe_timeout秒内没有确认抛redis.exceptions.TimeoutError，下次调用会重新订阅
+        """
+        wakeup = False
+        with self._lock:
+            handlers = self._handlers.get(channel)
+            if handlers is None:
+                handlers = self._handlers[channel] = weakref.WeakSet()
+            handlers.add(handler)
+            self._dropped.discard(channel)
+            confirmed = self._confirmed.get(channel)
+            if confirmed is None:
+                confirmed = self._confirmed[channel] = threading.Event()
+                self._requested.add(channel)
+                wakeup = True
+            if self._thread is None or not self._thread.is_alive():
+                self._requested.add(self._wakeup_channel)
+                self._thread = threading.Thread(
+                    target=self._listen, name="redislocks-dispatcher", daemon=True
+                )
+                self._thread.start()
+        if wakeup:
+            self._wakeup()
+        if not confirmed.wait(self.subscribe_timeout):
+            with self._lock:
+                if self._confirmed.get(channel) is confirmed:
+                    del self._confirmed[channel]
+            self.unsubscribe(channel, handler)
+            raise TimeoutError(f"subscribe to {channel!r} was not confirmed")
+
+    def _wakeup(self) -> None:
+        """后台线程刚启动的时候还没订阅wakeup channel，那就等它下一次轮询"""
+        client = self._client()
+        if client is None:
+            return
+        try:
+            client.publish(self._wakeup_channel, b"")
+        except RedisError:
+            pass
+
+    def unsubscribe(self, channel: bytes, handler) -> None:
+        """可以在__del__里调用，channel上没有handler了就交给后台线程退订"""
+        with self._lock:
+            handlers = self._handlers.get(channel)
+            if handlers is not None:
+                handlers.discard(handler)
+                if not handlers:
+                    self._drop(channel)
+
+    def _drop(self, channel: bytes) -> None:
+        self._handlers.pop(channel, None)
+        self._confirmed.pop(channel, None)
+        self._requested.discard(channel)
+        self._dropped.add(channel)
+
+    def _listen(self) -> None:
+        pubsub = self._pubsub
+        while True:
+            try:
+                with self._lock:
+                    if not self._handlers:
+                        self._thread = None
+                        return
+                    if self._dropped:
+                        pubsub.unsubscribe(*self._dropped)
+                        self._dropped.clear()
+                    if self._requested:
+                        pubsub.subscribe(*self._requested)
+                        self._requested.clear()
+                event = pubsub.get_message(timeout=self.poll_interval)
+            except (RedisError, OSError, ValueError):
+                # 连接断了或者client被close了，redis-py下次读的时候会重连并且重新订阅
+                time.sleep(0.1)
+                continue
+            if event is None:
+                continue
+            event_type = event["type"]
+            channel = ensure_bytes(event["channel"])
+            if event_type in (b"message", "message"):
+                self._dispatch(channel, ensure_bytes(event["data"]))
+            elif event_type in (b"subscribe", "subscribe"):
+                with self._lock:
+                    confirmed = self._confirmed.get(channel)
+                if confirmed is not None:
+                    confirmed.set()
+
+    def _dispatch(self, channel: bytes, data: bytes) -> None:
+        with self._lock:
+            handlers = self._handlers.get(channel)
+            if not handlers:  # 锁都被回收了
+                if handlers is not None:
+                    self._drop(channel)
+                return
+            handlers = list(handlers)
+        for handler in handlers:
+            handler._handle_event(channel, data)
+
+
+_dispatchers = (
+    weakref.WeakKeyDictionary()
+)  # type: weakref.WeakKeyDictionary[Redis, EventDispatcher]
+_dispatchers_lock = threading.Lock()
+
+
+def get_dispatcher(client: Redis) -> EventDispatcher:
+    """每个client只有一个dispatcher"""
+    with _dispatchers_lock:
+        dispatcher = _dispatchers.get(client)
+        if dispatcher is None:
+            dispatcher = _dispatchers[client] = EventDispatcher(client)
+        return dispatcher
@@ -0,0 +1,121 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import threading
+import weakref
+from typing import Dict, Optional, Sequence
+
+from redis import Redis
+from redis.cluster import RedisCluster
+from redis.exceptions import ResponseError
+
+from redislocks.library import ScriptLibrary as _AsyncScriptLibrary
+from redislocks.scripts import (
+    READONLY_SCRIPTS,
+    function_prefix,
+    library_code,
+    script_shas,
+    scripts,
+)
+
+
+class LibraryScript:
+    """redislocks.library.LibraryScript的同步版本，调用方式和register_script返回的Script一样"""
+
+    def __init__(self, library: "ScriptLibrary", name: str):
+        self.library = library
+        self.name = name
+        self.sha = script_shas[name]
+        self.function_name = function_prefix + name
+        self.readonly = name in READONLY_SCRIPTS
+
+    def __call__(
+        self, keys: Sequence = (), args: Sequence = (), client=None
+    ):  # client可以是pipeline
+        library = self.library
+        if library.use_functions is None:
+            library.load()
+        if client is None:
+            client = library.client
+        try:
+            return self._send(client, keys, args)
+        except ResponseError as e:
+            # redis被清空或者换了主，重新加载一次，平时不会走到这里
+            if not library.is_missing(e):
+                raise
+            library.load(force=True)
+            return self._send(client, keys, args)
+
+    def _send(self, client, keys: Sequence, args: Sequence):
+        if self.library.use_functions:
+            command = "FCALL_RO" if self.readonly else "FCALL"
+            return client.execute_command(
+                command, self.function_name, len(keys), *keys, *args
+            )
+        return client.execute_command("EVALSHA", self.sha, len(keys), *keys, *args)
+
+
+class ScriptLibrary:
+    """
+    redislocks.library.ScriptLibrary的同步版本，一个redis.Redis只加载一次所有的脚本
+    多个线程同时第一次调用的时候只有一个去加载
+    """
+
+    is_missing = staticmethod(_AsyncScriptLibrary.is_missing)
+
+    def __init__(self, client: Redis):
+        self._client = weakref.ref(client)
+        self.use_functions = None  # type: Optional[bool]  # None表示还没加载
+        self._lock = threading.Lock()
+        self._scripts = {
+            name: LibraryScript(self, name) for name in scripts
+        }  # type: Dict[str, LibraryScript]
+
+    def __getitem__(self, name: str) -> LibraryScript:
+        return self._scripts[name]
+
+    @property
+    def client(self) -> Redis:
+        return self._client()
+
+    def load(self, force: bool = False) -> None:
+        with self._lock:
+            if self.use_functions is not None and not force:  # 别的线程已经加载好了
+                return
+            client = self.client
+            try:
+                client.function_load(library_code)
+                self.use_functions = True
+                return
+            except ResponseError as e:
+                message = str(e).lower()
+                if "already exists" in message:
+                    self.use_functions = True
+                    return
+                if "unknown command" not in message:
+                    raise
+            # redis 7以前没有FUNCTION
+            if isinstance(client, RedisCluster):  # 会发给所有主节点
+                for source in scripts.values():
+                    client.script_load(source)
+            else:
+                with client.pipeline(transaction=False) as pipe:
+                    for source in scripts.values():
+                        pipe.script_load(source)
+                    pipe.execute()
+            self.use_functions = False
+
+
+_libraries = (
+    weakref.WeakKeyDictionary()
+)  # type: weakref.WeakKeyDictionary[Redis, ScriptLibrary]
+_libraries_lock = threading.Lock()
+
+
+def get_library(client: Redis) -> ScriptLibrary:
+    """每个client只有一个ScriptLibrary"""
+    with _libraries_lock:
+        library = _libraries.get(client)
+        if library is None:
+            library = _libraries[client] = ScriptLibrary(client)
+        return library
@@ -0,0 +1,312 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import threading
+import time
+from typing import Dict, List, Literal, Optional, Set
+
+from redis import Redis
+from redis.cluster import RedisCluster
+
+from redislocks.exceptions import NotAvailable
+from redislocks.sync.dispatcher import get_dispatcher
+from redislocks.sync.library import get_library
+from redislocks.utils import (
+    ensure_bytes,
+    ensure_str,
+    namespaced_key,
+    priority_args,
+    priority_step,
+)
+
+
+class RWLock:
+    """
+    redislocks.RWLock的同步版本，用同样的key和脚本，可以和异步的锁混用
+    client是redis.Redis，命令用它的连接池，一个锁对象可以被多个线程共用
+
+    阻塞的时候只监听EVENTS，相当于notify="publish"，服务器不需要打开keyspace事件
+    client共享的后台线程收到消息以后叫醒等待的线程，等待期间不占用连接
+    写锁在WRITEWAITER里排队，读锁等"del"或者"open"以后各自重试，写锁的priority和priority_aging和RWLock一样
+    acquire可以给timeout，超时抛NotAvailable，排队的写锁会被取消
+
+    没有读锁合并和租约
+    """
+
+    def __init__(
+        self,
+        client: Optional[Redis] = None,
+        namespace: str = "RWLOCK",
+        blocking: bool = True,
+        hash_tag: Optional[bool] = None,
+        priority_aging: Optional[float] = None,
+    ):
+        self.client = client or Redis()
+        self.namespace = namespace
+        self.blocking = blocking
+        if hash_tag is None:
+            hash_tag = isinstance(self.client, RedisCluster)
+        self.hash_tag = hash_tag
+        self.priority_aging = priority_aging
+        self._priority_step = priority_step(priority_aging)
+
+        self.read_key = self.get_namespaced_key("READ")
+        self.write_key = self.get_namespaced_key("WRITE")
+        self.write_waiter_key = self.get_namespaced_key("WRITEWAITER")
+        self.upgrader_key = self.get_namespaced_key("UPGRADER")
+        self.lease_key = self.get_namespaced_key("LEASES")
+        self._keys = [
+            self.read_key,
+            self.write_key,
+            self.write_waiter_key,
+            self.lease_key,
+        ]
+
+        # 保护下面所有的本地状态，后台线程和调用方的线程都会改
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)  # 读者在上面等"del"
+        self._read_epoch = 0  # 每收到一次"del"加一
+        self._write_waiters = {}  # type: Dict[str, threading.Event]
+        # lockwrite.lua返回之前就被轮到的token，等注册好Event再认领
+        self._enqueuing = 0
+        self._handoffs = set()  # type: Set[str]
+        self._local_readtokens = []  # type: List[str]
+        self._local_writetoken = None  # type: Optional[str]
+
+        library = get_library(self.client)
+        self._lockread_script = library["lockread"]  # lockread.lua
+        self._unlockread_script = library["unlockread"]  # unlockread.lua
+        self._lockwrite_nowait_script = library[
+            "lockwrite_nowait"
+        ]  # lockwrite_nowait.lua
+        self._lockwrite_script = library["lockwrite"]  # lockwrite.lua
+        self._cancelwrite_script = library["cancelwrite"]  # cancelwrite.lua
+        self._unlockwrite_script = library["unlockwrite"]  # unlockwrite.lua
+        self._upgrade_script = library["upgrade"]  # upgrade.lua
+        self._downgrade_script = library["downgrade"]  # downgrade.lua
+        self._get_state_script = library["get_state"]  # get_state.lua
+
+        self._dispatcher = get_dispatcher(self.client)
+        self._event_channel = ensure_bytes(self.get_namespaced_key("EVENTS"))
+
+    def __del__(self):
+        dispatcher = getattr(self, "_dispatcher", None)
+        if dispatcher is not None:
+            dispatcher.unsubscribe(self._event_channel, self)
+
+    def reset(self):
+        with self.client.pipeline() as pipe:
+            pipe.delete(
+                self.read_key,
+                self.write_key,
+                self.write_waiter_key,
+                self.upgrader_key,
+                self.lease_key,
+            )
+            pipe.execute()
+        self.client.publish(self._event_channel, "open")
+
+    def release_all(self):
+        for _ in range(len(self._local_readtokens)):
+            self.release("r")
+        if self._local_writetoken is not None:
+            self.release("w")
+
+    def acquire(
+        self,
+        mode: Literal["r", "w"] = "r",
+        timeout: Optional[float] = None,
+        priority: int = 0,
+    ) -> str:
+        if mode not in ("r", "w"):
+            raise ValueError("mode must be 'r' or 'w'")
+        if mode == "r" and priority:
+            raise ValueError("priority only applies to mode 'w'")
+        if self.blocking:  # 先订阅再尝试加锁，不然可能漏掉中间的事件
+            self._dispatcher.subscribe(self._event_channel, self)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if mode == "r":
+            token = self._acquire_read(deadline)
+            with self._lock:
+                self._local_readtokens.append(token)
+            return token
+        if not self.blocking:
+            token = self._lockwrite_nowait_script(self._keys, [self._event_channel])
+            if not token:
+                raise NotAvailable
+            token = ensure_str(token)
+        else:
+            token, granted = self._write_or_enqueue(
+                self._lockwrite_script,
+                self._keys,
+                ["", *priority_args(priority, self._priority_step)],
+            )
+            if not granted:
+                self._wait_write(token, deadline)
+        with self._lock:
+            self._local_writetoken = token
+        return token
+
+    def _acquire_read(self, deadline: Optional[float]) -> str:
+        woken = False  # 是不是被叫醒以后在重试，重试的时候不再记contended
+        while True:
+            with self._lock:
+                epoch = self._read_epoch
+            token = self._lockread_script(
+                self._keys, [self._event_channel, "", "", 1 if woken else ""]
+            )
+            if token != 0:  # 加锁成功
+                return ensure_str(token)
+            if not self.blocking:
+                raise NotAvailable
+            with self._cond:
+                while epoch == self._read_epoch:  # 等写锁被删
+                    if not self._cond.wait(_remaining(deadline)):
+                        raise NotAvailable
+            woken = True
+
+    def _write_or_enqueue(self, script, keys: list, args: list):
+        """跑lockwrite.lua或者upgrade.lua，返回(token, granted)，granted为0表示排进了WRITEWAITER"""
+        with self._lock:
+            self._enqueuing += 1
+        try:
+            token, granted, *_ = script(keys, [self._event_channel, *args])
+            token = ensure_str(token)
+            if granted == 0:
+                event = threading.Event()
+                with self._lock:
+                    if token in self._handoffs:  # 脚本返回之前就已经轮到了
+                        event.set()
+                    self._write_waiters[token] = event
+        finally:
+            with self._lock:
+                self._enqueuing -= 1
+                if not self._enqueuing:
+                    self._handoffs.clear()
+        return token, granted
+
+    def _wait_write(self, token: str, deadline: Optional[float]) -> None:
+        try:
+            if not self._write_waiters[token].wait(_remaining(deadline)):
+                # 超时，删除等待写锁队列里面的token，已经被轮到的话就顺手释放掉
+                self._cancelwrite_script(self._keys, [self._event_channel, token])
+                raise NotAvailable
+        finally:
+            with self._lock:
+                del self._write_waiters[token]
+
+    def upgrade(self, timeout: Optional[float] = None) -> str:
+        """
+        把最近获取的读锁原子地升级成写锁，规则和redislocks.RWLock.upgrade一样
+        等待超时的话读锁和写锁都没有了
+        """
+        with self._lock:
+            if not self._local_readtokens:
+                raise ValueError("can not upgrade without a read lock")
+            read_token = self._local_readtokens[-1]
+        if self.blocking:
+            self._dispatcher.subscribe(self._event_channel, self)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        token, granted = self._write_or_enqueue(
+            self._upgrade_script,
+            [*self._keys, self.upgrader_key],
+            [read_token, "", "" if self.blocking else 1],
+        )
+        if granted == -1:
+            raise ValueError("No lock is upgraded. Is redis changed?")
+        if granted < 0:
+            raise NotAvailable
+        with self._lock:  # 读锁已经在redis里放掉了
+            self._local_readtokens.remove(read_token)
+        if not granted:
+            self._wait_write(token, deadline)
+        with self._lock:
+            self._local_writetoken = token
+        return token
+
+    def downgrade(self) -> str:
+        """把持有的写锁原子地降级成读锁"""
+        with self._lock:
+            write_token = self._local_writetoken
+        if write_token is None:
+            raise ValueError("can not downgrade write lock without acquire it")
+        token = self._downgrade_script(self._keys, [self._event_channel, write_token])
+        if not token:
+            raise ValueError("can not downgrade write lock without acquire it")
+        token = ensure_str(token)
+        with self._lock:
+            if self._local_writetoken == write_token:
+                self._local_writetoken = None
+            self._local_readtokens.append(token)
+        return token
+
+    def release(self, mode: Literal["r", "w"] = "r"):
+        if mode == "r":
+            with self._lock:
+                try:
+                    token = self._local_readtokens.pop()
+                except IndexError:  # 空list？
+                    raise ValueError("can not release more than acquire")
+            if not self._unlockread_script(self._keys, [self._event_channel, token]):
+                raise ValueError("No lock is released. Is redis changed?")
+        elif mode == "w":
+            with self._lock:
+                token = self._local_writetoken
+            if token is None:
+                raise ValueError("can not release write lock without acquire it")
+            if not self._unlockwrite_script(self._keys, [self._event_channel, token]):
+                raise ValueError("can not release write lock without acquire it")
+            with self._lock:
+                # 释放的同时可能已经轮到了同一个对象上另一个线程的写锁，不能把它清掉
+                if self._local_writetoken == token:
+                    self._local_writetoken = None
+        else:
+            raise ValueError("mode must be 'r' or 'w'")
+
+    def has_token(self, mode: Literal["r", "w"] = "r") -> bool:
+        """如果当前lock存在对应的token返回True"""
+        if mode == "r":
+            with self._lock:
+                tokens = list(self._local_readtokens)
+            return any(self.client.sismember(self.read_key, token) for token in tokens)
+        elif mode == "w":
+            token = self._local_writetoken
+            return token is not None and token == ensure_str(
+                self.client.get(self.write_key)
+            )
+        raise ValueError("mode must be 'r' or 'w'")
+
+    def get_state(self) -> int:
+        return self._get_state_script(self._keys)
+
+    def locked(self, mode: Literal["r", "w"] = "r") -> bool:
+        """如果锁不能立刻获取返回True"""
+        current_state = self.get_state()
+        if mode == "r":
+            return current_state in (2, 3)
+        return current_state in (1, 2, 3)
+
+    def get_namespaced_key(self, suffix):
+        return namespaced_key(self.namespace, suffix, self.hash_tag)
+
+    def _handle_event(self, channel: bytes, data: bytes) -> None:
+        """在dispatcher的后台线程里调用"""
+        if data.startswith(b"set:"):  # 对应token的写锁不用等了，如果这个对象有的话
+            token = data[4:].decode()
+            with self._lock:
+                event = self._write_waiters.get(token)
+                if event is not None:
+                    event.set()
+                elif self._enqueuing:  # 可能是还没来得及注册的
+                    self._handoffs.add(token)
+        elif data in (b"del", b"open"):  # 写锁被删除了或者挡路的写锁等待者没了，现在可以读了
+            with self._cond:
+                self._read_epoch += 1
+                self._cond.notify_all()
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    """离deadline还有多久，没有deadline返回None"""
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
@@ -0,0 +1,261 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import threading
+import time
+from typing import Callable, List, Literal, Optional, Union
+
+from redis import Redis
+from redis.cluster import RedisCluster
+
+from redislocks.exceptions import NotAvailable
+from redislocks.sync.dispatcher import get_dispatcher
+from redislocks.sync.library import get_library
+from redislocks.utils import ensure_bytes, namespaced_key
+
+
+class Semaphore:
+    """
+    redislocks.Semaphore的同步版本，用同样的key和脚本，可以和异步的信号量混用
+    client是redis.Redis，命令用它的连接池，一个信号量对象可以被多个线程共用
+
+    notify="publish"(默认)时client共享的后台线程监听EVENTS，有token放回来就叫醒等待的线程各自重试，
+    阻塞的线程不占连接，不保证先来后到
+    notify="blpop"时阻塞的线程各自BLMOVE进PENDING，各占一个连接池里的连接，只能用layout="list"
+    """
+
+    exists_val = "ok"
+
+    def __init__(
+        self,
+        value: int,
+        client: Optional[Redis] = None,
+        namespace: str = "SEMAPHORE",
+        stale_client_timeout: Optional[float] = None,
+        blocking: bool = True,
+        notify: Literal["blpop", "publish"] = "publish",
+        layout: Literal["list", "counter"] = "list",
+        hash_tag: Optional[bool] = None,
+    ):
+        self.client = client or Redis()
+        if hash_tag is None:
+            hash_tag = isinstance(self.client, RedisCluster)
+        self.hash_tag = hash_tag
+        if value < 1:
+            raise ValueError("Semaphore initial value must be >= 0")
+        if layout not in ("list", "counter"):
+            raise ValueError("layout must be 'list' or 'counter'")
+        if notify not in ("blpop", "publish"):
+            raise ValueError("notify must be 'blpop' or 'publish'")
+        if layout == "counter" and notify == "blpop":
+            raise ValueError("counter layout can only be used with notify='publish'")
+        self.value = value
+        self.namespace = namespace
+        self.stale_client_timeout = stale_client_timeout
+        self.blocking = blocking
+        self.notify = notify
+        self.layout = layout
+
+        self.check_exists_key = self.get_namespaced_key("EXISTS")
+        self.available_key = self.get_namespaced_key("AVAILABLE")
+        self.grabbed_key = self.get_namespaced_key("GRABBED")
+        self.seq_key = self.get_namespaced_key("SEQ")
+        self.pending_key = self.get_namespaced_key("PENDING")
+
+        library = get_library(self.client)
+        if layout == "list":
+            self._acquire_script = library["semacquire"]  # semacquire.lua
+            self._acquire_keys = [
+                self.check_exists_key,
+                self.available_key,
+                self.grabbed_key,
+                self.pending_key,
+            ]
+            self._release_script = library["semrelease"]  # semrelease.lua
+            self._release_keys = [self.available_key, self.grabbed_key]
+            self._reap_keys = [self.grabbed_key, self.available_key, self.pending_key]
+        else:
+            self._acquire_script = library[
+                "semacquire_counter"
+            ]  # semacquire_counter.lua
+            self._acquire_keys = [self.grabbed_key, self.seq_key]
+            self._release_script = library[
+                "semrelease_counter"
+            ]  # semrelease_counter.lua
+            self._release_keys = [self.grabbed_key]
+            self._reap_keys = [self.grabbed_key]
+        self._grab_script = library["semgrab"]  # semgrab.lua
+        self._reap_script = library["semreap"]  # semreap.lua
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)  # 等待的线程在上面等"release"
+        self._release_epoch = 0  # 每收到一次release加一
+        self._local_tokens = []  # type: List[Union[str, bytes]]
+
+        self._dispatcher = get_dispatcher(self.client)
+        self._event_channel = ensure_bytes(self.get_namespaced_key("EVENTS"))
+
+    def __del__(self):
+        dispatcher = getattr(self, "_dispatcher", None)
+        if dispatcher is not None:
+            dispatcher.unsubscribe(self._event_channel, self)
+
+    def _init(self):
+        with self.client.pipeline(transaction=True) as pipe:
+            if self.layout == "list":
+                pipe.delete(self.grabbed_key, self.available_key, self.pending_key)
+                pipe.rpush(self.available_key, *range(self.value))
+                pipe.set(self.check_exists_key, self.exists_val)
+            else:
+                pipe.delete(self.grabbed_key)
+            pipe.execute()
+        self.client.publish(self._event_channel, "release")
+
+    def acquire(
+        self, timeout: float = 0, target: Optional[Callable[[bytes], None]] = None
+    ):
+        """timeout为0表示一直等"""
+        if self.blocking and self.notify == "publish":  # 先订阅再尝试，不然可能漏掉中间的release
+            self._dispatcher.subscribe(self._event_channel, self)
+
+        with self._lock:
+            epoch = self._release_epoch
+        token = self._try_acquire()
+        if token is None:
+            if not self.blocking:
+                raise NotAvailable
+            if self.notify == "publish":
+                token = self._wait(epoch, timeout)
+            else:
+                token = self._blocking_pop(timeout)
+                if token is None:
+                    raise NotAvailable
+
+        if target is None:
+            with self._lock:
+                self._local_tokens.append(token)
+            return token
+        try:
+            target(token)
+        finally:
+            self.signal(token)
+        return token
+
+    def _try_acquire(self, retry: bool = False):
+        """retry为True表示被叫醒以后的重试，第一次失败已经记过contended了，不再记"""
+        return self._acquire_script(
+            self._acquire_keys,
+            [
+                self.value,
+                "",
+                "" if self.stale_client_timeout is None else self.stale_client_timeout,
+                self._event_channel,
+                1 if retry else "",
+            ],
+        )
+
+    def _blocking_pop(self, timeout: float) -> Optional[bytes]:
+        """
+        BLMOVE把token从AVAILABLE挪进PENDING，semgrab.lua再挪进GRABBED，超时返回None
+        两步之间进程挂了的话token留在PENDING里，回收的时候不会丢
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            remaining = 0 if deadline is None else deadline - time.monotonic()
+            if deadline is not None and remaining <= 0:
+                return None
+            token = self.client.blmove(
+                self.available_key, self.pending_key, remaining, "LEFT", "RIGHT"
+            )
+            if token is None:
+                return None
+            if self._grab_script([self.grabbed_key, self.pending_key], [token]):
+                return token
+            # 停得太久，token已经被当作超时回收了，重新等
+
+    def _wait(self, epoch: int, timeout: float):
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            with self._cond:
+                while epoch == self._release_epoch:
+                    remaining = (
+                        None if deadline is None else deadline - time.monotonic()
+                    )
+                    if remaining is not None and remaining <= 0:
+                        raise NotAvailable
+                    self._cond.wait(remaining)
+                epoch = self._release_epoch
+            token = self._try_acquire(retry=True)
+            if token is not None:
+                return token
+
+    def _handle_event(self, channel: bytes, data: bytes) -> None:
+        """在dispatcher的后台线程里调用，有token被放回来了"""
+        with self._cond:
+            self._release_epoch += 1
+            self._cond.notify_all()
+
+    def release_stale_locks(self, limit: int = 100) -> List[bytes]:
+        """回收获取时间超过stale_client_timeout的token，一次最多limit个，返回被回收的token"""
+        if self.stale_client_timeout is None:
+            raise ValueError("stale_client_timeout is not set")
+        return self._reap_script(
+            self._reap_keys, [self.stale_client_timeout, limit, self._event_channel]
+        )
+
+    def _is_locked(self, token) -> bool:
+        return self.client.zscore(self.grabbed_key, token) is not None
+
+    @property
+    def available_count(self) -> int:
+        if self.layout == "counter":
+            return self.value - self.client.zcard(self.grabbed_key)
+        return self.client.llen(self.available_key)
+
+    @property
+    def num_tokens(self):
+        return len(self._local_tokens)
+
+    def has_token(self) -> bool:
+        """当前信号量拥有至少一个token时返回True"""
+        with self._lock:
+            tokens = list(self._local_tokens)
+        return any(self._is_locked(token) for token in tokens)
+
+    def locked(self) -> bool:
+        """如果信号量不能被立刻获取返回True，list布局下PENDING里的token也算被拿走了"""
+        grabbed = self.client.zcard(self.grabbed_key)
+        if self.layout == "list":
+            grabbed += self.client.llen(self.pending_key)
+        return grabbed >= self.value
+
+    def release(self):
+        with self._lock:
+            if not self._local_tokens:
+                return False
+            token = self._local_tokens.pop()
+        return self.signal(token)
+
+    def release_all(self):
+        for _ in range(len(self._local_tokens)):
+            self.release()
+
+    def reset(self):
+        self._init()
+
+    def signal(self, token):
+        if token is None:
+            return None
+        if self._release_script(self._release_keys, [self._event_channel, token]):
+            return token
+        return None
+
+    def get_namespaced_key(self, suffix):
+        return namespaced_key(self.namespace, suffix, self.hash_tag)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -1,35 +1,22 @@
 -- 释放读锁
--- numkey: 2
--- namespace token
-local namespace = KEYS[1]
-local token = KEYS[2] -- read token
---local blocking = ARGV[1] -- string
-local read_key = namespace .. ":READ"
-local write_key = namespace .. ":WRITE"
-local write_waiter_key = namespace .. ":WRITEWAITER"
-
-local function get_state()
-    local read_lock_exists = redis.call("SCARD", read_key) > 0
-    local write_lock_exists = redis.call("EXISTS", write_key) == 1
-    local write_waiter_exists = redis.call("LLEN", write_waiter_key) > 0
-    if not read_lock_exists and not write_lock_exists then -- 没有读锁也没有写锁，是空的
-        return 0
-    elseif read_lock_exists and not write_lock_exists and not write_waiter_exists then -- 存在读锁，不存在写锁和写锁等待，读ing
-        return 1
-    elseif not read_lock_exists and write_lock_exists then -- 不存在读锁，存在写锁，写ing
-        return 2
-    elseif read_lock_exists and not write_lock_exists and  write_waiter_exists then -- 存在读锁，不存在写锁，不过有等待等待队列有东西
-        return 3
-    end
-end
-
-local current_state = get_state()
+-- numkey: 4
+-- keys: read_key write_key write_waiter_key lease_key [stats_key]
+-- argv: event_channel token [wait_ms hold_ms] 打开统计的时候客户端量的等待和持有时间
+local token = ARGV[2] -- read token
+local read_key = KEYS[1]
+local write_key = KEYS[2]
+local write_waiter_key = KEYS[3]
+local event_channel = ARGV[1]
+local lease_key = KEYS[4]
+local stats_key = KEYS[5]
 
 local ret = redis.call("SREM", read_key, token)
-if redis.call("SCARD", read_key) == 0 and current_state == 3 then
-    --读锁空了，有人在等写锁，且写锁现在还不存在， 那去掉读锁的过程就帮他们轮一下写锁
-    local write_token = redis.call("LPOP", write_waiter_key)
-    redis.call("SET", write_key, write_token)
+redis.call("ZREM", lease_key, token)
+record_release(stats_key, "r", ret, ARGV[3], ARGV[4])
+if ret == 1 and redis.call("SCARD", read_key) == 0 then
+    -- 读锁空了，有人在等写锁的话去掉读锁的过程就帮他们轮一下写锁，直接告诉等待者轮到谁了
+    -- 没人排队或者排在最前面的是MultiLock就发布"free"，等着拿写锁的MultiLock可以重试了
+    promote_or_free(read_key, write_key, write_waiter_key, event_channel, stats_key)
 end
 
 return ret
\ No newline at end of file
@@ -1,36 +1,34 @@
 -- 老写锁释放的时候带新写锁进来，或者读锁没有的时候带新写锁尽量
--- numkey: 1
--- namespace
-local namespace = KEYS[1]
+-- numkey: 4
+-- keys: read_key write_key write_waiter_key lease_key [stats_key]
+-- argv: event_channel [token] 给了token的话只有写锁还是它的时候才释放，租约过期被别人拿走了就不能乱放
+--       [wait_ms hold_ms] 打开统计的时候客户端量的等待和持有时间
+local token = ARGV[2]
 
-local read_key = namespace .. ":READ"
-local write_key = namespace .. ":WRITE"
-local write_waiter_key = namespace .. ":WRITEWAITER"
+local read_key = KEYS[1]
+local write_key = KEYS[2]
+local write_waiter_key = KEYS[3]
+local event_channel = ARGV[1]
+local lease_key = KEYS[4]
+local stats_key = KEYS[5]
 
-local read_lock_exists = redis.call("SCARD", read_key) > 0
-local write_lock_exists = redis.call("EXISTS", write_key) == 1
-local write_waiter_exists = redis.call("LLEN", write_waiter_key) > 0
+local current_state = get_state(read_key, write_key, write_waiter_key)
 
-local function get_state()
-    if not read_lock_exists and not write_lock_exists then -- 没有读锁也没有写锁，是空的
+if current_state == 2 then
+    local current_token = redis.call("GET", write_key)
+    if token and current_token ~= token then
         return 0
-    elseif read_lock_exists and not write_lock_exists and not write_waiter_exists then -- 存在读锁，不存在写锁和写锁等待，读ing
-        return 1
-    elseif not read_lock_exists and write_lock_exists then -- 不存在读锁，存在写锁，写ing
-        return 2
-    elseif read_lock_exists and not write_lock_exists and write_waiter_exists then -- 存在读锁，不存在写锁，不过有等待等待队列有东西
-        return 3
     end
-end
-
-local current_state = get_state()
-
-if current_state == 2 then
-    if write_waiter_exists then -- 还有人在等写锁，帮他轮
-        local write_token = redis.call("LPOP", write_waiter_key)
+    redis.call("ZREM", lease_key, current_token)
+    record_release(stats_key, "w", 1, ARGV[3], ARGV[4])
+    local write_token = pop_writer(write_waiter_key)
+    if write_token then -- 还有人在等写锁，帮他轮
         redis.call("SET", write_key, write_token)
+        redis.call("PUBLISH", event_channel, "set:" .. write_token) -- 直接告诉等待者轮到谁了
+        record_promotion(stats_key)
     else --  后面没有人在等写锁了，那就删除写锁
         redis.call("DEL", write_key)
+        redis.call("PUBLISH", event_channel, "del") -- 读锁可以进来了
     end
     return 1
 else
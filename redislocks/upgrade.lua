@@ -0,0 +1,53 @@
+-- 读锁原子地升级成写锁
+-- numkey: 5
+-- keys: read_key write_key write_waiter_key lease_key upgrader_key [stats_key]
+-- argv: event_channel read_token [lease_ms] [nowait]
+-- 返回 {token, 1} 只剩自己在读，直接拿到写锁
+--      {token, 0} 读锁已经放掉，排到了WRITEWAITER最前面，等别的读者走完由unlockread轮到
+--      {"", -1} 没有这个读锁
+--      {"", -2} 已经有别的读者在排队等升级，两个人会互相等对方的读锁，后来的只能失败
+--      {"", -3} nowait并且不能立刻升级
+-- 失败的时候读锁原样保留
+local read_token = ARGV[2]
+local lease_ms = tonumber(ARGV[3])
+local nowait = ARGV[4] == "1"
+local read_key = KEYS[1]
+local write_key = KEYS[2]
+local write_waiter_key = KEYS[3]
+local upgrader_key = KEYS[5]
+local lease_key = KEYS[4]
+local stats_key = KEYS[6]
+local event_channel = ARGV[1]
+
+if redis.call("SISMEMBER", read_key, read_token) == 0 then
+    return {"", -1}
+end
+
+local pending = redis.call("GET", upgrader_key)
+if pending and redis.call("ZRANGE", write_waiter_key, 0, 0)[1] == pending then
+    return {"", -2}
+end
+local alone = redis.call("SCARD", read_key) == 1
+if not alone and nowait then
+    return {"", -3}
+end
+
+local time = redis.call("TIME")
+local timestring = time[1] ..".".. time[2] -- string
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+redis.call("SREM", read_key, read_token)
+redis.call("ZREM", lease_key, read_token)
+if lease_ms then
+    redis.call("ZADD", lease_key, now_ms + lease_ms, timestring)
+end
+
+if alone then
+    -- 排队的写者本来就在等这个读锁，升级的直接插到他们前面
+    redis.call("SET", write_key, timestring)
+    return {timestring, 1}
+end
+redis.call("ZADD", write_waiter_key, "-inf", timestring)
+redis.call("SET", upgrader_key, timestring)
+redis.call("PUBLISH", event_channel, "wait") -- 告诉合并读锁的进程别再让新读者搭车了
+record_contended(stats_key, "w")
+return {timestring, 0}
@@ -25,3 +25,30 @@ def ensure_str(data) -> str:
         return data
     else:
         return str(data)
+
+
+def namespaced_key(namespace: str, suffix: str, hash_tag: bool = False) -> str:
+    """hash_tag为True时给namespace套上{}，同一个namespace的key会落在集群的同一个slot"""
+    if hash_tag and "{" not in namespace:
+        namespace = "{%s}" % namespace
+    return "{0}:{1}".format(namespace, suffix)
+
+
+# 写锁优先级的范围，lockwrite.lua里的分数要在2^53以内才是精确的
+MAX_PRIORITY = 1000
+
+
+def priority_args(priority: int, step: str) -> list:
+    """lockwrite.lua的[priority, step_us]，priority超出范围抛ValueError"""
+    if not -MAX_PRIORITY <= priority <= MAX_PRIORITY:
+        raise ValueError(f"priority must be between {-MAX_PRIORITY} and {MAX_PRIORITY}")
+    return [priority, step]
+
+
+def priority_step(priority_aging) -> str:
+    """priority_aging秒换算成lockwrite.lua的step_us，None表示严格按优先级"""
+    if priority_aging is None:
+        return ""
+    if priority_aging <= 0:
+        raise ValueError("priority_aging must be > 0")
+    return str(int(priority_aging * 1000000))
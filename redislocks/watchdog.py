@@ -0,0 +1,86 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+import weakref
+from typing import Optional
+
+from redis.asyncio import Redis, RedisCluster
+from redis.exceptions import ConnectionError, TimeoutError
+
+from redislocks.library import get_library
+
+
+class LeaseWatchdog:
+    """
+    一个Redis client共享一个续租task
+    锁拿到带租约的token或者开始等待以后调用watch注册自己，task每隔最短租约的1/3
+    把所有还在用的锁的lease.lua放进一个pipeline一起续掉，没有锁要续了task就退出
+    RedisCluster的pipeline不能跑脚本，改成并发地发出去
+    redis丢了脚本的话重新加载再续一次；连接断了下一轮再试，别的错误不吞掉，task带着异常结束，
+    下一次watch会重新启动它
+    锁需要提供client, lease_timeout, _lease_active()和async的_renew_lease(client)
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakSet()
+        self._task = None  # type: Optional[asyncio.Task]
+        self._interval = None  # type: Optional[float]
+        self._wakeup = None  # type: Optional[asyncio.Event]
+
+    def watch(self, lock) -> None:
+        self._locks.add(lock)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        elif self._interval is not None and lock.lease_timeout / 3 < self._interval:
+            self._wakeup.set()  # 来了个租约更短的，重新算间隔
+
+    async def _run(self):
+        while (interval := self._next_interval()) is not None:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+                self._wakeup.clear()
+                continue
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self._renew()
+            except (ConnectionError, TimeoutError):  # 下一轮再试，租约还没到期
+                pass
+        self._interval = None
+
+    def _next_interval(self) -> Optional[float]:
+        # 单独一个函数，免得_run的栈帧在sleep的时候一直引用着锁
+        timeouts = [lock.lease_timeout for lock in self._locks if lock._lease_active()]
+        self._interval = min(timeouts) / 3 if timeouts else None
+        return self._interval
+
+    async def _renew(self):
+        locks = [lock for lock in self._locks if lock._lease_active()]
+        if not locks:
+            return
+        client = locks[0].client
+        if isinstance(client, RedisCluster):
+            # 集群的pipeline里不能跑脚本，各个namespace也可能在不同的节点上，并发发出去
+            await asyncio.gather(*[lock._renew_lease(client) for lock in locks])
+            return
+
+        async def fill(pipe):
+            for lock in locks:
+                await lock._renew_lease(pipe)
+
+        await get_library(client).run_pipeline(fill)
+
+
+_watchdogs = (
+    weakref.WeakKeyDictionary()
+)  # type: weakref.WeakKeyDictionary[Redis, LeaseWatchdog]
+
+
+def get_watchdog(client: Redis) -> LeaseWatchdog:
+    """每个client只有一个watchdog"""
+    watchdog = _watchdogs.get(client)
+    if watchdog is None:
+        watchdog = _watchdogs[client] = LeaseWatchdog()
+    return watchdog
@@ -44,6 +44,10 @@ def main():
         maintainer="v-vinson",
         python_requires=">=3.6",
         install_requires=["redis", "aiofiles", "typing-extensions"],
+        extras_require={
+            "otel": ["opentelemetry-api"],
+            "prometheus": ["prometheus-client"],
+        },
         license="GPLv3",
         classifiers=[
             "Development Status :: 3 - Alpha",
@@ -7,22 +7,27 @@ from unittest import IsolatedAsyncioTestCase
 
 from dotenv import load_dotenv
 from redis.asyncio import Redis
+from redis.exceptions import ResponseError
 
-from redislocks import RWLock
+from redislocks import NotAvailable, RWLock
 
 load_dotenv("./.env")
 
 
 class TestLock(IsolatedAsyncioTestCase):
     async def delkeys(self):
-        await self.client.delete("RWLOCK:READ", "RWLOCK:WRITE", "RWLOCK:WRITEWAITER")
+        await self.client.delete(
+            "RWLOCK:READ", "RWLOCK:WRITE", "RWLOCK:WRITEWAITER", "RWLOCK:LEASES"
+        )
 
     async def asyncSetUp(self) -> None:
         self.client = Redis(host=os.getenv("REDIS"), max_connections=10)
         self.lock1 = RWLock(self.client)
         self.lock2 = RWLock(self.client)
         await self.client.config_set("notify-keyspace-events", "Ag$lshzxeKEtmdn")
-        await self.client.delete("RWLOCK:READ", "RWLOCK:WRITE", "RWLOCK:WRITEWAITER")
+        await self.client.delete(
+            "RWLOCK:READ", "RWLOCK:WRITE", "RWLOCK:WRITEWAITER", "RWLOCK:LEASES"
+        )
 
     async def test_havelock(self):
         await self.lock1.acquire("r")
@@ -126,6 +131,18 @@ class TestLock(IsolatedAsyncioTestCase):
         print(await self.client.keys("*"))
         await self.delkeys()
 
+    async def test_batch_wakeup_read(self):
+        await self.lock1.acquire("w")
+        tasks = [asyncio.create_task(self.lock2.acquire("r")) for _ in range(8)]
+        await asyncio.sleep(0.5)
+        self.assertEqual(len(self.lock2._read_waiters), 8)
+        await self.lock1.release("w")
+        tokens = await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        self.assertEqual(len(set(tokens)), 8)
+        self.assertEqual(await self.client.scard("RWLOCK:READ"), 8)
+        await self.lock2.release_all()
+        self.assertEqual(await self.lock2.get_state(), 0)
+
     async def test_write_first(self):
         async def acquire_task():
             await self.lock1.acquire("r")
@@ -138,7 +155,7 @@ class TestLock(IsolatedAsyncioTestCase):
         self.assertTrue(await self.lock1.locked("w"))
         print(await self.client.keys("*"))
         print(await self.client.smembers("RWLOCK:READ"))
-        print(await self.client.lrange("RWLOCK:WRITEWAITER", 0, 5))
+        print(await self.client.zrange("RWLOCK:WRITEWAITER", 0, 5))
         # await self.lock2.acquire("r")
         with self.assertRaises(asyncio.TimeoutError):  # 此时也不能加读锁了
             await asyncio.wait_for(self.lock2.acquire("r"), 1)
@@ -160,8 +177,240 @@ class TestLock(IsolatedAsyncioTestCase):
         await asyncio.sleep(0.5)
         self.assertEquals(await self.lock2.get_state(), 3)
 
+    async def test_cancel_write_waiter(self):
+        await self.lock1.acquire("r")
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.lock2.acquire("w"), 1)
+        self.assertEqual(await self.client.zcard("RWLOCK:WRITEWAITER"), 0)
+        self.assertFalse(await self.client.exists("RWLOCK:EXISTS"))
+        await self.lock1.release("r")
+        self.assertEqual(await self.lock2.get_state(), 0)
+        await self.delkeys()
+
+    async def test_publish_notify(self):
+        """不打开keyspace事件也能唤醒"""
+        await self.client.config_set("notify-keyspace-events", "")
+        lock1 = RWLock(self.client, notify="publish")
+        lock2 = RWLock(self.client, notify="publish")
+        await lock1.acquire("w")
+        task = asyncio.create_task(lock2.acquire("r"))
+        await asyncio.sleep(0.5)
+        await lock1.release("w")
+        await asyncio.wait_for(task, 1)
+        await lock2.release("r")
+
+        await lock1.acquire("r")
+        task = asyncio.create_task(lock2.acquire("w"))
+        await asyncio.sleep(0.5)
+        await lock1.release("r")
+        await asyncio.wait_for(task, 1)
+        await lock2.release("w")
+        self.assertEqual(await lock2.get_state(), 0)
+
+    async def test_keyspace_single_wakeup(self):
+        """keyspace模式下写锁被删只处理keyspace事件，不理EVENTS上重复的del"""
+        await self.lock1.acquire("w")
+        task = asyncio.create_task(self.lock2.acquire("r"))
+        await asyncio.sleep(0.5)
+        epoch = self.lock2._read_epoch
+        await self.lock1.release("w")
+        await asyncio.wait_for(task, 1)
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.lock2._read_epoch, epoch + 1)
+        await self.lock2.release("r")
+
+    async def test_keyspace_open(self):
+        """取消最后一个排队的写者，写锁key没变，keyspace模式的读者靠EVENTS上的open醒过来"""
+        await self.lock1.acquire("r")
+        writer = asyncio.create_task(self.lock2.acquire("w"))
+        await asyncio.sleep(0.2)
+        lock3 = RWLock(self.client)
+        reader = asyncio.create_task(lock3.acquire("r"))
+        await asyncio.sleep(0.2)
+        self.assertFalse(reader.done())
+        writer.cancel()
+        await asyncio.wait_for(reader, 1)
+        await lock3.release("r")
+        await self.lock1.release("r")
+        self.assertEqual(await self.lock1.get_state(), 0)
+
+    async def test_shared_dispatcher(self):
+        """同一个client上的锁共用一个pubsub连接"""
+        lock3 = RWLock(self.client, namespace="RWLOCK3")
+        lock4 = RWLock(self.client, namespace="RWLOCK3")
+        await lock3.acquire("r")
+        await lock4.acquire("r")
+        channel = f"__keyspace@{lock3._get_db()}__:RWLOCK3:WRITE"
+        self.assertEqual(
+            await self.client.pubsub_numsub(channel), [(channel.encode(), 1)]
+        )
+        await lock3.release("r")
+        await lock4.release("r")
+        del lock3, lock4
+        await asyncio.sleep(0.1)
+        self.assertEqual(
+            await self.client.pubsub_numsub(channel), [(channel.encode(), 0)]
+        )
+
+    async def test_dispatcher_reconnect(self):
+        """pubsub连接断了，重连以后等待者自己重新检查，不会因为漏了事件一直等"""
+        await self.lock1.acquire("w")
+        reader = asyncio.create_task(self.lock2.acquire("r"))
+        await asyncio.sleep(0.1)
+        await self.client.client_kill_filter(_type="pubsub")
+        await self.lock1.release("w")  # 断线期间的del丢了
+        await asyncio.wait_for(reader, 3)
+        await self.lock2.release("r")
+
+        await self.lock1.acquire("w")
+        writer = asyncio.create_task(self.lock2.acquire("w"))
+        await asyncio.sleep(0.1)
+        await self.client.client_kill_filter(_type="pubsub")
+        await self.lock1.release("w")  # 断线期间轮给writer的set:<token>丢了
+        await asyncio.wait_for(writer, 3)
+        await self.lock2.release("w")
+        self.assertEqual(await self.lock1.get_state(), 0)
+
+    async def test_coalesce_reads(self):
+        """同一个锁上的读者共用一个读锁token，有写锁排队以后不再搭车"""
+        lock1 = RWLock(self.client, coalesce_reads=True)
+        tokens = await asyncio.gather(*(lock1.acquire("r") for _ in range(20)))
+        self.assertEqual(len(set(tokens)), 1)
+        self.assertEqual(await self.client.scard("RWLOCK:READ"), 1)
+
+        writer = asyncio.create_task(self.lock2.acquire("w"))
+        await asyncio.sleep(0.5)
+        self.assertEqual(await self.lock2.get_state(), 3)
+        reader = asyncio.create_task(lock1.acquire("r"))  # 写锁优先，只能等
+        for _ in range(19):
+            await lock1.release("r")
+        await asyncio.sleep(0.2)
+        self.assertFalse(writer.done())
+        await lock1.release("r")
+        await asyncio.wait_for(writer, 1)
+        self.assertFalse(reader.done())
+        await self.lock2.release("w")
+        self.assertNotEqual(await asyncio.wait_for(reader, 1), tokens[0])
+        await lock1.release("r")
+        self.assertEqual(await lock1.get_state(), 0)
+
+    async def test_lease_renew(self):
+        """watchdog在后台续租，持有时间超过租约也不会丢锁"""
+        lock1 = RWLock(self.client, lease_timeout=0.5)
+        await lock1.acquire("w")
+        await asyncio.sleep(1.5)
+        self.assertTrue(await lock1.has_token("w"))
+        await lock1.release("w")
+        self.assertEqual(await self.client.zcard("RWLOCK:LEASES"), 0)
+
+    async def test_lease_renew_after_flush(self):
+        """redis丢了脚本，watchdog的pipeline重新加载以后接着续租"""
+        lock1 = RWLock(self.client, lease_timeout=0.6)
+        token = await lock1.acquire("w")
+        await self.client.script_flush()
+        try:
+            await self.client.function_flush()
+        except ResponseError:  # redis 7以前没有FUNCTION
+            pass
+        await asyncio.sleep(1.5)
+        seconds, microseconds = await self.client.time()
+        now_ms = seconds * 1000 + microseconds // 1000
+        self.assertGreater(await self.client.zscore("RWLOCK:LEASES", token), now_ms)
+        await lock1.release("w")
+
+    async def test_lease_expire(self):
+        """没人续租的写锁过期以后，等待的读者和写者被唤醒"""
+        lock1 = RWLock(self.client, lease_timeout=0.5)
+        lock2 = RWLock(self.client, lease_timeout=0.5)
+        # 直接跑脚本拿写锁，不注册watchdog，相当于拿完锁进程就挂了
+        await lock1._lockwrite_nowait_script(lock1._keys, [lock1._event_channel, 500])
+        writer = asyncio.create_task(lock2.acquire("w"))
+        reader = asyncio.create_task(lock1.acquire("r"))
+        await asyncio.wait_for(writer, 2)
+        self.assertFalse(reader.done())
+        await lock2.release("w")
+        await asyncio.wait_for(reader, 1)
+        await lock1.release("r")
+        self.assertEqual(await lock1.get_state(), 0)
+
+    async def test_upgrade_downgrade(self):
+        await self.lock1.acquire("r")
+        token = await self.lock1.upgrade()
+        self.assertEqual(await self.lock1.get_state(), 2)
+        self.assertTrue(await self.lock1.has_token("w"))
+        self.assertFalse(await self.lock1.has_token("r"))
+        reader = asyncio.create_task(self.lock2.acquire("r"))
+        await asyncio.sleep(0.2)
+        self.assertFalse(reader.done())
+        self.assertNotEqual(await self.lock1.downgrade(), token)
+        await asyncio.wait_for(reader, 1)  # 降级以后读者可以一起进来
+        self.assertEqual(await self.client.scard("RWLOCK:READ"), 2)
+        await self.lock1.release("r")
+        await self.lock2.release("r")
+        self.assertEqual(await self.lock1.get_state(), 0)
+
+    async def test_upgrade_queue(self):
+        """升级排在已经排队的写者前面，第二个升级的直接失败"""
+        lock3 = RWLock(self.client)
+        await self.lock1.acquire("r")
+        await self.lock2.acquire("r")
+        writer = asyncio.create_task(lock3.acquire("w"))
+        await asyncio.sleep(0.2)
+        upgrader = asyncio.create_task(self.lock1.upgrade())
+        await asyncio.sleep(0.2)
+        self.assertFalse(upgrader.done())
+        with self.assertRaises(NotAvailable):
+            await self.lock2.upgrade()
+        self.assertTrue(await self.lock2.has_token("r"))
+        await self.lock2.release("r")
+        token = await asyncio.wait_for(upgrader, 1)
+        self.assertEqual((await self.client.get("RWLOCK:WRITE")).decode(), token)
+        self.assertFalse(writer.done())
+        await self.lock1.release("w")
+        await asyncio.wait_for(writer, 1)
+        await lock3.release("w")
+        self.assertEqual(await self.lock1.get_state(), 0)
+
+    async def _writers_order(self, locks, priorities, gap=0.05):
+        """lock1拿着写锁的时候依次排进去，返回轮到的顺序"""
+        order = []
+
+        async def writer(i, lock, priority):
+            await lock.acquire("w", priority=priority)
+            order.append(i)
+            await lock.release("w")
+
+        await locks[0].acquire("w")
+        tasks = []
+        for i, (lock, priority) in enumerate(zip(locks[1:], priorities)):
+            tasks.append(asyncio.create_task(writer(i, lock, priority)))
+            await asyncio.sleep(gap)
+        await locks[0].release("w")
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+        return order
+
+    async def test_writer_priority(self):
+        locks = [RWLock(self.client) for _ in range(6)]
+        order = await self._writers_order(locks, [0, 5, -1, 5, 1])
+        self.assertEqual(order, [1, 3, 4, 0, 2])  # 大的先，同一优先级先来后到
+        self.assertEqual(await self.lock1.get_state(), 0)
+        with self.assertRaises(ValueError):
+            await self.lock1.acquire("r", priority=1)
+        with self.assertRaises(ValueError):
+            await self.lock1.acquire("w", priority=1001)
+
+    async def test_writer_priority_aging(self):
+        locks = [RWLock(self.client, priority_aging=0.1) for _ in range(4)]
+        # 第一个多等了0.5秒，顶得上5级，比晚来的2级先轮到
+        order = await self._writers_order(locks, [0, 2, 9], gap=0.5)
+        self.assertEqual(order, [0, 2, 1])
+        with self.assertRaises(ValueError):
+            RWLock(self.client, priority_aging=0)
+
     async def asyncTearDown(self) -> None:
-        await self.client.delete("RWLOCK:READ", "RWLOCK:WRITE", "RWLOCK:WRITEWAITER")
+        await self.client.delete(
+            "RWLOCK:READ", "RWLOCK:WRITE", "RWLOCK:WRITEWAITER", "RWLOCK:LEASES"
+        )
 
 
 if __name__ == "__main__":
@@ -6,9 +6,9 @@ import os
 from unittest import IsolatedAsyncioTestCase
 
 from dotenv import load_dotenv
-from redis.asyncio import Redis
+from redis.asyncio import BlockingConnectionPool, Redis
 
-from redislocks import NotAvailable, Semaphore
+from redislocks import NotAvailable, Semaphore, StripedSemaphore
 
 load_dotenv("./.env")
 
@@ -53,6 +53,282 @@ class TestSem(IsolatedAsyncioTestCase):
 
         await self.sem1.reset()
 
+    async def test_publish_waiters(self):
+        """等待者不占用连接，3个连接的池子也能排几十个等待者"""
+        client = Redis(
+            connection_pool=BlockingConnectionPool(
+                host=os.getenv("REDIS"), max_connections=3
+            )
+        )
+        sem = Semaphore(2, client, notify="publish")
+        await sem.acquire()
+        await sem.acquire()
+        tasks = [asyncio.create_task(sem.acquire()) for _ in range(30)]
+        await asyncio.sleep(0.5)
+        self.assertEqual(len(sem._waiters), 30)
+        for _ in range(32):
+            await asyncio.wait_for(sem.release(), 1)
+            await asyncio.sleep(0.01)
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        self.assertEqual(sem.num_tokens, 0)
+        self.assertEqual(await sem.available_count, 2)
+        await sem.acquire()
+        await sem.acquire()
+        with self.assertRaises(NotAvailable):
+            await sem.acquire(timeout=0.5)
+        self.assertEqual(len(sem._waiters), 0)
+        await sem.release_all()
+
+    async def test_acquire_many_wait(self):
+        await self.sem1.acquire()
+        task = asyncio.create_task(self.sem2.acquire_many(2))
+        await asyncio.sleep(0.5)
+        self.assertEqual(await self.sem2.available_count, 1)  # 一个都没拿
+        await self.sem1.release()
+        tokens = await asyncio.wait_for(task, 1)
+        self.assertEqual(len(tokens), 2)
+        self.assertTrue(await self.sem2.locked())
+        await self.sem2.release_many(tokens)
+
+    async def test_counter_wakeup(self):
+        sem = Semaphore(
+            1,
+            Redis(host=os.getenv("REDIS"), max_connections=10),
+            namespace="SEMCOUNTER",
+            layout="counter",
+        )
+        await sem.reset()
+        await sem.acquire()
+        task = asyncio.create_task(sem.acquire())
+        await asyncio.sleep(0.5)
+        self.assertFalse(task.done())
+        await sem.release()
+        await asyncio.wait_for(task, 1)
+        await sem.release()
+        self.assertEqual(await sem.available_count, 1)
+
+    async def test_fair_order(self):
+        """公平模式按排队的先后拿到，release的时候直接交给队首"""
+        for layout in ("list", "counter"):
+            client = Redis(host=os.getenv("REDIS"), max_connections=10)
+            namespace = f"SEMFAIR{layout}"
+            sem = Semaphore(1, client, namespace, layout=layout, fair=True)
+            await sem.reset()
+            await sem.acquire()
+            order = []
+
+            async def worker(i):
+                async with Semaphore(1, client, namespace, layout=layout, fair=True):
+                    order.append(i)
+                    await asyncio.sleep(0.01)
+
+            tasks = []
+            for i in range(5):
+                tasks.append(asyncio.create_task(worker(i)))
+                await asyncio.sleep(0.05)  # 保证排队的顺序
+            self.assertEqual(await client.llen(sem.queue_key), 5)
+            await sem.release()
+            await asyncio.wait_for(asyncio.gather(*tasks), 2)
+            self.assertEqual(order, [0, 1, 2, 3, 4])
+            self.assertEqual(await sem.available_count, 1)
+            await asyncio.sleep(0.1)  # 收到grant消息的票在后台删掉
+            self.assertEqual(await client.exists(sem.grants_key, sem.tickets_key), 0)
+
+    async def test_fair_no_barging(self):
+        """有人排队的时候新来的不能插队，要的多的队首也不会被要的少的饿死"""
+        client = Redis(host=os.getenv("REDIS"), max_connections=10)
+        sem = Semaphore(2, client, "SEMFAIRBARGE", fair=True)
+        await sem.reset()
+        token = await sem.acquire()
+        big = asyncio.create_task(sem.acquire_many(2))
+        await asyncio.sleep(0.1)
+        nonblocking = Semaphore(2, client, "SEMFAIRBARGE", fair=True, blocking=False)
+        with self.assertRaises(NotAvailable):  # 还剩一个，但是big在排队
+            await nonblocking.acquire()
+        self.assertTrue(await nonblocking.locked())
+        await sem.signal(token)
+        self.assertEqual(len(await asyncio.wait_for(big, 1)), 2)
+        await sem.release_many(await big)
+
+    async def test_fair_timeout_and_cancel(self):
+        """超时和取消的票会出队，不会挡住后面的人"""
+        client = Redis(host=os.getenv("REDIS"), max_connections=10)
+        sem = Semaphore(1, client, "SEMFAIRCANCEL", fair=True)
+        await sem.reset()
+        await sem.acquire()
+        with self.assertRaises(NotAvailable):
+            await sem.acquire(timeout=0.2)
+        cancelled = asyncio.create_task(sem.acquire())
+        waiter = asyncio.create_task(sem.acquire())
+        await asyncio.sleep(0.1)
+        cancelled.cancel()
+        await asyncio.sleep(0.1)
+        self.assertEqual(await client.llen(sem.queue_key), 1)
+        await sem.release()
+        await asyncio.wait_for(waiter, 1)
+        await sem.release()
+        self.assertEqual(await sem.available_count, 1)
+        self.assertEqual(await client.llen(sem.queue_key), 0)
+
+    async def test_fair_dead_waiter(self):
+        """排队的进程挂了，票过期以后后面的人照样能拿到"""
+        client = Redis(host=os.getenv("REDIS"), max_connections=10)
+        sem = Semaphore(1, client, "SEMFAIRDEAD", fair=True, ticket_timeout=0.3)
+        await sem.reset()
+        await sem.acquire()
+        # 直接跑脚本排队，没有人续期，相当于排上队进程就挂了
+        await sem._fair_acquire_script(1, "dead/1")
+        waiter = asyncio.create_task(sem.acquire())
+        await asyncio.sleep(0.05)
+        await sem.release()  # 交给了dead
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.shield(waiter), 0.1)
+        # dead拿到的token被stale_client_timeout回收
+        await client.zrem(sem.grabbed_key, "0")
+        await client.lpush(sem.available_key, "0")
+        await asyncio.wait_for(waiter, 1)  # 续期的时候补发
+        await sem.release()
+
+    async def test_fair_reap(self):
+        """release_stale_locks回收的token马上交给排队的，不用等续期"""
+        client = Redis(host=os.getenv("REDIS"), max_connections=10)
+        sem = Semaphore(
+            1,
+            client,
+            "SEMFAIRREAP",
+            stale_client_timeout=0.2,
+            fair=True,
+            ticket_timeout=30,
+        )
+        await sem.reset()
+        await sem.acquire()  # 相当于拿完就挂了
+        waiter = asyncio.create_task(sem.acquire())
+        await asyncio.sleep(0.3)
+        self.assertFalse(waiter.done())
+        self.assertEqual(await sem.release_stale_locks(), [b"0"])
+        await asyncio.wait_for(waiter, 1)
+        await sem.release()
+        await asyncio.sleep(0.1)
+        self.assertEqual(await client.exists(sem.grants_key, sem.tickets_key), 0)
+
+    async def test_striped_wakeup(self):
+        """所有子信号量都拿完了，哪个子信号量放回来都能唤醒"""
+        for notify in ("blpop", "publish"):
+            sem = StripedSemaphore(
+                4,
+                4,
+                Redis(host=os.getenv("REDIS"), max_connections=10),
+                namespace="SEMSTRIPED",
+                notify=notify,
+            )
+            await sem.reset()
+            tokens = [await sem.acquire() for _ in range(4)]
+            task = asyncio.create_task(sem.acquire())
+            await asyncio.sleep(0.5)
+            self.assertFalse(task.done())
+            await sem.signal(tokens[2])
+            self.assertEqual(await asyncio.wait_for(task, 1), tokens[2])
+            await sem.reset()
+
+    def _slow_grab(self, sem):
+        """grab慢一点，好在BLMOVE/BLPOP拿到token之后取消"""
+        script = sem._grab_script
+
+        async def slow(keys, args, client=None):
+            await asyncio.sleep(0.2)
+            return await script(keys, args)
+
+        sem._grab_script = slow
+
+    async def test_cancel_after_pop(self):
+        await self.sem1.acquire()
+        await self.sem1.acquire()
+        self._slow_grab(self.sem2)
+        task = asyncio.create_task(self.sem2.acquire())
+        await asyncio.sleep(0.1)
+        await self.sem1.release()
+        await asyncio.sleep(0.1)  # token已经挪进PENDING，grab还没跑完
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.3)
+        self.assertEqual(await self.sem1.available_count, 1)  # token还回来了
+        self.assertEqual(await self.sem1.client.zcard(self.sem1.grabbed_key), 1)
+        self.assertEqual(await self.sem1.client.llen(self.sem1.pending_key), 0)
+
+    async def test_pending_reaped(self):
+        """BLMOVE之后进程挂了，token留在PENDING里，过stale_client_timeout以后被回收"""
+        sem = Semaphore(
+            1,
+            self.sem1.client,
+            namespace="SEMPENDING",
+            stale_client_timeout=0.2,
+            blocking=False,
+        )
+        await sem.reset()
+        await sem.client.lmove(sem.available_key, sem.pending_key)
+        self.assertTrue(await sem.locked())  # PENDING里的token也算被拿走了
+        with self.assertRaises(NotAvailable):
+            await sem.acquire()  # 当作刚被拿走
+        self.assertEqual(await sem.client.llen(sem.pending_key), 0)
+        await asyncio.sleep(0.3)
+        await sem.acquire()
+        await sem.release()
+        await sem.reset()
+
+    async def test_striped_cancel_after_pop(self):
+        sem = StripedSemaphore(
+            2,
+            1,
+            Redis(host=os.getenv("REDIS"), max_connections=10),
+            namespace="SEMSTRIPEDCANCEL",
+        )
+        await sem.reset()
+        tokens = [await sem.acquire() for _ in range(2)]
+        for stripe in sem.stripes:
+            self._slow_grab(stripe)
+        task = asyncio.create_task(sem.acquire())
+        await asyncio.sleep(0.1)
+        await sem.signal(tokens[0])
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.3)
+        self.assertEqual(await sem.available_count, 1)
+        await sem.reset()
+
+    async def test_striped_pending(self):
+        """BLMOVE进PENDING之后进程挂了，token过stale_client_timeout以后被回收，不会丢"""
+        client = Redis(host=os.getenv("REDIS"), max_connections=10)
+        sem = StripedSemaphore(2, 2, client, namespace="SEMSTRIPEDPENDING")
+        self.assertEqual(sem.notify, "publish")  # 好几个list没法BLMOVE
+        sem = StripedSemaphore(
+            1, 1, client, namespace="SEMSTRIPEDPENDING", stale_client_timeout=0.2
+        )
+        self.assertEqual(sem.notify, "blpop")
+        await sem.reset()
+        token = await sem.acquire()
+        stripe = sem.stripes[0]
+        grab = stripe._grab_script
+
+        async def crash(keys, args, client=None):
+            raise ConnectionError("crashed")
+
+        stripe._grab_script = crash
+        task = asyncio.create_task(sem.acquire())
+        await asyncio.sleep(0.1)
+        await sem.signal(token)
+        with self.assertRaises(ConnectionError):
+            await asyncio.wait_for(task, 1)
+        self.assertEqual(await client.llen(stripe.pending_key), 1)
+        stripe._grab_script = grab
+        await sem.release_stale_locks()  # 当作刚被拿走
+        await asyncio.sleep(0.3)
+        self.assertEqual(await sem.release_stale_locks(), [token])
+        self.assertEqual(await asyncio.wait_for(sem.acquire(), 1), token)
+        await sem.reset()
+
     async def asyncTearDown(self) -> None:
         await self.sem1.reset()
 
@@ -0,0 +1,236 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from redislocks import (
+    MemoryBackend,
+    MultiLock,
+    NotAvailable,
+    RWLock,
+    Semaphore,
+    StripedSemaphore,
+)
+
+
+class TestMemory(IsolatedAsyncioTestCase):
+    """不需要Redis也不需要.env"""
+
+    async def asyncSetUp(self) -> None:
+        self.client = MemoryBackend()
+
+    async def test_read_write(self):
+        lock1 = RWLock(self.client)
+        lock2 = RWLock(self.client)
+        self.assertEqual(lock1.notify, "publish")
+        token = await lock1.acquire("r")
+        self.assertTrue(await self.client.sismember("RWLOCK:READ", token))
+        await lock2.acquire("r")
+        writer = asyncio.create_task(lock2.acquire("w"))
+        await asyncio.sleep(0.05)
+        self.assertEqual(await lock1.get_state(), 3)
+        with self.assertRaises(asyncio.TimeoutError):  # 有写锁在等，新读者进不来
+            await asyncio.wait_for(RWLock(self.client).acquire("r"), 0.1)
+        await lock1.release("r")
+        await lock2.release("r")
+        write_token = await asyncio.wait_for(writer, 1)
+        self.assertEqual((await self.client.get("RWLOCK:WRITE")).decode(), write_token)
+        reader = asyncio.create_task(lock1.acquire("r"))
+        await asyncio.sleep(0.05)
+        self.assertFalse(reader.done())
+        await lock2.release("w")
+        await asyncio.wait_for(reader, 1)
+        await lock1.release("r")
+        self.assertEqual(await lock1.get_state(), 0)
+        self.assertEqual(self.client.keyspace._data, {})
+
+    async def test_nonblocking(self):
+        lock1 = RWLock(self.client, blocking=False)
+        lock2 = RWLock(self.client, blocking=False)
+        await lock1.acquire("w")
+        with self.assertRaises(NotAvailable):
+            await lock2.acquire("r")
+        await lock1.downgrade()
+        await lock2.acquire("r")
+        with self.assertRaises(NotAvailable):
+            await lock1.upgrade()
+        await lock2.release("r")
+        await lock1.upgrade()
+        self.assertTrue(await lock1.has_token("w"))
+        await lock1.release("w")
+        self.assertEqual(await lock1.get_state(), 0)
+
+    async def test_lease(self):
+        lock1 = RWLock(self.client, lease_timeout=0.2)
+        lock2 = RWLock(self.client, lease_timeout=0.2)
+        # 直接跑脚本拿写锁，不注册watchdog，相当于拿完锁进程就挂了
+        await lock1._lockwrite_nowait_script(lock1._keys, [lock1._event_channel, 200])
+        await asyncio.wait_for(lock2.acquire("w"), 1)
+        await asyncio.sleep(0.3)  # lock2有watchdog续租
+        self.assertTrue(await lock2.has_token("w"))
+        await lock2.release("w")
+
+    async def test_semaphore(self):
+        for layout in ("list", "counter"):
+            for notify in ("blpop", "publish"):
+                if layout == "counter" and notify == "blpop":
+                    continue
+                namespace = f"SEM{layout}{notify}"
+                sem = Semaphore(2, self.client, namespace, layout=layout, notify=notify)
+                running = []
+                peak = []
+
+                async def worker():
+                    async with Semaphore(
+                        2, self.client, namespace, layout=layout, notify=notify
+                    ):
+                        running.append(1)
+                        peak.append(len(running))
+                        await asyncio.sleep(0.01)
+                        running.pop()
+
+                await asyncio.wait_for(asyncio.gather(*[worker() for _ in range(6)]), 2)
+                self.assertEqual(len(peak), 6)
+                self.assertEqual(max(peak), 2)
+                self.assertEqual(await sem.available_count, 2)
+
+    async def test_stale_semaphore(self):
+        # 计数模式的token不会重复，回收以后sem1就没有token了
+        sem1, sem2 = [
+            Semaphore(
+                1,
+                self.client,
+                stale_client_timeout=0.1,
+                blocking=False,
+                layout="counter",
+            )
+            for _ in range(2)
+        ]
+        await sem1.acquire()
+        with self.assertRaises(NotAvailable):
+            await sem2.acquire()
+        await asyncio.sleep(0.15)
+        await sem2.acquire()  # sem1的token过期被回收了
+        self.assertFalse(await sem1.has_token())
+        await sem2.release()
+
+    async def test_fair_semaphore(self):
+        for layout in ("list", "counter"):
+            namespace = f"SEMFAIR{layout}"
+            sem = Semaphore(1, self.client, namespace, layout=layout, fair=True)
+            await sem.acquire()
+            order = []
+
+            async def worker(i):
+                async with Semaphore(
+                    1, self.client, namespace, layout=layout, fair=True
+                ):
+                    order.append(i)
+                    await asyncio.sleep(0)
+
+            tasks = []
+            for i in range(5):
+                tasks.append(asyncio.create_task(worker(i)))
+                await asyncio.sleep(0.01)
+            with self.assertRaises(NotAvailable):
+                await sem.acquire(timeout=0.05)
+            await sem.release()
+            self.assertTrue(await sem.locked())  # token已经交给了队首
+            await asyncio.wait_for(asyncio.gather(*tasks), 1)
+            self.assertEqual(order, [0, 1, 2, 3, 4])
+            self.assertEqual(await sem.available_count, 1)
+            await asyncio.sleep(0)
+            self.assertEqual(
+                await self.client.exists(sem.grants_key, sem.tickets_key), 0
+            )
+
+    async def test_writer_priority(self):
+        holder = RWLock(self.client, namespace="PRIO")
+        await holder.acquire("w")
+        order = []
+
+        async def writer(i, priority):
+            lock = RWLock(self.client, namespace="PRIO")
+            await lock.acquire("w", priority=priority)
+            order.append(i)
+            await lock.release("w")
+
+        tasks = []
+        for i, priority in enumerate([0, 3, 3, -2, 1]):
+            tasks.append(asyncio.create_task(writer(i, priority)))
+            await asyncio.sleep(0.01)
+        await holder.release("w")
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        self.assertEqual(order, [1, 2, 4, 0, 3])
+        self.assertEqual(await holder.get_state(), 0)
+
+    async def test_zset(self):
+        """zset和Redis一样按(分数, member)排序，分数改了位置跟着变"""
+        db = self.client.keyspace
+        self.assertEqual(db.zadd("Z", {"b": 2, "a": 2, "c": 1, "d": 3}), 4)
+        self.assertEqual(db.zrangebyscore("Z", 2), [b"c", b"a", b"b"])
+        self.assertEqual(db.zrangebyscore("Z", 2, exclusive=True), [b"c"])
+        self.assertEqual(db.zrangebyscore("Z", 3, limit=2), [b"c", b"a"])
+        self.assertEqual(db.zrank("Z", "b"), 2)
+        self.assertEqual(db.zadd("Z", {"d": 0, "e": 5}, xx=True), 1)
+        self.assertEqual(db.zfirst("Z"), b"d")
+        self.assertEqual(db.zpopmin("Z"), b"d")
+        self.assertEqual(db.zrem("Z", "a", "x"), 1)
+        self.assertEqual((db.zcard("Z"), db.zscore("Z", "b")), (2, 2))
+        self.assertEqual(db.zrank("Z", "a"), None)
+        db.zrem("Z", "b", "c")
+        self.assertEqual(db._data, {})
+
+    async def test_striped(self):
+        sem = StripedSemaphore(4, 2, self.client, blocking=False)
+        tokens = [await sem.acquire() for _ in range(4)]
+        self.assertEqual(len(set(tokens)), 4)
+        with self.assertRaises(NotAvailable):
+            await sem.acquire()
+        await sem.release_all()
+        self.assertEqual(await sem.available_count, 4)
+
+    async def test_multilock(self):
+        lock1 = RWLock(self.client, namespace="MULTI1")
+        lock2 = RWLock(self.client, namespace="MULTI2")
+        multi = MultiLock([("MULTI1", "w"), ("MULTI2", "r")], self.client)
+        await lock1.acquire("r")
+        task = asyncio.create_task(multi.acquire())
+        await asyncio.sleep(0.05)
+        self.assertFalse(task.done())
+        await lock1.release("r")
+        token = await asyncio.wait_for(task, 1)
+        self.assertTrue(await self.client.sismember("MULTI2:READ", token))
+        waiter = asyncio.create_task(lock1.acquire("w"))
+        await asyncio.sleep(0.05)
+        await multi.release()
+        await asyncio.wait_for(waiter, 1)
+        await lock1.release("w")
+        self.assertEqual(await lock2.get_state(), 0)
+
+    async def test_many_tasks(self):
+        """一把锁被很多task抢，写锁互斥，读锁可以并发"""
+        lock = RWLock(self.client)
+        inside = {"r": 0, "w": 0}
+        overlaps = []
+
+        async def worker(mode):
+            for _ in range(20):
+                await lock.acquire(mode)
+                inside[mode] += 1
+                if inside["w"] > 1 or (inside["w"] and inside["r"]):
+                    overlaps.append(mode)
+                await asyncio.sleep(0)
+                inside[mode] -= 1
+                await lock.release(mode)
+
+        await asyncio.wait_for(asyncio.gather(*[worker(mode) for mode in "rrrwwrw"]), 5)
+        self.assertEqual(overlaps, [])
+        self.assertEqual(await lock.get_state(), 0)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
@@ -0,0 +1,173 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+import importlib.util
+import unittest
+from unittest import IsolatedAsyncioTestCase
+
+from redislocks import LockMetrics, MemoryBackend, RWLock, Semaphore
+from redislocks.metrics import OpenTelemetryMetrics, PrometheusMetrics
+
+
+class Recorder(LockMetrics):
+    def __init__(self):
+        self.events = []
+
+    def acquired(self, lock, mode, wait, round_trips):
+        self.events.append(("acquired", mode, round_trips))
+
+    def released(self, lock, mode, hold):
+        self.events.append(("released", mode))
+
+    def lost_wakeup(self, lock, mode):
+        self.events.append(("lost", mode))
+
+    def enqueued(self, lock, mode, depth):
+        self.events.append(("enqueued", mode, depth))
+
+
+class TestMetrics(IsolatedAsyncioTestCase):
+    """用MemoryBackend，不需要Redis"""
+
+    async def asyncSetUp(self) -> None:
+        self.client = MemoryBackend()
+        self.metrics = Recorder()
+
+    async def test_rwlock(self):
+        lock1 = RWLock(self.client, metrics=self.metrics)
+        lock2 = RWLock(self.client, metrics=self.metrics)
+        await lock1.acquire("w")
+        self.assertEqual(self.metrics.events, [("acquired", "w", 1)])
+        writer = asyncio.create_task(lock2.acquire("w"))
+        reader = asyncio.create_task(
+            RWLock(self.client, metrics=self.metrics).acquire("r")
+        )
+        await asyncio.sleep(0.05)
+        await lock1.release("w")  # 轮给排队的写者，读者接着等
+        await asyncio.wait_for(writer, 1)
+        await lock2.release("w")
+        await asyncio.wait_for(reader, 1)
+        self.assertEqual(
+            self.metrics.events,
+            [
+                ("acquired", "w", 1),
+                ("enqueued", "w", 0),
+                ("enqueued", "r", 0),
+                ("released", "w"),
+                ("acquired", "w", 1),  # 排队以后是被直接叫醒的，不用再访问redis
+                ("released", "w"),
+                ("acquired", "r", 1),
+            ],
+        )
+
+    async def test_lost_wakeup(self):
+        lock = RWLock(self.client, metrics=self.metrics)
+        thief = RWLock(self.client, blocking=False)
+        await lock.acquire("w")
+        reader = asyncio.create_task(
+            RWLock(self.client, metrics=self.metrics).acquire("r")
+        )
+        await asyncio.sleep(0.05)
+        await lock.release("w")
+        await thief.acquire("w")  # "del"送到之前又被拿走了
+        await asyncio.sleep(0.05)
+        self.assertIn(("lost", "r"), self.metrics.events)
+        self.assertFalse(reader.done())
+        await thief.release("w")
+        await asyncio.wait_for(reader, 1)
+
+    async def test_upgrade_downgrade(self):
+        lock = RWLock(self.client, metrics=self.metrics)
+        await lock.acquire("r")
+        await lock.upgrade()
+        await lock.downgrade()
+        await lock.release("r")
+        self.assertEqual(
+            self.metrics.events,
+            [
+                ("acquired", "r", 1),
+                ("acquired", "w", 1),
+                ("released", "r"),
+                ("released", "w"),
+                ("released", "r"),
+            ],
+        )
+        self.assertEqual(lock._held_since, {})
+
+    async def test_semaphore(self):
+        for notify in ("blpop", "publish"):
+            self.metrics.events.clear()
+            namespace = f"SEM{notify}"
+            sem1 = Semaphore(
+                1, self.client, namespace, notify=notify, metrics=self.metrics
+            )
+            sem2 = Semaphore(
+                1, self.client, namespace, notify=notify, metrics=self.metrics
+            )
+            await sem1.acquire()
+            task = asyncio.create_task(sem2.acquire())
+            await asyncio.sleep(0.05)
+            await sem1.release()
+            await asyncio.wait_for(task, 1)
+            await sem2.release()
+            events = self.metrics.events
+            self.assertEqual(events[0], ("acquired", None, 1))
+            self.assertIn(("enqueued", None, 0), events)
+            self.assertEqual(events.count(("released", None)), 2)
+            self.assertEqual(len([e for e in events if e[0] == "acquired"]), 2)
+            self.assertEqual(sem1._held_since, {})
+
+    @unittest.skipUnless(
+        importlib.util.find_spec("prometheus_client"), "prometheus-client not installed"
+    )
+    async def test_prometheus(self):
+        from prometheus_client import CollectorRegistry
+
+        registry = CollectorRegistry()
+        lock = RWLock(self.client, metrics=PrometheusMetrics(registry))
+        for _ in range(3):
+            await lock.acquire("w")
+            await lock.release("w")
+        labels = {"lock": "RWLock", "namespace": "RWLOCK", "mode": "w"}
+        self.assertEqual(
+            registry.get_sample_value("redislocks_acquire_wait_seconds_count", labels),
+            3,
+        )
+        self.assertEqual(
+            registry.get_sample_value("redislocks_acquire_round_trips_sum", labels), 3
+        )
+        self.assertEqual(
+            registry.get_sample_value("redislocks_hold_seconds_count", labels), 3
+        )
+
+    @unittest.skipUnless(
+        importlib.util.find_spec("opentelemetry.sdk"), "opentelemetry-sdk not installed"
+    )
+    async def test_opentelemetry(self):
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import InMemoryMetricReader
+
+        reader = InMemoryMetricReader()
+        provider = MeterProvider(metric_readers=[reader])
+        sem = Semaphore(2, self.client, metrics=OpenTelemetryMetrics(provider))
+        await sem.acquire()
+        await sem.release()
+        names = {
+            metric.name
+            for resource in reader.get_metrics_data().resource_metrics
+            for scope in resource.scope_metrics
+            for metric in scope.metrics
+        }
+        self.assertTrue(
+            {
+                "redislocks.acquire.wait",
+                "redislocks.hold",
+                "redislocks.acquire.round_trips",
+            }
+            <= names
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
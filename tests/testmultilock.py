@@ -0,0 +1,160 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+import os
+from unittest import IsolatedAsyncioTestCase
+
+from dotenv import load_dotenv
+from redis.asyncio import Redis
+
+from redislocks import MultiLock, NotAvailable, RWLock
+
+load_dotenv("./.env")
+
+KEYS = [
+    f"{namespace}:{suffix}"
+    for namespace in ("MULTI1", "MULTI2")
+    for suffix in ("READ", "WRITE", "WRITEWAITER", "LEASES")
+]
+
+
+class TestMultiLock(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.client = Redis(host=os.getenv("REDIS"), max_connections=10)
+        self.lock1 = RWLock(self.client, namespace="MULTI1")
+        self.lock2 = RWLock(self.client, namespace="MULTI2")
+        await self.client.delete(*KEYS)
+
+    async def test_all_or_none(self):
+        multi = MultiLock(
+            [("MULTI2", "w"), ("MULTI1", "r")], self.client, blocking=False
+        )
+        self.assertEqual(multi.namespaces, ["MULTI1", "MULTI2"])
+        await self.lock2.acquire("r")
+        with self.assertRaises(NotAvailable):
+            await multi.acquire()
+        self.assertEqual(await self.lock1.get_state(), 0)  # 一个都没拿
+        await self.lock2.release("r")
+        token = await multi.acquire()
+        self.assertEqual((await self.client.get("MULTI2:WRITE")).decode(), token)
+        self.assertTrue(await self.client.sismember("MULTI1:READ", token))
+        await multi.release()
+        self.assertEqual(await self.lock1.get_state(), 0)
+        self.assertEqual(await self.lock2.get_state(), 0)
+
+    async def test_wait(self):
+        multi = MultiLock([("MULTI1", "w"), ("MULTI2", "w")], self.client)
+        await self.lock1.acquire("w")
+        await self.lock2.acquire("r")
+        task = asyncio.create_task(multi.acquire())
+        await asyncio.sleep(0.2)
+        await self.lock1.release("w")
+        await asyncio.sleep(0.2)
+        self.assertFalse(task.done())
+        await self.lock2.release("r")  # 读锁空了会发布free
+        await asyncio.wait_for(task, 1)
+        waiter = asyncio.create_task(self.lock1.acquire("w"))
+        await asyncio.sleep(0.2)
+        await multi.release()  # 顺便把写锁轮给等待者
+        await asyncio.wait_for(waiter, 1)
+        await self.lock1.release("w")
+        self.assertEqual(await self.lock1.get_state(), 0)
+
+    async def test_lease(self):
+        """租约过期的锁被MultiLock的加锁脚本回收，MultiLock自己的token也带租约"""
+        lock1 = RWLock(self.client, namespace="MULTI1", lease_timeout=0.5)
+        # 直接跑脚本拿写锁，不注册watchdog，相当于拿完锁进程就挂了
+        await lock1._lockwrite_nowait_script(lock1._keys, [lock1._event_channel, 500])
+        multi = MultiLock(
+            [("MULTI1", "w"), ("MULTI2", "r")], self.client, lease_timeout=0.5
+        )
+        token = await asyncio.wait_for(multi.acquire(), 2)
+        self.assertIsNotNone(await self.client.zscore("MULTI1:LEASES", token))
+        self.assertIsNotNone(await self.client.zscore("MULTI2:LEASES", token))
+        await asyncio.sleep(1)  # watchdog在续租
+        self.assertEqual(await lock1.get_state(), 2)
+        await multi.release()
+        self.assertEqual(await self.client.zcard("MULTI1:LEASES"), 0)
+
+        crashed = MultiLock([("MULTI1", "w")], self.client, lease_timeout=0.5)
+        await crashed._lock()  # 拿完就挂了
+        await asyncio.wait_for(lock1.acquire("w"), 2)
+        await lock1.release("w")
+
+    async def test_queue(self):
+        """要写锁的MultiLock在每个namespace都排队，后来的读者不能插队"""
+        multi = MultiLock([("MULTI1", "w"), ("MULTI2", "r")], self.client)
+        await self.lock1.acquire("r")
+        task = asyncio.create_task(multi.acquire())
+        await asyncio.sleep(0.1)
+        self.assertEqual(await self.client.zcard("MULTI1:WRITEWAITER"), 1)
+        self.assertEqual(await self.client.zcard("MULTI2:WRITEWAITER"), 1)
+        for namespace in ("MULTI1", "MULTI2"):  # 空着的MULTI2也被挡住
+            reader = RWLock(self.client, namespace=namespace)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(reader.acquire("r"), 0.2)
+        await self.lock1.release("r")
+        token = await asyncio.wait_for(task, 1)
+        self.assertTrue(token.startswith("multi:"))
+        self.assertEqual(await self.client.zcard("MULTI1:WRITEWAITER"), 0)
+        self.assertEqual(await self.client.zcard("MULTI2:WRITEWAITER"), 0)
+        await multi.release()
+        self.assertEqual(await self.lock1.get_state(), 0)
+
+    async def test_priority(self):
+        """MultiLock和RWLock的写者按同一个优先级排队"""
+        multi = MultiLock([("MULTI1", "w"), ("MULTI2", "w")], self.client)
+        writer = RWLock(self.client, namespace="MULTI1")
+        await self.lock1.acquire("w")
+        writer_task = asyncio.create_task(writer.acquire("w"))
+        await asyncio.sleep(0.1)
+        multi_task = asyncio.create_task(multi.acquire(priority=5))
+        await asyncio.sleep(0.1)
+        await self.lock1.release("w")  # 排在最前面的是MultiLock
+        await asyncio.wait_for(multi_task, 1)
+        self.assertFalse(writer_task.done())
+        await multi.release()
+        await asyncio.wait_for(writer_task, 1)
+
+        multi_task = asyncio.create_task(multi.acquire(priority=-5))
+        await asyncio.sleep(0.1)
+        high = asyncio.create_task(self.lock1.acquire("w", priority=1))
+        await asyncio.sleep(0.1)
+        await writer.release("w")
+        await asyncio.wait_for(high, 1)
+        self.assertFalse(multi_task.done())
+        await self.lock1.release("w")
+        await asyncio.wait_for(multi_task, 1)
+        await multi.release()
+        self.assertEqual(await self.lock1.get_state(), 0)
+        self.assertEqual(await self.lock2.get_state(), 0)
+
+        with self.assertRaises(ValueError):
+            await MultiLock([("MULTI1", "r")], self.client).acquire(priority=1)
+
+    async def test_timeout(self):
+        """超时的MultiLock从每个namespace的WRITEWAITER里撤出来，被它挡住的读者可以进来了"""
+        multi = MultiLock([("MULTI1", "w"), ("MULTI2", "w")], self.client)
+        await self.lock1.acquire("r")
+        task = asyncio.create_task(multi.acquire(timeout=0.3))
+        await asyncio.sleep(0.1)
+        reader = asyncio.create_task(self.lock2.acquire("r"))
+        await asyncio.sleep(0.1)
+        self.assertFalse(reader.done())
+        with self.assertRaises(NotAvailable):
+            await task
+        self.assertEqual(await self.client.zcard("MULTI1:WRITEWAITER"), 0)
+        self.assertEqual(await self.client.zcard("MULTI2:WRITEWAITER"), 0)
+        await asyncio.wait_for(reader, 1)
+        await self.lock2.release("r")
+        await self.lock1.release("r")
+
+    async def asyncTearDown(self) -> None:
+        await self.client.delete(*KEYS)
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
@@ -61,6 +61,29 @@ class TestLock(IsolatedAsyncioTestCase):
         await self.lock1.release("r")
         print(await self.client.keys("*"))
 
+    async def test_hash_tag(self):
+        """hash_tag打开以后同一个namespace的key都带着同一个{}"""
+        lock = RWLock(self.client, namespace="HASHTAG", blocking=False, hash_tag=True)
+        self.assertEqual(lock.read_key, "{HASHTAG}:READ")
+        token = await lock.acquire("w")
+        self.assertEqual((await self.client.get("{HASHTAG}:WRITE")).decode(), token)
+        with self.assertRaises(NotAvailable):
+            await lock.acquire("r")
+        await lock.release("w")
+        await lock.acquire("r")
+        self.assertEqual(await self.client.scard("{HASHTAG}:READ"), 1)
+        await lock.release("r")
+        self.assertEqual(await lock.get_state(), 0)
+
+    async def test_script_flush(self):
+        """redis丢了脚本以后自动重新加载"""
+        await self.lock1.acquire("w")
+        await self.client.script_flush()
+        await self.lock1.release("w")
+        await self.lock2.acquire("r")
+        await self.lock2.release("r")
+        self.assertEqual(await self.lock1.get_state(), 0)
+
     async def asyncTearDown(self) -> None:
         await self.client.delete("RWLOCK:READ", "RWLOCK:WRITE", "RWLOCK:WRITEWAITER")
 
@@ -1,13 +1,14 @@
 """
 Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
 """
+import asyncio
 import os
 from unittest import IsolatedAsyncioTestCase
 
 from dotenv import load_dotenv
 from redis.asyncio import Redis
 
-from redislocks import NotAvailable, Semaphore
+from redislocks import NotAvailable, Semaphore, StripedSemaphore
 
 load_dotenv("./.env")
 
@@ -35,6 +36,115 @@ class TestSem(IsolatedAsyncioTestCase):
         with self.assertRaises(NotAvailable):
             await self.sem2.acquire()
 
+    async def test_init_on_acquire(self):
+        await self.sem1.client.delete(
+            self.sem1.check_exists_key, self.sem1.available_key, self.sem1.grabbed_key
+        )
+        token = await self.sem1.acquire()
+        self.assertEqual(await self.sem1.available_count, 1)
+        self.assertTrue(await self.sem1._is_locked(token))
+        await self.sem1.release()
+        self.assertEqual(await self.sem1.available_count, 2)
+
+    async def test_acquire_many(self):
+        tokens = await self.sem1.acquire_many(2)
+        self.assertEqual(len(set(tokens)), 2)
+        with self.assertRaises(NotAvailable):
+            await self.sem2.acquire()
+        self.assertEqual(await self.sem1.release_many(tokens), 2)
+        self.assertEqual(self.sem1.num_tokens, 0)
+        await self.sem2.acquire()
+        with self.assertRaises(NotAvailable):  # 只剩一个，一个都不拿
+            await self.sem1.acquire_many(2)
+        self.assertEqual(await self.sem1.available_count, 1)
+        with self.assertRaises(ValueError):
+            await self.sem1.acquire_many(3)
+        await self.sem2.release()
+
+    async def test_counter_layout(self):
+        sem = Semaphore(
+            200000,
+            self.sem1.client,
+            namespace="SEMCOUNTER",
+            blocking=False,
+            layout="counter",
+        )
+        await sem.reset()
+        token = await sem.acquire()
+        tokens = await sem.acquire_many(3)
+        self.assertEqual(len({token, *tokens}), 4)
+        self.assertEqual(await sem.available_count, 199996)
+        self.assertFalse(await sem.client.exists(sem.available_key))
+        self.assertEqual(await sem.release_many(tokens), 3)
+        await sem.release()
+        self.assertEqual(await sem.available_count, 200000)
+
+        small = Semaphore(
+            1,
+            self.sem1.client,
+            namespace="SEMCOUNTER",
+            blocking=False,
+            layout="counter",
+        )
+        await small.acquire()
+        with self.assertRaises(NotAvailable):
+            await small.acquire()
+        await small.release()
+        await sem.reset()
+
+    async def test_stale(self):
+        sem = Semaphore(2, self.sem1.client, blocking=False, stale_client_timeout=0.5)
+        await self.sem1.acquire()
+        await self.sem1.acquire()
+        with self.assertRaises(NotAvailable):
+            await sem.acquire()
+        await asyncio.sleep(0.6)
+        await sem.acquire()  # 超时的token被acquire顺便回收了
+        self.assertEqual(await self.sem1.client.zcard(self.sem1.grabbed_key), 1)
+        self.assertEqual(await self.sem1.available_count, 1)
+        await asyncio.sleep(0.6)
+        self.assertEqual(len(await sem.release_stale_locks()), 1)
+        self.assertEqual(await self.sem1.available_count, 2)
+
+    async def test_striped(self):
+        sem = StripedSemaphore(
+            5, 2, self.sem1.client, namespace="SEMSTRIPED", blocking=False
+        )
+        await sem.reset()
+        self.assertEqual([stripe.value for stripe in sem.stripes], [3, 2])
+        tokens = [await sem.acquire() for _ in range(5)]  # 一个拿完了会去拿另一个
+        self.assertEqual(len(set(tokens)), 5)
+        self.assertTrue(await sem.locked())
+        with self.assertRaises(NotAvailable):
+            await sem.acquire()
+        self.assertEqual(await sem.signal(tokens[0]), tokens[0])
+        self.assertFalse(await sem.locked())
+        self.assertEqual(await sem.acquire(), tokens[0])
+        await sem.release_all()
+        self.assertEqual(await sem.available_count, 5)
+
+    async def test_striped_one_round_trip(self):
+        for layout in ("list", "counter"):
+            sem = StripedSemaphore(
+                4,
+                4,
+                self.sem1.client,
+                namespace="SEMSTRIPED",
+                blocking=False,
+                notify="publish",
+                layout=layout,
+            )
+            await sem.reset()
+            for stripe in sem.stripes:  # 单机不会一个一个子信号量去试
+                stripe._try_acquire = None
+            tokens = [await sem.acquire() for _ in range(4)]
+            self.assertEqual(sorted(token[0] for token in tokens), list("0123"))
+            with self.assertRaises(NotAvailable):
+                await sem.acquire()
+            await sem.release_all()
+            self.assertEqual(await sem.available_count, 4)
+            await sem.reset()
+
     async def asyncTearDown(self) -> None:
         await self.sem1.reset()
 
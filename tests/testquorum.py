@@ -0,0 +1,139 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+import os
+from unittest import IsolatedAsyncioTestCase
+
+from dotenv import load_dotenv
+from redis.asyncio import Redis
+
+from redislocks import NotAvailable, QuorumRWLock, QuorumSemaphore, RWLock
+
+load_dotenv("./.env")
+
+# 同一个redis的不同db当作互相独立的实例
+DBS = (1, 2, 3)
+
+
+class TestQuorum(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.clients = [
+            Redis(host=os.getenv("REDIS"), db=db, max_connections=10) for db in DBS
+        ]
+        for client in self.clients:
+            await client.flushdb()
+
+    async def test_rwlock_majority(self):
+        other = RWLock(self.clients[0], blocking=False)
+        await other.acquire("w")  # 一个实例被别人占了，还有两个
+        lock = QuorumRWLock(self.clients, lease_timeout=10, blocking=False)
+        validity = await lock.acquire("w")
+        self.assertTrue(0 < validity < 10)
+        self.assertEqual(await self.clients[1].exists("RWLOCK:WRITE"), 1)
+        self.assertEqual(await self.clients[2].exists("RWLOCK:WRITE"), 1)
+        await lock.release()
+        self.assertEqual(await self.clients[1].exists("RWLOCK:WRITE"), 0)
+        await other.release("w")
+
+    async def test_rwlock_rollback(self):
+        others = [RWLock(client, blocking=False) for client in self.clients[:2]]
+        for other in others:
+            await other.acquire("r")
+        lock = QuorumRWLock(self.clients, lease_timeout=10, blocking=False)
+        with self.assertRaises(NotAvailable):
+            await lock.acquire("w")
+        self.assertEqual(await self.clients[2].exists("RWLOCK:WRITE"), 0)  # 拿到的少数派被放掉了
+        await others[0].release("r")
+        blocking = QuorumRWLock(self.clients, lease_timeout=10, retry_delay=0.05)
+        await blocking.acquire("w", timeout=2)
+        await blocking.release()
+        await others[1].release("r")
+
+    async def test_instance_down(self):
+        dead = Redis(host=os.getenv("REDIS"), port=1)  # 没有人监听
+        lock = QuorumRWLock([*self.clients[:2], dead], lease_timeout=10, blocking=False)
+        await lock.acquire("w")
+        await lock.release()
+        lock = QuorumRWLock([self.clients[0], dead], lease_timeout=10, blocking=False)
+        with self.assertRaises(NotAvailable):
+            await lock.acquire("w")
+        self.assertEqual(await self.clients[0].exists("RWLOCK:WRITE"), 0)
+
+    async def test_release_after_expiry(self):
+        lock = QuorumRWLock(self.clients, lease_timeout=0.2, blocking=False)
+        await lock.acquire("w")
+        await asyncio.sleep(0.3)  # 有效期过了
+        other = QuorumRWLock(self.clients, lease_timeout=10, blocking=False)
+        await other.acquire("w")  # 过期的锁被加锁脚本回收
+        await lock.release()  # 什么都放不掉，不报错
+        for instance in lock.locks:
+            self.assertIsNone(instance._local_writetoken)
+        self.assertEqual(await self.clients[0].exists("RWLOCK:WRITE"), 1)  # 别人的锁还在
+        await other.release()
+
+    async def test_semaphore(self):
+        sem = QuorumSemaphore(1, self.clients, stale_client_timeout=10, blocking=False)
+        await sem.acquire()
+        with self.assertRaises(NotAvailable):
+            await sem.acquire()
+        await sem.release()
+        self.assertEqual(await sem.sems[0].available_count, 1)
+        with self.assertRaises(ValueError):
+            await sem.release()
+
+    async def test_slow_instance(self):
+        lock = QuorumRWLock(
+            self.clients, lease_timeout=10, blocking=False, instance_timeout=0.1
+        )
+        slow = lock.locks[2]
+        script = slow._lockwrite_nowait_script
+
+        async def delayed(keys, args, client=None):
+            result = await script(keys, args)
+            await asyncio.sleep(0.3)  # 脚本已经跑完了，回复晚到
+            return result
+
+        slow._lockwrite_nowait_script = delayed
+        await lock.acquire("w")
+        self.assertEqual(await self.clients[2].exists("RWLOCK:WRITE"), 1)
+        await lock.release()
+        await asyncio.sleep(0.4)
+        self.assertEqual(await self.clients[2].exists("RWLOCK:WRITE"), 0)  # 晚到的锁也放掉了
+
+        sem = QuorumSemaphore(
+            1,
+            self.clients,
+            stale_client_timeout=10,
+            blocking=False,
+            instance_timeout=0.1,
+        )
+        script = sem.sems[2]._acquire_script
+
+        async def delayed_sem(keys, args, client=None):
+            result = await script(keys, args)
+            await asyncio.sleep(0.3)
+            return result
+
+        sem.sems[2]._acquire_script = delayed_sem
+        await sem.acquire()
+        await sem.release()
+        await asyncio.sleep(0.4)
+        self.assertEqual(await sem.sems[2].available_count, 1)
+
+    async def test_extend(self):
+        lock = QuorumRWLock(self.clients, lease_timeout=0.5, blocking=False)
+        other = RWLock(self.clients[0], blocking=False)
+        with self.assertRaises(ValueError):
+            await lock.extend()
+        await lock.acquire("w")
+        await asyncio.sleep(0.3)
+        self.assertTrue(0 < await lock.extend() < 0.5)
+        await asyncio.sleep(0.3)  # 续过了，还没到期
+        with self.assertRaises(NotAvailable):
+            await other.acquire("w")
+        await asyncio.sleep(0.6)  # 没有后台续租，过期以后被加锁脚本回收
+        await other.acquire("w")
+        await other.release("w")
+        with self.assertRaises(NotAvailable):
+            await lock.extend()
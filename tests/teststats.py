@@ -0,0 +1,156 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import asyncio
+import contextlib
+import io
+import json
+import os
+from unittest import IsolatedAsyncioTestCase
+
+from dotenv import load_dotenv
+from redis.asyncio import Redis
+
+from redislocks import MemoryBackend, NotAvailable, RWLock, Semaphore
+from redislocks.__main__ import main
+from redislocks.stats import collect, format_table, parse, rank
+
+load_dotenv("./.env")
+
+
+class StatsCases:
+    async def test_rwlock(self):
+        lock1 = RWLock(self.client, "STATSRW", stats=True)
+        lock2 = RWLock(self.client, "STATSRW", stats=True)
+        await lock1.acquire("w")
+        writer = asyncio.create_task(lock2.acquire("w"))
+        await asyncio.sleep(0.05)
+        await lock1.release("w")  # 轮给lock2
+        await asyncio.wait_for(writer, 1)
+        await lock2.release("w")
+        await lock1.acquire("r")
+        await lock1.release("r")
+
+        stats = (await collect(self.client, "STATSRW"))["STATSRW"]
+        self.assertEqual(stats["promotions"], 1)
+        write = stats["modes"]["w"]
+        self.assertEqual((write["acquired"], write["contended"]), (2, 1))
+        self.assertGreaterEqual(write["wait_p99"], 32)  # lock2等了50ms
+        self.assertGreaterEqual(write["hold_ms"], 20)
+        read = stats["modes"]["r"]
+        self.assertEqual((read["acquired"], read["contended"]), (1, 0))
+
+    async def test_semaphore(self):
+        for layout in ("list", "counter"):
+            namespace = f"STATSSEM{layout}"
+            sem1, sem2 = [
+                Semaphore(
+                    2, self.client, namespace, layout=layout, stats=True, blocking=False
+                )
+                for _ in range(2)
+            ]
+            tokens = await sem1.acquire_many(2)
+            with self.assertRaises(NotAvailable):
+                await sem2.acquire()
+            await sem1.release_many(tokens)
+            await sem2.acquire()
+            await sem2.release()
+            stats = (await collect(self.client, namespace))[namespace]["modes"]["s"]
+            self.assertEqual((stats["acquired"], stats["contended"]), (3, 1))
+
+    async def test_retry_contended_once(self):
+        # 被叫醒以后重试又失败，同一次acquire不再记contended
+        lock1 = RWLock(self.client, "STATSRETRY", stats=True)
+        lock2 = RWLock(self.client, "STATSRETRY", stats=True)
+        await lock1.acquire("w")
+        reader = asyncio.create_task(lock2.acquire("r"))
+        await asyncio.sleep(0.05)
+        await lock2._grant_readers()  # 写锁还在，替等待的读者重试又失败
+        await lock1.release("w")
+        await asyncio.wait_for(reader, 1)
+        await lock2.release("r")
+        read = (await collect(self.client, "STATSRETRY"))["STATSRETRY"]["modes"]["r"]
+        self.assertEqual((read["acquired"], read["contended"]), (1, 1))
+
+        for layout in ("list", "counter"):
+            namespace = f"STATSRETRY{layout}"
+            sem1, sem2 = [
+                Semaphore(
+                    1,
+                    self.client,
+                    namespace,
+                    layout=layout,
+                    stats=True,
+                    notify="publish",
+                )
+                for _ in range(2)
+            ]
+            await sem1.acquire()
+            waiter = asyncio.create_task(sem2.acquire())
+            await asyncio.sleep(0.05)
+            await sem2._grant_waiters()  # 没有token，重试又失败
+            await sem1.release()
+            await asyncio.wait_for(waiter, 1)
+            await sem2.release()
+            stats = (await collect(self.client, namespace))[namespace]["modes"]["s"]
+            self.assertEqual((stats["acquired"], stats["contended"]), (2, 1))
+
+    async def test_disabled(self):
+        lock = RWLock(self.client, "STATSOFF")
+        await lock.acquire("w")
+        await lock.release("w")
+        self.assertEqual(await collect(self.client, "STATSOFF"), {})
+
+
+class TestStatsMemory(StatsCases, IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.client = MemoryBackend()
+
+    def test_rank(self):
+        hot = parse({b"acquired:w": b"10", b"contended:w": b"8", b"wait:w:64": b"10"})
+        cold = parse({"acquired:r": "100", "contended:r": "2", "promotions": "0"})
+        self.assertEqual(hot["modes"]["w"]["wait_p50"], 64)
+        stats = {"HOT": hot, "COLD": cold}
+        self.assertEqual([ns for ns, _ in rank(stats, "rate")], ["HOT", "COLD"])
+        self.assertEqual([ns for ns, _ in rank(stats, "acquired", 1)], ["COLD"])
+        self.assertIn("HOT", format_table(rank(stats)))
+        with self.assertRaises(ValueError):
+            rank(stats, "nope")
+
+
+class TestStatsRedis(StatsCases, IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.client = Redis(host=os.getenv("REDIS"))
+        await self.client.config_set("notify-keyspace-events", "Ag$lshzxeKEtmdn")
+        async for key in self.client.scan_iter(match="STATS*"):
+            await self.client.delete(key)
+
+    async def asyncTearDown(self) -> None:
+        await self.client.aclose()
+
+    async def test_cli(self):
+        lock = RWLock(self.client, "STATSCLI", stats=True)
+        await lock.acquire("r")
+        await lock.release("r")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            await asyncio.to_thread(
+                main,
+                [
+                    "stats",
+                    "--url",
+                    f"redis://{os.getenv('REDIS')}:6379/0",
+                    "--match",
+                    "STATSCLI",
+                    "--json",
+                ],
+            )
+        self.assertEqual(
+            json.loads(output.getvalue())["STATSCLI"]["modes"]["r"]["acquired"], 1
+        )
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()
@@ -0,0 +1,213 @@
+"""
+Copyright (c) 2008-2023 synodriver <diguohuangjiajinweijun@gmail.com>
+"""
+import os
+import threading
+import time
+from unittest import TestCase
+
+from dotenv import load_dotenv
+from redis import Redis
+from redis.exceptions import TimeoutError
+
+from redislocks.sync import NotAvailable, RWLock, Semaphore
+from redislocks.sync.dispatcher import EventDispatcher
+
+load_dotenv("./.env")
+
+KEYS = [
+    f"SYNC:{suffix}"
+    for suffix in ("READ", "WRITE", "WRITEWAITER", "UPGRADER", "LEASES", "EVENTS")
+] + [
+    f"SYNCSEM:{suffix}"
+    for suffix in ("EXISTS", "AVAILABLE", "GRABBED", "SEQ", "PENDING")
+]
+
+
+class TestSync(TestCase):
+    def setUp(self) -> None:
+        self.client = Redis(host=os.getenv("REDIS"), max_connections=20)
+        self.client.delete(*KEYS)
+
+    def tearDown(self) -> None:
+        self.client.delete(*KEYS)
+        self.client.close()
+
+    def test_nonblocking(self):
+        lock1 = RWLock(self.client, namespace="SYNC", blocking=False)
+        lock2 = RWLock(self.client, namespace="SYNC", blocking=False)
+        token = lock1.acquire("w")
+        self.assertEqual(self.client.get("SYNC:WRITE").decode(), token)
+        with self.assertRaises(NotAvailable):
+            lock2.acquire("r")
+        lock1.release("w")
+        lock2.acquire("r")
+        self.assertTrue(lock2.locked("w"))
+        lock2.release("r")
+        self.assertEqual(lock1.get_state(), 0)
+
+    def test_wakeup(self):
+        """写锁释放以后后台线程叫醒等待的读者和写者"""
+        lock = RWLock(self.client, namespace="SYNC")
+        lock.acquire("w")
+        got = []
+
+        def worker(mode):
+            other = RWLock(self.client, namespace="SYNC")
+            other.acquire(mode)
+            got.append(mode)
+            time.sleep(0.05)
+            other.release(mode)
+
+        threads = [threading.Thread(target=worker, args=(mode,)) for mode in "rrw"]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        self.assertEqual(got, [])
+        lock.release("w")
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(sorted(got), ["r", "r", "w"])
+        self.assertEqual(lock.get_state(), 0)
+
+    def test_shared_between_threads(self):
+        """一个锁对象给多个线程共用，写锁互斥"""
+        lock = RWLock(self.client, namespace="SYNC")
+        inside = []
+        overlaps = []
+
+        def worker():
+            for _ in range(5):
+                lock.acquire("w")
+                inside.append(1)
+                if len(inside) > 1:
+                    overlaps.append(1)
+                time.sleep(0.002)
+                inside.pop()
+                lock.release("w")
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(overlaps, [])
+        self.assertEqual(lock.get_state(), 0)
+
+    def test_timeout(self):
+        lock1 = RWLock(self.client, namespace="SYNC")
+        lock2 = RWLock(self.client, namespace="SYNC")
+        lock1.acquire("r")
+        with self.assertRaises(NotAvailable):
+            lock2.acquire("w", timeout=0.2)
+        self.assertEqual(self.client.zcard("SYNC:WRITEWAITER"), 0)  # 排队被取消了
+        lock2.acquire("r", timeout=0.2)
+        lock2.release("r")
+        lock1.upgrade()
+        self.assertEqual(lock1.get_state(), 2)
+        lock1.downgrade()
+        lock1.release("r")
+        self.assertEqual(lock1.get_state(), 0)
+
+    def test_semaphore(self):
+        for layout, notify in (
+            ("list", "publish"),
+            ("list", "blpop"),
+            ("counter", "publish"),
+        ):
+            sem = Semaphore(
+                2, self.client, namespace="SYNCSEM", layout=layout, notify=notify
+            )
+            sem.reset()
+            running = []
+            peak = []
+
+            def worker():
+                with sem:
+                    running.append(1)
+                    peak.append(len(running))
+                    time.sleep(0.02)
+                    running.pop()
+
+            threads = [threading.Thread(target=worker) for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+            self.assertEqual(len(peak), 6)
+            self.assertLessEqual(max(peak), 2)
+            self.assertEqual(sem.available_count, 2)
+            self.client.delete(*KEYS)
+
+    def test_semaphore_default_notify(self):
+        """默认用client共享的后台线程等，阻塞的线程不占连接"""
+        sem = Semaphore(1, self.client, namespace="SYNCSEM")
+        self.assertEqual(sem.notify, "publish")
+        sem.reset()
+        sem.acquire()
+        before = len(self.client.connection_pool._in_use_connections)
+
+        def worker():
+            with sem:
+                pass
+
+        waiters = [threading.Thread(target=worker) for _ in range(4)]
+        for waiter in waiters:
+            waiter.start()
+        time.sleep(0.2)
+        self.assertLessEqual(
+            len(self.client.connection_pool._in_use_connections), before
+        )
+        sem.release()
+        for waiter in waiters:
+            waiter.join(5)
+        self.assertEqual(sem.available_count, 1)
+        self.client.delete(*KEYS)
+
+    def test_subscribe_from_threads(self):
+        """很多线程同时订阅，PubSub只在后台线程里用"""
+        dispatcher = EventDispatcher(self.client)
+        handlers = []
+        errors = []
+
+        class Handler:
+            def _handle_event(self, channel, data):
+                pass
+
+        def subscribe(i):
+            handler = Handler()
+            handlers.append(handler)
+            try:
+                dispatcher.subscribe(f"SYNC:CH{i % 4}".encode(), handler)
+            except Exception as e:
+                errors.append(e)
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=subscribe, args=(i,)) for i in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(errors, [])
+        self.assertLess(time.monotonic() - start, dispatcher.poll_interval)
+
+    def test_subscribe_timeout(self):
+        dead = Redis(host=os.getenv("REDIS"), port=1)  # 没有人监听
+        dispatcher = EventDispatcher(dead)
+        dispatcher.subscribe_timeout = 0.3
+
+        class Handler:
+            def _handle_event(self, channel, data):
+                pass
+
+        handler = Handler()
+        with self.assertRaises(TimeoutError):
+            dispatcher.subscribe(b"SYNC:DEAD", handler)
+        time.sleep(0.3)
+        self.assertIsNone(dispatcher._thread)  # 没有handler了，后台线程退出
+
+
+if __name__ == "__main__":
+    import unittest
+
+    unittest.main()